@@ -0,0 +1,368 @@
+"""
+Asynchronous HTTP/JSON API over the movie database, built on asyncio streams.
+The blocking storage functions run in a thread pool, while the connection pool
+of storage.database is shared by all requests. Writes run one at a time and
+never while a read uses the MovieCaches, which they change. Read responses are
+cached until any process changes the movies or users, which the counter of
+storage.movie_storage_sql.data_changes() shows. Unknown user_ids get a 404.
+
+Endpoints:
+    GET    /users
+    GET    /users/{user_id}/movies?after=<last title>&limit=100
+    GET    /users/{user_id}/movies/search?q=matrix
+    GET    /users/{user_id}/stats
+    POST   /users/{user_id}/movies           {"titles": ["The Matrix", ...]}
+    PATCH  /users/{user_id}/movies/{title}   {"comment": "...", "version": 3 (optional)}
+    DELETE /users/{user_id}/movies/{title}
+    GET    /metrics[?format=json]            Prometheus text by default
+
+Start it with:
+    python api_server.py [--host 127.0.0.1] [--port 8080] [--workers 8]
+"""
+import argparse
+import asyncio
+import json
+import re
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from http import HTTPStatus
+from urllib.parse import parse_qs, unquote, urlsplit
+
+import cli
+from storage import metrics
+from storage import movie_storage_sql as storage
+from storage import user_data_handling as user
+from storage.errors import UnknownUserError, VersionConflictError
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+MAX_BODY_SIZE = 1024 * 1024
+RESPONSE_CACHE_SIZE = 1024
+JSON_CONTENT_TYPE = "application/json"
+# Prometheus text exposition format
+TEXT_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+ROUTES = [
+    ("GET", re.compile(r"^/users$"), "list_users"),
+    ("GET", re.compile(r"^/users/(?P<user_id>\d+)/movies$"), "list_movies"),
+    ("GET", re.compile(r"^/users/(?P<user_id>\d+)/movies/search$"), "search_movies"),
+    ("GET", re.compile(r"^/users/(?P<user_id>\d+)/stats$"), "show_stats"),
+    ("POST", re.compile(r"^/users/(?P<user_id>\d+)/movies$"), "add_movies"),
+    ("PATCH", re.compile(r"^/users/(?P<user_id>\d+)/movies/(?P<title>[^/]+)$"), "update_movie"),
+    ("DELETE", re.compile(r"^/users/(?P<user_id>\d+)/movies/(?P<title>[^/]+)$"), "delete_movie"),
+    ("GET", re.compile(r"^/metrics$"), "show_metrics"),
+]
+
+
+class HttpError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class ReadWriteLock:
+    """
+    Lets any number of reading tasks or one writing task in at a time.
+    A waiting writer holds back new readers, so a stream of reads can't starve the writes.
+    """
+
+    def __init__(self):
+        self._condition = asyncio.Condition()
+        self._readers = 0
+        self._writing = False
+        self._waiting_writers = 0
+
+    @asynccontextmanager
+    async def reading(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: not self._writing and not self._waiting_writers)
+            self._readers += 1
+        try:
+            yield
+        finally:
+            async with self._condition:
+                self._readers -= 1
+                self._condition.notify_all()
+
+    @asynccontextmanager
+    async def writing(self):
+        async with self._condition:
+            self._waiting_writers += 1
+            try:
+                await self._condition.wait_for(lambda: not self._writing and not self._readers)
+            finally:
+                self._waiting_writers -= 1
+            self._writing = True
+        try:
+            yield
+        finally:
+            async with self._condition:
+                self._writing = False
+                self._condition.notify_all()
+
+
+def list_movies_page(user_id, after_title, limit):
+    """
+    One page of a user's movies ordered by title, read with a keyset query.
+    next_after is the parameter for the following page, None after the last one.
+    """
+    movies = storage.list_movies_page(user_id, after_title, limit)
+    if not movies:
+        check_user(user_id)
+    next_after = movies[-1].title if len(movies) == limit else None
+    return {"after": after_title, "limit": limit, "next_after": next_after,
+            "movies": [dict(movie.as_dict(), version=movie.version) for movie in movies]}
+
+
+def search_movies(user_id, query):
+    results = cli.search_command(user_id, query)
+    if not results:
+        check_user(user_id)
+    return results
+
+
+def user_stats(user_id):
+    stats = cli.stats_command(user_id)
+    if not stats[0]["count"]:
+        check_user(user_id)
+    return stats
+
+
+def check_user(user_id):
+    """
+    Raises UnknownUserError, if there is no user with this user_id.
+    Only empty reads check it, they may come from an unknown user.
+    """
+    user.get_user_name(user_id)
+
+
+class MovieApi:
+    """ Request handlers and the state shared between the requests """
+
+    def __init__(self, workers=8):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="storage")
+        # Reads iterate the MovieCaches in the pool threads, writes change them
+        self.cache_lock = ReadWriteLock()
+        # {cache_key: (data_changes counter, status, body)}
+        self.response_cache = {}
+
+    async def run_blocking(self, function, *args):
+        """ Run a storage function in the thread pool """
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    async def cached_read(self, cache_key, function, *args):
+        """
+        Answer a read request from the response cache, while no process committed a change
+        to the database. The change counter is read on every request in the thread pool,
+        it waits for the database like every other query.
+        Returns: (status, body)
+        """
+        # Read before the response, a change in between only computes it again next time
+        changes = await self.run_blocking(storage.data_changes)
+        cached = self.response_cache.get(cache_key)
+        if cached is not None and cached[0] == changes:
+            return cached[1], cached[2]
+        async with self.cache_lock.reading():
+            body = json.dumps(await self.run_blocking(function, *args)).encode()
+        if len(self.response_cache) >= RESPONSE_CACHE_SIZE:
+            self.response_cache.pop(next(iter(self.response_cache)))
+        self.response_cache[cache_key] = (changes, HTTPStatus.OK, body)
+        return HTTPStatus.OK, body
+
+    @metrics.timed("api_request_seconds")
+    async def list_users(self, query, body):
+        return HTTPStatus.OK, await self.run_blocking(cli.users_list_command)
+
+    @metrics.timed("api_request_seconds")
+    async def list_movies(self, query, body, user_id):
+        after_title = query.get("after", [None])[0]
+        limit = min(_int_parameter(query, "limit", DEFAULT_PAGE_SIZE), MAX_PAGE_SIZE)
+        if limit == 0:
+            raise HttpError(HTTPStatus.BAD_REQUEST, "Parameter 'limit' has to be positive")
+        return await self.cached_read(("movies", user_id, after_title, limit),
+                                      list_movies_page, user_id, after_title, limit)
+
+    @metrics.timed("api_request_seconds")
+    async def search_movies(self, query, body, user_id):
+        search = query.get("q", [""])[0]
+        if not search:
+            raise HttpError(HTTPStatus.BAD_REQUEST, "Parameter 'q' is missing")
+        return await self.cached_read(("search", user_id, search), search_movies, user_id, search)
+
+    @metrics.timed("api_request_seconds")
+    async def show_stats(self, query, body, user_id):
+        return await self.cached_read(("stats", user_id), user_stats, user_id)
+
+    @metrics.timed("api_request_seconds")
+    async def add_movies(self, query, body, user_id):
+        titles = _json_body(body).get("titles")
+        if not isinstance(titles, list) or not titles:
+            raise HttpError(HTTPStatus.BAD_REQUEST, "Expected {\"titles\": [...]}")
+        titles = [str(title).title() for title in titles]
+        async with self.cache_lock.reading():
+            saved_titles = await self.run_blocking(cli.saved_titles_of, user_id)
+        # The requests to the OMDb-API take the longest, other requests go on meanwhile
+        results, movies = await self.run_blocking(cli.fetch_new_movies, titles, saved_titles)
+        async with self.cache_lock.writing():
+            return HTTPStatus.CREATED, await self.run_blocking(cli.save_new_movies, user_id, titles, results, movies)
+
+    @metrics.timed("api_request_seconds")
+    async def update_movie(self, query, body, user_id, title):
+        data = _json_body(body)
+        comment = data.get("comment")
+        version = data.get("version")
+        if not isinstance(comment, str) or not (version is None or isinstance(version, int)):
+            raise HttpError(HTTPStatus.BAD_REQUEST, "Expected {\"comment\": \"...\", \"version\": 3}")
+        async with self.cache_lock.writing():
+            try:
+                result = await self.run_blocking(cli.update_command, user_id, title, comment, version)
+            except VersionConflictError as e:
+                raise HttpError(HTTPStatus.CONFLICT, str(e))
+        return (HTTPStatus.OK if result[0]["updated"] else HTTPStatus.NOT_FOUND), result
+
+    @metrics.timed("api_request_seconds")
+    async def delete_movie(self, query, body, user_id, title):
+        async with self.cache_lock.writing():
+            result = await self.run_blocking(cli.delete_command, user_id, [title])
+        return (HTTPStatus.OK if result[0]["deleted"] else HTTPStatus.NOT_FOUND), result
+
+    async def show_metrics(self, query, body):
+        if query.get("format", [""])[0] == "json":
+            return HTTPStatus.OK, metrics.snapshot()
+        return HTTPStatus.OK, metrics.to_prometheus()
+
+    async def dispatch(self, method, target, body):
+        """
+        Route a request to its handler, handlers return JSON data,
+        JSON already encoded as bytes or plain text as str.
+        Returns: (status, body bytes, content type)
+        """
+        url = urlsplit(target)
+        query = parse_qs(url.query)
+        path_matched = False
+        for route_method, pattern, handler_name in ROUTES:
+            match = pattern.match(url.path)
+            if not match:
+                continue
+            path_matched = True
+            if route_method != method:
+                continue
+            parameters = match.groupdict()
+            if "user_id" in parameters:
+                parameters["user_id"] = int(parameters["user_id"])
+            if "title" in parameters:
+                parameters["title"] = unquote(parameters["title"])
+            status, result = await getattr(self, handler_name)(query, body, **parameters)
+            if isinstance(result, bytes):
+                return status, result, JSON_CONTENT_TYPE
+            if isinstance(result, str):
+                return status, result.encode(), TEXT_CONTENT_TYPE
+            return status, json.dumps(result).encode(), JSON_CONTENT_TYPE
+        if path_matched:
+            raise HttpError(HTTPStatus.METHOD_NOT_ALLOWED, f"{method} is not allowed here")
+        raise HttpError(HTTPStatus.NOT_FOUND, f"No endpoint {url.path}")
+
+    async def handle_connection(self, reader, writer):
+        """ Serve the requests of one keep-alive connection """
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                try:
+                    method, target, version = request_line.decode("latin-1").split()
+                except ValueError:
+                    await _write_response(writer, HTTPStatus.BAD_REQUEST, b'{"error": "Bad request line"}', False)
+                    break
+                headers = await _read_headers(reader)
+                keep_alive = headers.get("connection", "").lower() != "close" and version == "HTTP/1.1"
+                try:
+                    length = int(headers.get("content-length", 0))
+                    if length > MAX_BODY_SIZE:
+                        raise HttpError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, "Body too large")
+                    body = await reader.readexactly(length) if length else b""
+                    status, response_body, content_type = await self.dispatch(method.upper(), target, body)
+                except HttpError as e:
+                    status, response_body = e.status, json.dumps({"error": str(e)}).encode()
+                except UnknownUserError as e:
+                    status, response_body = HTTPStatus.NOT_FOUND, json.dumps({"error": str(e)}).encode()
+                except (ValueError, KeyError) as e:
+                    status, response_body = HTTPStatus.BAD_REQUEST, json.dumps({"error": str(e)}).encode()
+                except Exception as e:
+                    status = HTTPStatus.INTERNAL_SERVER_ERROR
+                    response_body = json.dumps({"error": f"{type(e).__name__}: {e}"}).encode()
+                if status >= 400:
+                    content_type = JSON_CONTENT_TYPE
+                metrics.count("api_responses_total", str(status.value))
+                await _write_response(writer, status, response_body, keep_alive, content_type)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+
+def _int_parameter(query, name, default):
+    try:
+        value = int(query.get(name, [default])[0])
+    except ValueError:
+        raise HttpError(HTTPStatus.BAD_REQUEST, f"Parameter '{name}' has to be a number")
+    if value < 0:
+        raise HttpError(HTTPStatus.BAD_REQUEST, f"Parameter '{name}' can't be negative")
+    return value
+
+
+def _json_body(body):
+    try:
+        data = json.loads(body or b"{}")
+    except ValueError:
+        raise HttpError(HTTPStatus.BAD_REQUEST, "Body is no valid JSON")
+    if not isinstance(data, dict):
+        raise HttpError(HTTPStatus.BAD_REQUEST, "Body has to be a JSON object")
+    return data
+
+
+async def _read_headers(reader):
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            return headers
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+
+async def _write_response(writer, status, body, keep_alive, content_type=JSON_CONTENT_TYPE):
+    writer.write(f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+                 f"Content-Type: {content_type}\r\n"
+                 f"Content-Length: {len(body)}\r\n"
+                 f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode("latin-1") + body)
+    await writer.drain()
+
+
+async def start_server(host="127.0.0.1", port=8080, workers=8):
+    """ Create the database if needed and start listening, returns the asyncio server """
+    api = MovieApi(workers)
+    await api.run_blocking(storage.create_table, None)
+    return await asyncio.start_server(api.handle_connection, host, port)
+
+
+async def serve(host, port, workers):
+    server = await start_server(host, port, workers)
+    print(f"Serving the movie API on http://{host}:{server.sockets[0].getsockname()[1]}", flush=True)
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve the movie database as HTTP/JSON API.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--workers", type=int, default=8, help="threads for the database calls")
+    arguments = parser.parse_args()
+    metrics.setup_from_environment()
+    try:
+        asyncio.run(serve(arguments.host, arguments.port, arguments.workers))
+    except KeyboardInterrupt:
+        pass
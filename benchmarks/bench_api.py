@@ -0,0 +1,49 @@
+"""
+Throughput of OMDb lookups against a local stub server.
+Compares one request per title with the bulk fetch, cold and warm cache.
+
+Run from the project root:
+    python -m benchmarks.bench_api [--titles 500] [--latency 0.02]
+"""
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+from benchmarks.omdb_stub import running_stub_server
+from storage import api_cache
+from storage import api_data_handling as api
+from storage.database import create_database_engine
+
+
+def titles_per_second(function, titles):
+    start = time.perf_counter()
+    function(titles)
+    return len(titles) / (time.perf_counter() - start)
+
+
+def run(title_count, latency):
+    titles = [f"Benchmark Movie {number}" for number in range(title_count)]
+    with tempfile.TemporaryDirectory() as temp_dir, running_stub_server(latency) as url:
+        api.REQUEST_GET_URL = f"{url}?apikey=benchmark&"
+        api_cache.cache_database.set_engine(create_database_engine(f"sqlite:///{Path(temp_dir) / 'cache.db'}"))
+
+        def one_by_one(titles):
+            for title in titles:
+                api.get_movie_by_title(title)
+
+        results = {"sequential, cold cache": titles_per_second(one_by_one, titles),
+                   "sequential, warm cache": titles_per_second(one_by_one, titles)}
+        api_cache.clear()
+        results["bulk, cold cache"] = titles_per_second(api.get_movies_by_titles, titles)
+        results["bulk, warm cache"] = titles_per_second(api.get_movies_by_titles, titles)
+    for name, throughput in results.items():
+        print(f"{name:<24} {throughput:10.1f} titles/s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--titles", type=int, default=500)
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds the stub waits per request")
+    arguments = parser.parse_args()
+    run(arguments.titles, arguments.latency)
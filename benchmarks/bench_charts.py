@@ -0,0 +1,97 @@
+"""
+Chart rendering: charts per second and resident memory over many
+consecutive renders, with explicit Agg figures compared with the former
+pyplot code, and batch rendering of all users in a process pool.
+
+Run from the project root:
+    python -m benchmarks.bench_charts [--renders 1000] [--users 40]
+"""
+import argparse
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+import charts
+
+
+def resident_mib():
+    """ Current resident set size of this process """
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * 4096 / 2 ** 20
+
+
+def make_data(movies, rng):
+    years = rng.integers(1920, 2025, movies).astype(np.float64)
+    ratings = np.round(rng.uniform(1, 10, movies), 1)
+    ratings[rng.random(movies) < 0.05] = np.nan
+    return years, ratings
+
+
+def pyplot_histogram(histogram, file_path):
+    """ The former create_histogram_from_dict: global pyplot figure, never cleared or closed """
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    plt.bar(list(histogram.keys()), list(histogram.values()), align="center")
+    plt.title('Ratings of current movies')
+    plt.xlabel("Rating (1-10)")
+    plt.ylabel("Movies with the same rating")
+    plt.savefig(file_path)
+
+
+def consecutive_renders(name, render, renders):
+    start_memory = resident_mib()
+    start = time.perf_counter()
+    checkpoints = []
+    for number in range(1, renders + 1):
+        render(number)
+        if number % (renders // 4) == 0:
+            checkpoints.append(f"{resident_mib() - start_memory:+7.1f}")
+    seconds = time.perf_counter() - start
+    print(f"{name:<22} {renders / seconds:8.1f} charts/s | RSS growth after each quarter (MiB): "
+          f"{' '.join(checkpoints)}")
+
+
+def run(renders, users):
+    rng = np.random.default_rng(1)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        file_path = Path(temp_dir) / "chart.png"
+        years, ratings = make_data(500, rng)
+        chart = charts.build_charts(years, ratings)["ratings"]
+        rated = ratings[~np.isnan(ratings)]
+        values, counts = np.unique(rated, return_counts=True)
+        histogram = dict(zip(values.tolist(), counts.tolist()))
+
+        # The first render imports matplotlib, which is not what is measured
+        charts.save_chart(chart, file_path)
+        consecutive_renders("Agg figure per chart", lambda _: charts.save_chart(chart, file_path), renders)
+        # Every pyplot call adds another set of bars to the same figure, it gets slower with each call
+        consecutive_renders("pyplot, former code", lambda _: pyplot_histogram(histogram, file_path),
+                            max(4, renders // 20))
+
+        start = time.perf_counter()
+        binned = [charts.build_charts(*make_data(2000, rng)) for _ in range(users)]
+        print(f"binning {users} users x 2000 movies  {(time.perf_counter() - start) * 1000:8.1f} ms")
+        for workers in (1, None):
+            output_path = Path(temp_dir) / f"charts_{workers}"
+            start = time.perf_counter()
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                drawn = sum(result[1] for result in executor.map(
+                    charts._render_missing, range(users), binned, [output_path] * users))
+            seconds = time.perf_counter() - start
+            print(f"pool of {workers or 'all'} processes   {drawn / seconds:8.1f} charts/s ({drawn} charts)")
+        start = time.perf_counter()
+        cached = sum(charts.chart_file(user_id, chart, output_path).exists()
+                     for user_id, user_charts in enumerate(binned) for chart in user_charts.values())
+        print(f"cache check of {cached} charts   {(time.perf_counter() - start) * 1000:8.1f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--renders", type=int, default=1000)
+    parser.add_argument("--users", type=int, default=40)
+    arguments = parser.parse_args()
+    run(arguments.renders, arguments.users)
@@ -0,0 +1,103 @@
+"""
+Rows per second of exporting and importing all collections as Parquet, Arrow or CSV
+compared with the SQL path of the app: list_all_movies() to read every movie
+and add_movies() per user to write them. Every export is imported into a new
+database and compared with the original, a difference exits with 1.
+Parquet and Arrow are skipped without pyarrow.
+
+Run from the project root:
+    python -m benchmarks.bench_columnar [--users 50] [--movies 2000]
+"""
+import argparse
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from sqlalchemy import text
+
+from benchmarks import dataset
+from storage import columnar, database, schema
+from storage import movie_storage_sql as storage
+
+
+def new_engine(file_path):
+    engine = database.create_database_engine(f"sqlite:///{file_path}")
+    schema.migrate(engine)
+    return engine
+
+
+def sql_path(source, target):
+    """ Returns: (export seconds, import seconds) through the storage functions """
+    database.set_engine(source)
+    start = time.perf_counter()
+    movies_by_user = storage.list_all_movies()
+    export_seconds = time.perf_counter() - start
+    database.set_engine(target)
+    with target.begin() as connection:
+        connection.execute(text("INSERT INTO users (user_id, user_name) VALUES (:user_id, :user_name)"),
+                           [{"user_id": user_id, "user_name": f"User {user_id}"} for user_id in movies_by_user])
+    start = time.perf_counter()
+    with storage.UnitOfWork() as work:
+        for user_id, movies in movies_by_user.items():
+            work.add_movies(user_id, movies)
+    return export_seconds, time.perf_counter() - start
+
+
+def columnar_path(source, target, file_format, output_path):
+    """ Returns: (export seconds, import seconds, bytes of the files) """
+    database.set_engine(source)
+    start = time.perf_counter()
+    exported = columnar.export_tables(output_path, file_format)
+    export_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    columnar.import_tables(output_path, engine=target)
+    import_seconds = time.perf_counter() - start
+    return export_seconds, import_seconds, sum(file_path.stat().st_size for file_path, _ in exported.values())
+
+
+def run(users, movies_per_user, seed):
+    formats = ["parquet", "arrow", "csv"] if columnar.has_pyarrow() else ["csv"]
+    if not columnar.has_pyarrow():
+        print("pyarrow is not installed, only CSV is measured")
+    else:
+        # Loaded once here, so the first format doesn't pay for the import
+        import pyarrow.parquet
+    failed = False
+    with tempfile.TemporaryDirectory() as temp_dir:
+        temp_path = Path(temp_dir)
+        source = new_engine(temp_path / "source.db")
+        rows = dataset.fill_database(source, users, movies_per_user, seed)
+        source_fingerprint = dataset.fingerprint(source)
+        print(f"{users} users with {rows} movies, database {(temp_path / 'source.db').stat().st_size / 2 ** 20:.1f} MiB")
+
+        export_seconds, import_seconds = sql_path(source, new_engine(temp_path / "sql.db"))
+        print(f"{'sql':<8} export {rows / export_seconds:10.0f} rows/s | import {rows / import_seconds:10.0f} rows/s")
+        for file_format in formats:
+            target = new_engine(temp_path / f"{file_format}.db")
+            export_seconds, import_seconds, size = columnar_path(source, target, file_format,
+                                                                 temp_path / file_format)
+            same = dataset.fingerprint(target) == source_fingerprint
+            failed = failed or not same
+            print(f"{file_format:<8} export {rows / export_seconds:10.0f} rows/s | "
+                  f"import {rows / import_seconds:10.0f} rows/s | {size / 2 ** 20:6.1f} MiB | "
+                  f"round trip {'identical' if same else 'DIFFERENT'}")
+            target.dispose()
+        if "arrow" in formats:
+            import numpy as np
+            start = time.perf_counter()
+            ratings = columnar.load_table(temp_path / "arrow" / "movies.arrow").column("rating").to_numpy()
+            mean = np.nanmean(ratings)
+            print(f"Memory-mapped Arrow: mean rating {mean:.3f} of {len(ratings)} movies in "
+                  f"{(time.perf_counter() - start) * 1000:.1f} ms")
+        source.dispose()
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--movies", type=int, default=2000, help="movies per user")
+    parser.add_argument("--seed", type=int, default=1)
+    arguments = parser.parse_args()
+    sys.exit(run(arguments.users, arguments.movies, arguments.seed))
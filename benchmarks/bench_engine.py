@@ -0,0 +1,54 @@
+"""
+Single-row writes and point reads with SQLite's default settings
+compared with the tuned engine of storage.database.
+
+Run from the project root:
+    python -m benchmarks.bench_engine [--rows 2000]
+"""
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+from sqlalchemy import text
+
+from storage import schema
+from storage.database import create_database_engine, get_pragmas
+
+
+def run_operations(engine, rows):
+    """ Return (writes per second, reads per second) """
+    with engine.begin() as connection:
+        connection.execute(text("INSERT INTO users (user_id, user_name) VALUES (1, 'Benchmark')"))
+    start = time.perf_counter()
+    for number in range(rows):
+        # Like movie_storage_sql.add_movie: one connection and commit per row
+        with engine.connect() as connection:
+            connection.execute(text("INSERT INTO movies (user_id, title, year, rating) VALUES (1, :title, 2000, 5.0)"),
+                               {"title": f"Movie {number}"})
+            connection.commit()
+    writes = rows / (time.perf_counter() - start)
+    start = time.perf_counter()
+    for number in range(rows):
+        with engine.connect() as connection:
+            connection.execute(text("SELECT year, rating FROM movies WHERE user_id = 1 AND title = :title"),
+                               {"title": f"Movie {number}"}).fetchall()
+    reads = rows / (time.perf_counter() - start)
+    return writes, reads
+
+
+def run(rows):
+    print(f"Tuned pragmas: {get_pragmas()}")
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for tuned in (False, True):
+            engine = create_database_engine(f"sqlite:///{Path(temp_dir) / f'tuned_{tuned}.db'}", tuned=tuned)
+            schema.migrate(engine)
+            writes, reads = run_operations(engine, rows)
+            engine.dispose()
+            print(f"{'tuned' if tuned else 'default':<8} {writes:10.1f} writes/s | {reads:10.1f} reads/s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rows", type=int, default=2000)
+    run(parser.parse_args().rows)
@@ -0,0 +1,55 @@
+"""
+Cold start of movies.py, measured with python -X importtime.
+Fails, if importing takes longer than the budget or loads a library,
+which should only be imported on first use.
+
+Run from the project root:
+    python -m benchmarks.bench_import_time [--budget-ms 400] [--runs 5]
+"""
+import argparse
+import subprocess
+import sys
+
+# Only needed by the histogram, the search and adding movies
+LAZY_MODULES = ["matplotlib", "rapidfuzz", "requests", "urllib3", "dotenv", "numpy", "pygments"]
+
+
+def measure_import(module="movies"):
+    """
+    Import a module in a fresh interpreter.
+    Returns: (total microseconds, {top level module: microseconds}, loaded lazy modules)
+    """
+    check = f"import sys, {module}; print(','.join(m for m in {LAZY_MODULES!r} if m in sys.modules))"
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", check],
+                            capture_output=True, text=True, check=True)
+    top_level = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # Nested imports are indented below the module importing them
+        if not name.startswith("  "):
+            top_level[name.strip()] = int(cumulative)
+    loaded = [name for name in result.stdout.strip().split(",") if name]
+    return top_level.get(module, 0), top_level, loaded
+
+
+def run(budget_ms, runs):
+    timings = []
+    for _ in range(runs):
+        total, _, loaded = measure_import()
+        timings.append(total)
+    best_ms = min(timings) / 1000
+    print(f"import movies: best {best_ms:.1f} ms of {runs} runs (budget {budget_ms} ms)")
+    if loaded:
+        sys.exit(f"Loaded at startup, but should be lazy: {', '.join(loaded)}")
+    if best_ms > budget_ms:
+        sys.exit(f"Startup budget exceeded by {best_ms - budget_ms:.1f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--budget-ms", type=float, default=400)
+    parser.add_argument("--runs", type=int, default=5)
+    arguments = parser.parse_args()
+    run(arguments.budget_ms, arguments.runs)
@@ -0,0 +1,63 @@
+"""
+Cost of the always-on metrics: point reads through an instrumented
+and a plain engine, and calls of a function with and without @metrics.timed.
+
+Run from the project root:
+    python -m benchmarks.bench_metrics [--rows 5000]
+"""
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+from sqlalchemy import text
+
+from storage import metrics, schema
+from storage.database import create_database_engine
+
+
+def point_reads(engine, rows):
+    """ Return the microseconds per read """
+    with engine.begin() as connection:
+        connection.execute(text("INSERT INTO users (user_id, user_name) VALUES (1, 'Benchmark')"))
+        connection.execute(text("INSERT INTO movies (user_id, title, year, rating) VALUES (1, :title, 2000, 5.0)"),
+                           [{"title": f"Movie {number}"} for number in range(rows)])
+    start = time.perf_counter()
+    with engine.connect() as connection:
+        for number in range(rows):
+            connection.execute(text("SELECT year, rating FROM movies WHERE user_id = 1 AND title = :title"),
+                               {"title": f"Movie {number}"}).fetchall()
+    return (time.perf_counter() - start) / rows * 1e6
+
+
+def function_calls(function, calls):
+    """ Return the microseconds per call """
+    start = time.perf_counter()
+    for number in range(calls):
+        function(number)
+    return (time.perf_counter() - start) / calls * 1e6
+
+
+def run(rows):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for instrumented in (False, True):
+            engine = create_database_engine(f"sqlite:///{Path(temp_dir) / f'metrics_{instrumented}.db'}",
+                                            instrumented=instrumented)
+            schema.migrate(engine)
+            print(f"point read, {'instrumented' if instrumented else 'plain':<13} {point_reads(engine, rows):8.2f} µs")
+            engine.dispose()
+
+    def plain(number):
+        return number
+    calls = rows * 20
+    print(f"function call, plain         {function_calls(plain, calls):8.2f} µs")
+    print(f"function call, timed         {function_calls(metrics.timed()(plain), calls):8.2f} µs")
+    query_count = sum(histogram["count"] for histogram in metrics.snapshot()["histograms"]
+                      if histogram["name"] == metrics.PREFIX + "query_seconds")
+    print(f"{query_count} statements recorded")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rows", type=int, default=5000)
+    run(parser.parse_args().rows)
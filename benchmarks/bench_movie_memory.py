@@ -0,0 +1,51 @@
+"""
+Memory of a cached collection as {title: record}, comparing the former
+per-movie dicts, a namedtuple and the __slots__ Movie.
+The field values are created before measuring, so only the records
+and the title dict are counted.
+
+Run from the project root:
+    python -m benchmarks.bench_movie_memory [--movies 1000000]
+"""
+import argparse
+import time
+import tracemalloc
+from collections import namedtuple
+
+from storage.movie import Movie
+
+MovieTuple = namedtuple("MovieTuple", ["title", "year", "rating", "poster_url", "comment"])
+
+VARIANTS = {
+    "dict per movie": lambda rows: {title: {"year": year, "rating": rating, "poster_url": poster_url,
+                                            "comment": comment}
+                                    for title, year, rating, poster_url, comment in rows},
+    "namedtuple": lambda rows: {row[0]: MovieTuple(*row) for row in rows},
+    "__slots__ Movie": lambda rows: {row[0]: Movie(*row) for row in rows},
+}
+
+
+def make_rows(count):
+    return [(f"Movie {number}", 1950 + number % 75, round(1 + number % 90 / 10, 1),
+             f"https://example.invalid/{number}.jpg", f"Comment {number}")
+            for number in range(count)]
+
+
+def run(movie_count):
+    rows = make_rows(movie_count)
+    for name, build in VARIANTS.items():
+        tracemalloc.start()
+        start = time.perf_counter()
+        movies = build(rows)
+        seconds = time.perf_counter() - start
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        print(f"{name:<16} {size / 1024 ** 2:9.1f} MiB | {size / len(movies):6.1f} bytes per movie"
+              f" | built in {seconds:6.3f} s")
+        del movies
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--movies", type=int, default=1_000_000)
+    run(parser.parse_args().movies)
@@ -0,0 +1,139 @@
+"""
+Poster cache against the local stub server: download throughput with
+concurrent workers, warm lookups, thumbnail size and eviction under a size cap.
+Checks, that equal images are stored once, stored posters aren't downloaded again,
+eviction keeps to the cap and spares the posters in use and that pages fall back
+to the original without thumbnails, a failed check exits with 1.
+
+Run from the project root:
+    python -m benchmarks.bench_posters [--posters 300] [--latency 0.02]
+"""
+import argparse
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from sqlalchemy import text
+
+from benchmarks.omdb_stub import fake_poster, running_stub_server
+from storage import database, poster_cache, schema
+from storage.database import create_database_engine
+
+
+def timed(name, function, count=None):
+    start = time.perf_counter()
+    result = function()
+    seconds = time.perf_counter() - start
+    rate = f" | {count / seconds:8.1f} posters/s" if count else ""
+    print(f"{name:<28} {seconds:8.3f} s{rate}")
+    return result
+
+
+def check(name, passed, detail=""):
+    """ Print the outcome of a check. Returns: passed """
+    print(f"{'ok' if passed else 'FAILED':<6} {name}{f' ({detail})' if detail else ''}")
+    return passed
+
+
+def save_movies_with_posters(urls):
+    """ Save a movie for every url, like a user who added them """
+    with database.get_engine().begin() as connection:
+        connection.execute(text("INSERT OR IGNORE INTO users (user_id, user_name) VALUES (1, 'Benchmark')"))
+        connection.execute(text("INSERT INTO movies (user_id, title, poster_url, comment) "
+                                "VALUES (1, :title, :poster_url, '')"),
+                           [{"title": f"Movie {number}", "poster_url": url} for number, url in enumerate(urls)])
+
+
+def check_deduplication(url, poster_path):
+    """ Returns: True if a second url of a stored image shares its files and adds no size """
+    size = poster_cache.cache_size()
+    posters = poster_cache.cache_posters([f"{url}posters/1.png", f"{url}posters/1.png?copy=1"], poster_path)
+    first, second = posters.values()
+    added_size = poster_cache.cache_size() - size
+    return check("equal images stored once", first == second and added_size == 0,
+                 f"{added_size} bytes added")
+
+
+def check_no_download(urls, poster_path):
+    """ Returns: True if a second cache_posters of the same urls downloads nothing """
+    downloaded = []
+    download_poster = poster_cache.download_poster
+    poster_cache.download_poster = lambda url, path: downloaded.append(url) or download_poster(url, path)
+    try:
+        posters = poster_cache.cache_posters(urls, poster_path)
+    finally:
+        poster_cache.download_poster = download_poster
+    return check("stored posters not downloaded again", not downloaded and len(posters) == len(urls),
+                 f"{len(downloaded)} downloads")
+
+
+def check_eviction(urls, poster_path):
+    """
+    Evict to half the size, while a saved movie links some posters and keep names others,
+    both used least recently.
+    Returns: True if the cache fits the cap and every used poster is still there
+    """
+    count = len(urls) // 10
+    saved_urls, kept_urls = urls[:count], urls[count:2 * count]
+    save_movies_with_posters(saved_urls)
+    # The stub repeats its images after 256 posters, only the others are touched
+    poster_cache.lookup(urls[2 * count:256], poster_path)
+    cap = poster_cache.cache_size() // 2
+    evicted = timed("evict to half the size", lambda: poster_cache.evict(cap, keep=kept_urls,
+                                                                         poster_path=poster_path))
+    size = poster_cache.cache_size()
+    print(f"evicted {evicted} posters, {size / 1024:.1f} KiB left (cap {cap / 1024:.1f} KiB)")
+    left = poster_cache.lookup(saved_urls + kept_urls, poster_path)
+    return (check("eviction keeps to the cap", evicted > 0 and size <= cap, f"{size} of {cap} bytes")
+            & check("eviction spares posters in use", len(left) == len(saved_urls + kept_urls),
+                    f"{len(left)} of {len(saved_urls + kept_urls)} left"))
+
+
+def check_without_pillow(poster_path):
+    """ Returns: True if an image, which make_thumbnail can't shrink, is its own thumbnail """
+    make_thumbnail = poster_cache.make_thumbnail
+    poster_cache.make_thumbnail = lambda content: None
+    try:
+        # A size the stub never serves, so no thumbnail of it is stored yet
+        row = poster_cache.store_poster(fake_poster(1, width=301), ".png", poster_path)
+    finally:
+        poster_cache.make_thumbnail = make_thumbnail
+    return check("original shown without thumbnail", row["thumbnail_name"] == row["image_name"],
+                 row["thumbnail_name"])
+
+
+def run(poster_count, latency):
+    passed = True
+    with tempfile.TemporaryDirectory() as temp_dir, running_stub_server(latency) as url:
+        poster_path = Path(temp_dir) / "posters"
+        poster_cache.cache_database.set_engine(create_database_engine(f"sqlite:///{Path(temp_dir) / 'poster_cache.db'}"))
+        engine = create_database_engine(f"sqlite:///{Path(temp_dir) / 'movies.db'}")
+        schema.migrate(engine)
+        database.set_engine(engine)
+        urls = [f"{url}posters/{number}.png" for number in range(poster_count)]
+
+        sequential_urls = urls[:poster_count // 4]
+        timed("sequential download", lambda: poster_cache.cache_posters(sequential_urls, poster_path,
+                                                                        max_in_flight=1), len(sequential_urls))
+        poster_cache.clear(poster_path)
+        posters = timed("concurrent download", lambda: poster_cache.cache_posters(urls, poster_path), len(urls))
+        timed("warm lookup", lambda: poster_cache.cache_posters(urls, poster_path), len(urls))
+
+        image_size = sum(poster.image.stat().st_size for poster in posters.values())
+        thumbnail_size = sum(poster.thumbnail.stat().st_size for poster in posters.values())
+        print(f"{len(posters)} posters: originals {image_size / 1024:.1f} KiB, thumbnails {thumbnail_size / 1024:.1f} KiB")
+
+        passed &= check_no_download(urls, poster_path)
+        passed &= check_deduplication(url, poster_path)
+        passed &= check_eviction(urls, poster_path)
+        passed &= check_without_pillow(poster_path)
+    return 0 if passed else 1
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--posters", type=int, default=300)
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds the stub server waits per request")
+    arguments = parser.parse_args()
+    sys.exit(run(arguments.posters, arguments.latency))
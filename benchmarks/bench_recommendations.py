@@ -0,0 +1,71 @@
+"""
+Build time of the recommendation model and latency per request
+with generated collections, popular titles shared by many users.
+
+Run from the project root:
+    python -m benchmarks.bench_recommendations [--users 10000] [--titles 100000] [--movies 100]
+"""
+import argparse
+import random
+import time
+
+import numpy as np
+
+from storage.recommendations import RecommendationModel
+
+
+def make_collections(users, titles, movies_per_user, seed=1):
+    """ Columns (user_ids, titles, years, ratings), title popularity falls off like 1 / rank """
+    rng = np.random.default_rng(seed)
+    popularity = 1.0 / (np.arange(titles) + 10.0)
+    popularity /= popularity.sum()
+    user_ids, user_titles = [], []
+    for user_id in range(users):
+        chosen = np.unique(rng.choice(titles, size=movies_per_user, p=popularity))
+        user_ids.extend([user_id] * len(chosen))
+        user_titles.extend(chosen.tolist())
+    ratings = np.round(rng.uniform(1, 10, len(user_titles)), 1).tolist()
+    years = [1950 + title % 75 for title in user_titles]
+    return user_ids, [f"Movie {title}" for title in user_titles], years, ratings
+
+
+def percentiles(seconds):
+    seconds = sorted(seconds)
+    return (f"p50 {seconds[len(seconds) // 2] * 1000:7.3f} ms"
+            f" | p99 {seconds[min(len(seconds) - 1, int(len(seconds) * 0.99))] * 1000:7.3f} ms")
+
+
+def timed_requests(function, user_ids):
+    seconds = []
+    for user_id in user_ids:
+        start = time.perf_counter()
+        function(user_id)
+        seconds.append(time.perf_counter() - start)
+    return seconds
+
+
+def run(users, titles, movies_per_user, requests):
+    columns = make_collections(users, titles, movies_per_user)
+    print(f"{len(columns[0])} saved movies of {users} users, {len(set(columns[1]))} different titles")
+    start = time.perf_counter()
+    model = RecommendationModel(*columns)
+    print(f"model built in {time.perf_counter() - start:.3f} s")
+
+    random.seed(1)
+    user_ids = [random.randrange(users) for _ in range(requests)]
+    print(f"recommend, cold       {percentiles(timed_requests(model.recommend, user_ids))}")
+    print(f"recommend, cached     {percentiles(timed_requests(model.recommend, user_ids))}")
+    model = RecommendationModel(*columns)
+    print(f"pick, first of user   {percentiles(timed_requests(model.sampler, user_ids))}")
+    pick = lambda user_id: model.sampler(user_id)[1].sample()
+    print(f"pick, sampler cached  {percentiles(timed_requests(pick, user_ids))}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--users", type=int, default=10_000)
+    parser.add_argument("--titles", type=int, default=100_000)
+    parser.add_argument("--movies", type=int, default=100, help="movies per user")
+    parser.add_argument("--requests", type=int, default=1000)
+    arguments = parser.parse_args()
+    run(arguments.users, arguments.titles, arguments.movies, arguments.requests)
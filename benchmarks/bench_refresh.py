@@ -0,0 +1,167 @@
+"""
+Background refresh against the local stub server: throughput with and without
+rate limit, retries of failing requests and page reads while the worker runs.
+Checks, that the rate limit and the daily requests hold, that 503 and 429 answers
+are retried and that expired leases are claimed again, a failed check exits with 1.
+
+Run from the project root:
+    python -m benchmarks.bench_refresh [--movies 400] [--latency 0.02]
+"""
+import argparse
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from sqlalchemy import text
+
+from benchmarks.omdb_stub import running_stub_server
+from storage import api_cache, database, refresh_worker, schema
+from storage import api_data_handling as api
+from storage import movie_storage_sql as storage
+
+USERS = 4
+# A rate limited run may be this much faster than the limit, for timer resolution
+RATE_TOLERANCE = 1.05
+
+
+def fill_database(movie_count):
+    """ Movies without year, rating and fetched_at, a tenth of them unknown to the API """
+    with database.get_engine().begin() as connection:
+        connection.execute(text("DELETE FROM users"))
+        connection.execute(text("DELETE FROM refresh_budget"))
+        connection.execute(text("INSERT INTO users (user_id, user_name) VALUES (:user_id, :user_name)"),
+                           [{"user_id": user_id, "user_name": f"User {user_id}"} for user_id in range(1, USERS + 1)])
+        connection.execute(text("INSERT INTO movies (user_id, title, poster_url, comment) "
+                                "VALUES (:user_id, :title, 'N/A', '')"),
+                           [{"user_id": number % USERS + 1,
+                             "title": f"{'Unknown' if number % 10 == 0 else 'Movie'} {number}"}
+                            for number in range(movie_count)])
+
+
+def check_database():
+    """ Return (movies still missing a rating, open jobs), the unknown titles keep missing theirs """
+    with database.get_engine().connect() as connection:
+        missing = connection.execute(text("SELECT COUNT(*) FROM movies WHERE rating IS NULL "
+                                          "AND title NOT LIKE 'Unknown%'")).scalar()
+        jobs = connection.execute(text("SELECT COUNT(*) FROM refresh_jobs")).scalar()
+    return missing, jobs
+
+
+def check(name, passed, detail=""):
+    """ Print the outcome of a check. Returns: passed """
+    print(f"{'ok' if passed else 'FAILED':<6} {name}{f' ({detail})' if detail else ''}")
+    return passed
+
+
+def timed_refresh(name, movie_count, **options):
+    """
+    Refresh movie_count new movies without a daily limit, every movie has to be done afterwards.
+    Returns: (totals of refresh_all, seconds, passed)
+    """
+    fill_database(movie_count)
+    start = time.perf_counter()
+    totals = refresh_worker.refresh_all(daily_requests=0, **options)
+    seconds = time.perf_counter() - start
+    missing, jobs = check_database()
+    print(f"{name:<28} {seconds:8.3f} s | {totals['queued'] / seconds:8.1f} movies/s | {totals} | "
+          f"{missing} unrated, {jobs} jobs left")
+    return totals, seconds, check(f"{name}: every movie refreshed", missing == 0 and jobs == 0)
+
+
+def requests_sent(totals):
+    """ Returns: number of OMDb requests of a refresh, one per handled job """
+    return sum(number for outcome, number in totals.items() if outcome != "queued")
+
+
+def page_reads_while_refreshing(movie_count, reads=200):
+    """ Latency of the reads of the menu, while the worker thread refreshes every movie """
+    fill_database(movie_count)
+    worker = refresh_worker.RefreshWorker(rate=0, idle_seconds=0.05, daily_requests=0)
+    worker.start()
+    seconds = []
+    for number in range(reads):
+        start = time.perf_counter()
+        storage.list_movies_page(number % USERS + 1, limit=50)
+        seconds.append(time.perf_counter() - start)
+    worker.stop()
+    seconds.sort()
+    print(f"{'page reads while refreshing':<28} p50 {seconds[len(seconds) // 2] * 1000:7.3f} ms"
+          f" | p99 {seconds[int(len(seconds) * 0.99)] * 1000:7.3f} ms")
+
+
+def check_daily_requests(movie_count, daily_requests):
+    """
+    Two foreground refreshes and a worker share one daily limit,
+    the requests of the first refresh count for the others.
+    Returns: True if no more than daily_requests movies were fetched
+    """
+    fill_database(movie_count)
+    first = refresh_worker.refresh_all(rate=0, daily_requests=daily_requests)
+    second = refresh_worker.refresh_all(rate=0, daily_requests=daily_requests)
+    worker = refresh_worker.RefreshWorker(rate=0, idle_seconds=0.05, daily_requests=daily_requests)
+    worker.start()
+    time.sleep(0.5)
+    worker.stop()
+    with database.get_engine().connect() as connection:
+        fetched = connection.execute(text("SELECT COUNT(*) FROM movies WHERE fetched_at IS NOT NULL")).scalar()
+        counted = connection.execute(text("SELECT SUM(requests) FROM refresh_budget")).scalar()
+    return check(f"at most {daily_requests} requests per day", requests_sent(first) == daily_requests
+                 and requests_sent(second) == 0 and fetched == counted == daily_requests,
+                 f"{requests_sent(first)} + {requests_sent(second)} requests, worker after them "
+                 f"{fetched - requests_sent(first)}, {counted} counted")
+
+
+def check_expired_lease(movie_count):
+    """ Returns: True if claimed jobs are held for LEASE_SECONDS and given out again afterwards """
+    fill_database(movie_count)
+    now = time.time()
+    refresh_worker.enqueue_stale(now=now)
+    claimed = refresh_worker.claim_jobs(movie_count, now=now, daily_requests=0)
+    held = refresh_worker.claim_jobs(movie_count, now=now + refresh_worker.LEASE_SECONDS - 1, daily_requests=0)
+    reclaimed = refresh_worker.claim_jobs(movie_count, now=now + refresh_worker.LEASE_SECONDS, daily_requests=0)
+    return check("expired lease claimed again", len(claimed) == movie_count and not held
+                 and sorted(reclaimed) == sorted(claimed),
+                 f"{len(claimed)} claimed, {len(held)} during the lease, {len(reclaimed)} after it")
+
+
+def run(movie_count, latency):
+    passed = True
+    with tempfile.TemporaryDirectory() as temp_dir:
+        engine = database.create_database_engine(f"sqlite:///{Path(temp_dir) / 'movies.db'}")
+        schema.migrate(engine)
+        database.set_engine(engine)
+        api_cache.cache_database.set_engine(database.create_database_engine(f"sqlite:///{Path(temp_dir) / 'cache.db'}"))
+        # Retried right away instead of after a minute
+        refresh_worker.BACKOFF_BASE = 0.0
+
+        with running_stub_server(latency) as url:
+            api.REQUEST_GET_URL = f"{url}?apikey=benchmark&"
+            passed &= timed_refresh("unlimited, 1 in flight", movie_count, rate=0, max_in_flight=1)[2]
+            passed &= timed_refresh("unlimited, 4 in flight", movie_count, rate=0, max_in_flight=4)[2]
+            rate = 50
+            totals, seconds, refreshed = timed_refresh(f"limited to {rate} requests/s", movie_count // 4,
+                                                       rate=rate, max_in_flight=4)
+            # The first request is sent right away
+            measured_rate = (requests_sent(totals) - 1) / seconds
+            passed &= refreshed & check("rate limit holds", measured_rate <= rate * RATE_TOLERANCE,
+                                        f"{measured_rate:.1f} requests/s")
+            page_reads_while_refreshing(movie_count)
+            passed &= check_daily_requests(movie_count, movie_count // 4)
+            passed &= check_expired_lease(movie_count)
+        for status in (503, 429):
+            with running_stub_server(latency, fail_every=5, fail_status=status) as url:
+                api.REQUEST_GET_URL = f"{url}?apikey=benchmark&"
+                totals, _, refreshed = timed_refresh(f"every 5th request {status}", movie_count,
+                                                     rate=0, max_in_flight=4)
+                passed &= refreshed & check(f"{status} answers retried", totals["retried"] > 0
+                                            and totals["given_up"] == 0, f"{totals['retried']} retries")
+    return 0 if passed else 1
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--movies", type=int, default=400)
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds the stub waits per request")
+    arguments = parser.parse_args()
+    sys.exit(run(arguments.movies, arguments.latency))
@@ -0,0 +1,69 @@
+"""
+Fuzzy search latency: linear partial_ratio scan against the n-gram TitleIndex.
+A title the linear scan finds, but the index misses, exits with 1.
+
+Run from the project root:
+    python -m benchmarks.bench_search [--sizes 10000 100000 1000000]
+"""
+import argparse
+import random
+import string
+import sys
+import time
+
+from rapidfuzz.fuzz import partial_ratio
+
+from storage.search_index import TitleIndex, SCORE_CUTOFF
+
+QUERIES = 20
+
+
+def make_titles(count):
+    """ Titles out of three made-up words each """
+    words = ["".join(random.choices(string.ascii_lowercase, k=random.randint(3, 9))) for _ in range(5000)]
+    return list({" ".join(random.choices(words, k=3)).title() for _ in range(count)})
+
+
+def make_queries(titles):
+    """ Parts of existing titles with a typo """
+    queries = []
+    for title in random.sample(titles, QUERIES):
+        query = list(title[:random.randint(8, len(title))])
+        query[random.randrange(len(query))] = random.choice(string.ascii_lowercase)
+        queries.append("".join(query))
+    return queries
+
+
+def linear_search(titles, query):
+    return [title for title in titles if partial_ratio(query.lower(), title.lower()) >= SCORE_CUTOFF]
+
+
+def run(sizes):
+    random.seed(1)
+    missed = 0
+    for size in sizes:
+        titles = make_titles(size)
+        queries = make_queries(titles)
+        start = time.perf_counter()
+        index = TitleIndex(titles)
+        build_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        linear_results = [linear_search(titles, query) for query in queries]
+        linear_time = (time.perf_counter() - start) / QUERIES
+        start = time.perf_counter()
+        index_results = [index.search(query) for query in queries]
+        index_time = (time.perf_counter() - start) / QUERIES
+        size_missed = sum(len(set(linear_titles) - {title for title, _ in index_titles})
+                          for linear_titles, index_titles in zip(linear_results, index_results))
+        missed += size_missed
+        print(f"{len(titles):>8} titles | linear: {linear_time * 1000:9.2f} ms/query"
+              f" | index: {index_time * 1000:8.2f} ms/query | index build: {build_time:6.2f} s"
+              f" | {size_missed} matches missed")
+    return 1 if missed else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    sys.exit(run(parser.parse_args().sizes))
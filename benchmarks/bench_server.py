@@ -0,0 +1,106 @@
+"""
+Load test of api_server.py against a local instance with generated data.
+Reports requests per second and p50/p99 latency per endpoint.
+
+Run from the project root:
+    python -m benchmarks.bench_server [--connections 32] [--seconds 10] [--users 20] [--movies 2000]
+"""
+import argparse
+import asyncio
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from sqlalchemy import text
+
+from storage import schema
+from storage.database import create_database_engine
+
+ENDPOINTS = {
+    "list": lambda user_id: ("GET", f"/users/{user_id}/movies?after=Movie%20{random.randrange(500)}&limit=100"),
+    "search": lambda user_id: ("GET", f"/users/{user_id}/movies/search?q=movie%20{random.randrange(1000)}"),
+    "stats": lambda user_id: ("GET", f"/users/{user_id}/stats"),
+    "update": lambda user_id: ("PATCH", f"/users/{user_id}/movies/Movie%20{random.randrange(100)}"),
+}
+
+
+def fill_database(db_file, users, movies_per_user):
+    engine = create_database_engine(f"sqlite:///{db_file}")
+    schema.migrate(engine)
+    with engine.begin() as connection:
+        connection.execute(text("INSERT INTO users (user_id, user_name) VALUES (:user_id, :user_name)"),
+                           [{"user_id": user_id, "user_name": f"User {user_id}"} for user_id in range(1, users + 1)])
+        connection.execute(text("INSERT INTO movies (user_id, title, year, rating, poster_url, comment) "
+                                "VALUES (:user_id, :title, 2000, :rating, '', '')"),
+                           [{"user_id": user_id, "title": f"Movie {number}", "rating": round(random.uniform(1, 10), 1)}
+                            for user_id in range(1, users + 1) for number in range(movies_per_user)])
+    engine.dispose()
+
+
+async def request(reader, writer, method, path):
+    """ Send one keep-alive request and read the whole response """
+    body = b'{"comment": "load test"}' if method == "PATCH" else b""
+    writer.write(f"{method} {path} HTTP/1.1\r\nHost: localhost\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body)
+    await writer.drain()
+    length = 0
+    while (line := await reader.readline()) not in (b"\r\n", b""):
+        if line.lower().startswith(b"content-length:"):
+            length = int(line.split(b":")[1])
+    await reader.readexactly(length)
+
+
+async def client(port, users, deadline, latencies, weights):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    while time.perf_counter() < deadline:
+        name = random.choices(list(ENDPOINTS), weights)[0]
+        method, path = ENDPOINTS[name](random.randint(1, users))
+        start = time.perf_counter()
+        await request(reader, writer, method, path)
+        latencies[name].append(time.perf_counter() - start)
+    writer.close()
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+async def load_test(port, connections, seconds, users, weights):
+    latencies = {name: [] for name in ENDPOINTS}
+    deadline = time.perf_counter() + seconds
+    await asyncio.gather(*(client(port, users, deadline, latencies, weights) for _ in range(connections)))
+    total = sum(len(values) for values in latencies.values())
+    print(f"{total / seconds:10.1f} requests/s with {connections} connections")
+    for name, values in latencies.items():
+        if values:
+            print(f"{name:<8} {len(values):8} requests | p50 {percentile(values, 0.5) * 1000:7.2f} ms"
+                  f" | p99 {percentile(values, 0.99) * 1000:7.2f} ms")
+
+
+def run(connections, seconds, users, movies_per_user):
+    random.seed(1)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        db_file = Path(temp_dir) / "movies.db"
+        fill_database(db_file, users, movies_per_user)
+        server = subprocess.Popen([sys.executable, "api_server.py", "--port", "0"], stdout=subprocess.PIPE, text=True,
+                                  env=dict(os.environ, MOVIES_DB_PATH=str(db_file)))
+        try:
+            port = int(server.stdout.readline().rsplit(":", 1)[1])
+            asyncio.run(load_test(port, connections, seconds, users, weights=[40, 25, 25, 10]))
+        finally:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--connections", type=int, default=32)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--movies", type=int, default=2000, help="movies per user")
+    arguments = parser.parse_args()
+    run(arguments.connections, arguments.seconds, arguments.users, arguments.movies)
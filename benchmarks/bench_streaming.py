@@ -0,0 +1,93 @@
+"""
+Peak RSS and time-to-first-row of reading one big collection,
+list_movies() into a dict compared with the keyset-paginated iter_movies().
+Filling the database and every variant run in fresh processes,
+a child inherits the peak RSS of its parent otherwise.
+
+Run from the project root:
+    python -m benchmarks.bench_streaming [--movies 500000]
+"""
+import argparse
+import json
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from sqlalchemy import text
+
+from storage import movie_storage_sql as storage
+from storage import schema
+from storage.database import create_database_engine, set_engine
+
+USER_ID = 1
+
+
+def fill_database(db_file, movie_count):
+    engine = create_database_engine(f"sqlite:///{db_file}")
+    schema.migrate(engine)
+    with engine.begin() as connection:
+        connection.execute(text("INSERT INTO users (user_id, user_name) VALUES (:user_id, 'Benchmark')"),
+                           {"user_id": USER_ID})
+        connection.execute(text("INSERT INTO movies (user_id, title, year, rating, poster_url, comment) "
+                                "VALUES (:user_id, :title, 2000, 7.5, :poster_url, :comment)"),
+                           [{"user_id": USER_ID, "title": f"Movie {number:07}",
+                             "poster_url": f"https://example.invalid/{number}.jpg", "comment": f"Comment {number}"}
+                            for number in range(movie_count)])
+    engine.dispose()
+
+
+def read_movies(variant):
+    """ Return an iterator over the movies like the terminal listing consumes them """
+    if variant == "dict":
+        return iter(storage.list_movies(USER_ID).items())
+    return storage.iter_movies(USER_ID)
+
+
+def measure(variant, db_file):
+    """ Runs in the child process, prints its results as JSON """
+    set_engine(create_database_engine(f"sqlite:///{db_file}"))
+    # Connect once, so the timing doesn't include opening the database
+    with storage.get_engine().connect():
+        pass
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    movies = read_movies(variant)
+    next(movies)
+    first_row = time.perf_counter() - start
+    count = 1 + sum(1 for _ in movies)
+    total = time.perf_counter() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({"count": count, "first_row": first_row, "total": total, "rss_growth_kib": peak - baseline}))
+
+
+def run_child(*arguments):
+    return subprocess.run([sys.executable, "-m", "benchmarks.bench_streaming", *arguments],
+                          capture_output=True, text=True, check=True).stdout
+
+
+def run(movie_count):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        db_file = Path(temp_dir) / "movies.db"
+        run_child("--fill", str(movie_count), str(db_file))
+        for variant in ("dict", "stream"):
+            output = run_child("--measure", variant, str(db_file))
+            result = json.loads(output)
+            print(f"{variant:<8} {result['count']:9} rows | first row {result['first_row'] * 1000:9.2f} ms"
+                  f" | all rows {result['total']:7.3f} s | peak RSS +{result['rss_growth_kib'] / 1024:8.1f} MiB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--movies", type=int, default=500_000)
+    parser.add_argument("--fill", nargs=2, metavar=("MOVIES", "DB_FILE"), help=argparse.SUPPRESS)
+    parser.add_argument("--measure", nargs=2, metavar=("VARIANT", "DB_FILE"), help=argparse.SUPPRESS)
+    arguments = parser.parse_args()
+    if arguments.fill:
+        fill_database(arguments.fill[1], int(arguments.fill[0]))
+    elif arguments.measure:
+        measure(*arguments.measure)
+    else:
+        run(arguments.movies)
@@ -0,0 +1,81 @@
+"""
+Rows per second of the single-row write functions of movie_storage_sql
+compared with the same writes grouped into one UnitOfWork.
+
+Run from the project root:
+    python -m benchmarks.bench_unit_of_work [--rows 2000]
+"""
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+from storage import database
+from storage import movie_storage_sql as storage
+from storage import schema, user_data_handling
+from storage.movie import Movie
+
+USER_ID = 1
+
+
+def single_rows(movies):
+    """ Returns: {operation: seconds} with one transaction per row """
+    seconds = {}
+    start = time.perf_counter()
+    for movie in movies:
+        storage.add_movie(USER_ID, movie)
+    seconds["add"] = time.perf_counter() - start
+    start = time.perf_counter()
+    for movie in movies:
+        storage.update_movie(movie.title, "updated", USER_ID)
+    seconds["update"] = time.perf_counter() - start
+    start = time.perf_counter()
+    for movie in movies:
+        storage.delete_movie(movie.title, USER_ID)
+    seconds["delete"] = time.perf_counter() - start
+    return seconds
+
+
+def batched(movies):
+    """ Returns: {operation: seconds} with one UnitOfWork per operation """
+    seconds = {}
+    start = time.perf_counter()
+    with storage.UnitOfWork() as work:
+        for movie in movies:
+            work.add_movie(USER_ID, movie)
+    seconds["add"] = time.perf_counter() - start
+    start = time.perf_counter()
+    with storage.UnitOfWork() as work:
+        for movie in movies:
+            work.update_movie(movie.title, "updated", USER_ID)
+    seconds["update"] = time.perf_counter() - start
+    start = time.perf_counter()
+    with storage.UnitOfWork() as work:
+        for movie in movies:
+            work.delete_movie(movie.title, USER_ID)
+    seconds["delete"] = time.perf_counter() - start
+    return seconds
+
+
+def run(rows):
+    movies = [Movie(f"Movie {number}", 2000, 5.0, "", "") for number in range(rows)]
+    with tempfile.TemporaryDirectory() as temp_dir:
+        engine = database.create_database_engine(f"sqlite:///{Path(temp_dir) / 'movies.db'}")
+        schema.migrate(engine)
+        database.set_engine(engine)
+        user_data_handling.insert_user("Benchmark")
+        # A loaded cache is updated by every write, like in the menu
+        storage.get_movie_cache(USER_ID)
+        results = {"single rows": single_rows(movies), "unit of work": batched(movies)}
+        engine.dispose()
+    for name, seconds in results.items():
+        print(f"{name:<13} " + " | ".join(f"{operation} {rows / elapsed:10.1f} rows/s"
+                                            for operation, elapsed in seconds.items()))
+    for operation in results["single rows"]:
+        print(f"{operation:<7} {results['single rows'][operation] / results['unit of work'][operation]:6.1f}x faster batched")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rows", type=int, default=2000)
+    run(parser.parse_args().rows)
@@ -0,0 +1,75 @@
+"""
+Per-user query latency while the total number of rows grows.
+Compares the migrated schema without and with the user_id indexes.
+
+Run from the project root:
+    python -m benchmarks.bench_user_queries [--sizes 10000 100000 500000]
+"""
+import argparse
+import random
+import tempfile
+import time
+from pathlib import Path
+
+from sqlalchemy import text
+
+from storage import movie_storage_sql as storage
+from storage import schema
+from storage.database import create_database_engine, set_engine
+
+MOVIES_PER_USER = 200
+# Indexes of the migrations 2 and 3, which let a query find the movies of one user
+USER_INDEXES = ("idx_movies_user_title", "idx_movies_user_rating")
+
+
+def fill_database(engine, total_rows):
+    """ Insert total_rows movies spread over users with MOVIES_PER_USER each """
+    with engine.begin() as connection:
+        connection.execute(text("INSERT INTO users (user_id, user_name) VALUES (:user_id, 'Benchmark')"),
+                           [{"user_id": user_id} for user_id in range(total_rows // MOVIES_PER_USER + 1)])
+    rows = [{"user_id": row // MOVIES_PER_USER, "title": f"Movie {row}", "year": 2000,
+             "rating": round(random.uniform(1, 10), 1), "poster_url": "", "comment": ""}
+            for row in range(total_rows)]
+    with engine.begin() as connection:
+        connection.execute(text("INSERT INTO movies (user_id, title, year, rating, poster_url, comment) "
+                                "VALUES (:user_id, :title, :year, :rating, :poster_url, :comment)"), rows)
+
+
+def time_user_queries(total_rows, rounds=50):
+    """ Return the average seconds of list/update/delete for a random user """
+    users = total_rows // MOVIES_PER_USER
+    start = time.perf_counter()
+    for _ in range(rounds):
+        user_id = random.randrange(users)
+        title = f"Movie {user_id * MOVIES_PER_USER + random.randrange(MOVIES_PER_USER)}"
+        storage.list_movies(user_id)
+        storage.update_movie(title, "benchmark", user_id)
+        storage.delete_movie(title, user_id)
+    return (time.perf_counter() - start) / rounds
+
+
+def run(sizes):
+    random.seed(1)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for total_rows in sizes:
+            results = {}
+            for indexed in (False, True):
+                engine = create_database_engine(f"sqlite:///{Path(temp_dir) / f'{total_rows}_{indexed}.db'}")
+                # The storage functions need the newest schema, the baseline only lacks the indexes
+                schema.migrate(engine)
+                if not indexed:
+                    with engine.begin() as connection:
+                        for index in USER_INDEXES:
+                            connection.execute(text(f"DROP INDEX {index}"))
+                fill_database(engine, total_rows)
+                set_engine(engine)
+                results[indexed] = time_user_queries(total_rows)
+                engine.dispose()
+            print(f"{total_rows:>9} rows | no index: {results[False] * 1000:8.3f} ms"
+                  f" | indexed: {results[True] * 1000:8.3f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 500_000])
+    run(parser.parse_args().sizes)
@@ -0,0 +1,131 @@
+"""
+Rating statistics from the trigger maintained aggregates compared with
+summarizing every movie of the user, as before the user_stats table.
+Also measures what the triggers cost on inserts and checks the aggregates
+after random inserts, rating updates and deletes.
+
+Run from the project root:
+    python -m benchmarks.bench_user_stats [--users 20] [--movies 50000]
+"""
+import argparse
+import random
+import tempfile
+import time
+from itertools import groupby
+from pathlib import Path
+
+from sqlalchemy import text
+
+from storage import database, movie_stats, schema
+
+
+def full_scan_stats(user_id):
+    """ The former path: read all ratings of the user and summarize them in Python """
+    with database.get_engine().connect() as connection:
+        rows = connection.execute(text("SELECT title, year, rating FROM movies "
+                                       "WHERE user_id = :user_id ORDER BY rating DESC"),
+                                  {"user_id": user_id}).fetchall()
+    ratings = [rating for _, _, rating in rows if rating is not None]
+    count = len(ratings)
+    average = sum(ratings) / count
+    median = (ratings[(count - 1) // 2] + ratings[count // 2]) / 2
+    best_movies = [row for row in rows if row[2] == ratings[0]]
+    worst_movies = [row for row in rows if row[2] == ratings[-1]]
+    histogram = {rating: len(list(group)) for rating, group in groupby(reversed(ratings))}
+    return count, average, median, best_movies, worst_movies, histogram
+
+
+def make_rows(users, movies_per_user, rng, first_number=0):
+    return [{"user_id": user_id, "title": f"Movie {number}", "year": 1950 + number % 75,
+             "rating": None if rng.random() < 0.05 else round(rng.uniform(1, 10), 1)}
+            for user_id in range(1, users + 1)
+            for number in range(first_number, first_number + movies_per_user)]
+
+
+def insert_rows(engine, rows):
+    """ Return the rows per second of one bulk insert """
+    start = time.perf_counter()
+    with engine.begin() as connection:
+        connection.execute(text("INSERT INTO movies (user_id, title, year, rating, poster_url, comment) "
+                                "VALUES (:user_id, :title, :year, :rating, '', '')"), rows)
+    return len(rows) / (time.perf_counter() - start)
+
+
+def timed_calls(function, user_ids):
+    start = time.perf_counter()
+    for user_id in user_ids:
+        function(user_id)
+    return (time.perf_counter() - start) / len(user_ids) * 1000
+
+
+def random_writes(engine, users, movies_per_user, rng, operations=2000):
+    """ Insert, re-rate and delete single movies like the app and the refresh worker do """
+    with engine.begin() as connection:
+        for number in range(operations):
+            user_id = rng.randint(1, users)
+            title = f"Movie {rng.randrange(movies_per_user + 100)}"
+            kind = rng.choice(("insert", "update", "delete"))
+            if kind == "insert":
+                connection.execute(text("INSERT OR IGNORE INTO movies (user_id, title, year, rating, poster_url, comment) "
+                                        "VALUES (:user_id, :title, 2000, :rating, '', '')"),
+                                   {"user_id": user_id, "title": title, "rating": round(rng.uniform(1, 10), 1)})
+            elif kind == "update":
+                rating = None if rng.random() < 0.1 else round(rng.uniform(1, 10), 1)
+                connection.execute(text("UPDATE movies SET rating = :rating WHERE user_id = :user_id AND title = :title"),
+                                   {"user_id": user_id, "title": title, "rating": rating})
+            else:
+                connection.execute(text("DELETE FROM movies WHERE user_id = :user_id AND title = :title"),
+                                   {"user_id": user_id, "title": title})
+
+
+def run(users, movies_per_user):
+    rng = random.Random(1)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        plain = database.create_database_engine(f"sqlite:///{Path(temp_dir) / 'plain.db'}")
+        schema.migrate(plain)
+        with plain.begin() as connection:
+            for trigger in ("movies_stats_insert", "movies_stats_delete", "movies_stats_update"):
+                connection.execute(text(f"DROP TRIGGER {trigger}"))
+        engine = database.create_database_engine(f"sqlite:///{Path(temp_dir) / 'movies.db'}")
+        schema.migrate(engine)
+        for connected in (plain, engine):
+            with connected.begin() as connection:
+                connection.execute(text("INSERT INTO users (user_id, user_name) VALUES (:user_id, 'Benchmark')"),
+                                   [{"user_id": user_id} for user_id in range(1, users + 1)])
+
+        rows = make_rows(users, movies_per_user, rng)
+        print(f"insert {len(rows)} movies, no triggers    {insert_rows(plain, rows):10.1f} rows/s")
+        print(f"insert {len(rows)} movies, with triggers  {insert_rows(engine, rows):10.1f} rows/s")
+
+        database.set_engine(engine)
+        user_ids = [rng.randint(1, users) for _ in range(50)]
+        print(f"stats, full scan of {movies_per_user} movies {timed_calls(full_scan_stats, user_ids):10.3f} ms")
+        print(f"stats, aggregate tables        {timed_calls(movie_stats.get_movie_stats, user_ids):10.3f} ms")
+
+        stats = movie_stats.get_movie_stats(1)
+        count, average, median, best_movies, worst_movies, histogram = full_scan_stats(1)
+        assert (stats.count, stats.histogram) == (count, histogram)
+        assert abs(stats.average - average) < 1e-9 and stats.median == median
+        assert sorted(stats.best_movies) == sorted(best_movies) and sorted(stats.worst_movies) == sorted(worst_movies)
+
+        start = time.perf_counter()
+        random_writes(engine, users, movies_per_user, rng)
+        print(f"2000 random writes              {time.perf_counter() - start:10.3f} s")
+        start = time.perf_counter()
+        wrong_user_ids = movie_stats.check_user_stats()
+        print(f"consistency check               {time.perf_counter() - start:10.3f} s | wrong users: {wrong_user_ids}")
+        with engine.begin() as connection:
+            connection.execute(text("UPDATE user_stats SET movie_count = movie_count + 1 WHERE user_id = 1"))
+        assert movie_stats.check_user_stats() == [1]
+        start = time.perf_counter()
+        movie_stats.rebuild_user_stats()
+        print(f"rebuild                         {time.perf_counter() - start:10.3f} s | "
+              f"wrong users: {movie_stats.check_user_stats()}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--movies", type=int, default=50_000, help="movies per user")
+    arguments = parser.parse_args()
+    run(arguments.users, arguments.movies)
@@ -0,0 +1,68 @@
+"""
+Render time and peak memory of the website generator,
+compared with the old string concatenation.
+
+Run from the project root:
+    python -m benchmarks.bench_website [--movies 100000]
+"""
+import argparse
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import website
+from storage.movie import Movie
+
+USER_ID = 1
+
+
+def make_movies(count):
+    return [Movie(f"Movie <{number}>", 1950 + number % 75, round(1 + number % 90 / 10, 1),
+                  f"https://example.invalid/{number}.jpg", f"Comment '{number}'")
+            for number in range(count)]
+
+
+def concatenate_website(user_name, movies, output_path):
+    """ The generator before streaming: one big string written at the end """
+    generated_html = ""
+    for movie in movies:
+        generated_html += website.render_movie(movie)
+    with open(website.TEMPLATE_FILE, "r", encoding="utf-8") as data:
+        template = data.read()
+        generated_site = template.replace("My", user_name + "'s")
+        generated_site = generated_site.replace(website.GRID_PLACEHOLDER, generated_html)
+    with open(Path(output_path) / f"{user_name}.html", "w", encoding="utf8") as handle:
+        handle.write(generated_site)
+
+
+def measure(name, function):
+    """
+    Time function(user_name) and measure its peak memory in a second run,
+    tracemalloc slows down the allocations of the first run otherwise.
+    """
+    start = time.perf_counter()
+    function(f"{name}-timed")
+    seconds = time.perf_counter() - start
+    tracemalloc.start()
+    function(f"{name}-traced")
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print(f"{name:<24} {seconds:8.3f} s | peak {peak / 1024:10.1f} KiB")
+
+
+def run(movie_count):
+    movies = make_movies(movie_count)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        measure("concatenated", lambda user_name: concatenate_website(user_name, movies, temp_dir))
+        measure("streamed, one page",
+                lambda user_name: website.generate_website(USER_ID, user_name, movies, temp_dir, movie_count))
+        measure("streamed, paginated", lambda user_name: website.generate_website(USER_ID, user_name, movies, temp_dir))
+        measure("unchanged, skipped",
+                lambda user_name: website.generate_website(USER_ID, "streamed, paginated-timed", movies, temp_dir))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--movies", type=int, default=100_000)
+    run(parser.parse_args().movies)
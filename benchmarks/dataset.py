@@ -0,0 +1,123 @@
+"""
+Seeded synthetic data for the benchmarks, written straight into the storage schema.
+Every user saves movies_per_user titles of a shared catalog, popular titles
+are saved by many users. Year, rating and poster of a title are the ones
+the OMDb stub answers with, so adding a title through the stub API gives the same row.
+The same seed always gives the same database (with the same NumPy version).
+
+Create a database with:
+    python -m benchmarks.dataset data/bench.db [--users 100] [--movies 1000] [--seed 1]
+"""
+import argparse
+import hashlib
+import time
+
+from sqlalchemy import text
+
+from benchmarks.omdb_stub import fake_movie_data
+from storage import schema
+from storage.database import create_database_engine
+from storage.movie import parse_rating, parse_year
+
+ADJECTIVES = ["Silent", "Broken", "Golden", "Last", "Hidden", "Dark", "Eternal", "Lost", "Crimson", "Frozen",
+              "Wild", "Secret", "Final", "Burning", "Distant", "Fallen", "Iron", "Midnight", "Savage", "Hollow"]
+NOUNS = ["River", "Empire", "Garden", "Machine", "Kingdom", "Shadow", "Horizon", "Island", "Mirror", "Storm",
+         "Harbor", "Legacy", "Voyage", "Prophecy", "Frontier", "Circus", "Citadel", "Echo", "Orchard", "Signal"]
+# Share of titles without year or rating, as OMDb answers "N/A" for them
+MISSING_YEAR_SHARE = 0.01
+UNRATED_SHARE = 0.05
+INSERT_CHUNK_SIZE = 50_000
+
+
+def catalog_title(number):
+    """ Unique, title cased name of the catalog entry number, e.g. "Golden Harbor 3" """
+    title = f"The {ADJECTIVES[number % len(ADJECTIVES)]} {NOUNS[number // len(ADJECTIVES) % len(NOUNS)]}"
+    sequel = number // (len(ADJECTIVES) * len(NOUNS))
+    return f"{title} {sequel + 1}" if sequel else title
+
+
+def catalog_size(users, movies_per_user):
+    """ Enough titles, that collections overlap without being identical """
+    return max(movies_per_user * 4, users * movies_per_user // 10, 1000)
+
+
+def generate_rows(users, movies_per_user, seed=1):
+    """
+    Yield the movie rows of all users as dicts for the movies table,
+    the titles of a user are drawn without repetition, weighted by 1 / rank.
+    """
+    import numpy as np
+    rng = np.random.default_rng(seed)
+    size = catalog_size(users, movies_per_user)
+    titles = [catalog_title(number) for number in range(size)]
+    movie_data = [fake_movie_data(title) for title in titles]
+    years = [parse_year(data["Year"]) for data in movie_data]
+    ratings = [parse_rating(data["imdbRating"]) for data in movie_data]
+    for position in np.flatnonzero(rng.random(size) < MISSING_YEAR_SHARE):
+        years[position] = None
+    for position in np.flatnonzero(rng.random(size) < UNRATED_SHARE):
+        ratings[position] = None
+    log_weights = -np.log(np.arange(size) + 10.0)
+    fetched_at = time.time()
+    for user_id in range(1, users + 1):
+        # Weighted sampling without repetition: the largest log(u) / weight win
+        keys = np.log(rng.random(size)) / np.exp(log_weights)
+        chosen = np.argpartition(-keys, min(movies_per_user, size) - 1)[:movies_per_user]
+        for position in np.sort(chosen).tolist():
+            yield {"user_id": user_id, "title": titles[position], "year": years[position],
+                   "rating": ratings[position], "poster_url": movie_data[position]["Poster"],
+                   "comment": titles[position], "fetched_at": fetched_at}
+
+
+def fill_database(engine, users, movies_per_user, seed=1):
+    """
+    Migrate the database of engine and insert users "User 1" ... "User n" with their movies.
+    Returns: number of inserted movies (int)
+    """
+    schema.migrate(engine)
+    with engine.begin() as connection:
+        connection.execute(text("INSERT INTO users (user_id, user_name) VALUES (:user_id, :user_name)"),
+                           [{"user_id": user_id, "user_name": f"User {user_id}"} for user_id in range(1, users + 1)])
+    inserted = 0
+    chunk = []
+    for row in generate_rows(users, movies_per_user, seed):
+        chunk.append(row)
+        if len(chunk) == INSERT_CHUNK_SIZE:
+            inserted += _insert_movies(engine, chunk)
+            chunk = []
+    return inserted + _insert_movies(engine, chunk)
+
+
+def _insert_movies(engine, rows):
+    if not rows:
+        return 0
+    with engine.begin() as connection:
+        connection.execute(text("INSERT INTO movies (user_id, title, year, rating, poster_url, comment, fetched_at) "
+                                "VALUES (:user_id, :title, :year, :rating, :poster_url, :comment, :fetched_at)"), rows)
+    return len(rows)
+
+
+def fingerprint(engine):
+    """ SHA-256 of all users and movies, equal for databases generated with the same seed """
+    digest = hashlib.sha256()
+    with engine.connect() as connection:
+        for row in connection.execute(text("SELECT user_id, user_name FROM users ORDER BY user_id")):
+            digest.update(repr(tuple(row)).encode())
+        for row in connection.execute(text("SELECT user_id, title, year, rating, poster_url, comment "
+                                           "FROM movies ORDER BY user_id, title")):
+            digest.update(repr(tuple(row)).encode())
+    return digest.hexdigest()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("db_file", help="new SQLite file")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--movies", type=int, default=1000, help="movies per user")
+    parser.add_argument("--seed", type=int, default=1)
+    arguments = parser.parse_args()
+    start = time.perf_counter()
+    database_engine = create_database_engine(f"sqlite:///{arguments.db_file}")
+    movie_count = fill_database(database_engine, arguments.users, arguments.movies, arguments.seed)
+    print(f"{arguments.users} users with {movie_count} movies written in {time.perf_counter() - start:.3f}s, "
+          f"fingerprint {fingerprint(database_engine)[:16]}")
@@ -0,0 +1,89 @@
+"""
+Local stand-in for the OMDb-API, so benchmarks never leave the machine.
+Every title is answered with generated movie data after an optional latency,
+its poster url points to a generated PNG image served by the same server.
+Titles starting with "Unknown" are not found, with fail_every every n-th request
+is answered with fail_status, 503 Service Unavailable by default.
+"""
+import itertools
+import json
+import struct
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+def fake_movie_data(title, poster_base="https://example.invalid/"):
+    """ Deterministic OMDb-like movie data for a title """
+    seed = sum(map(ord, title))
+    return {"Title": title, "Year": str(1950 + seed % 75), "imdbRating": str(round(1 + seed % 90 / 10, 1)),
+            "Poster": f"{poster_base}posters/{seed}.png", "Response": "True"}
+
+
+def fake_poster(seed, width=300, height=450):
+    """ A poster sized PNG image in a color depending on seed """
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+    row = b"\x00" + bytes((seed * 37 % 256, seed * 91 % 256, seed * 53 % 256)) * width
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(row * height)) + chunk(b"IEND", b""))
+
+
+class OmdbStubHandler(BaseHTTPRequestHandler):
+    latency = 0.0
+    fail_every = 0
+    fail_status = 503
+    request_numbers = itertools.count(1)
+    protocol_version = "HTTP/1.1"
+    # Headers and body are sent separately, delayed ACKs would add 40 ms otherwise
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        if self.latency:
+            time.sleep(self.latency)
+        url = urlparse(self.path)
+        if self.fail_every and next(self.request_numbers) % self.fail_every == 0:
+            self.send_response(self.fail_status)
+            self.send_header("Retry-After", "0")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if url.path.startswith("/posters/"):
+            body, content_type = fake_poster(int(url.path.rsplit("/", 1)[1].split(".")[0])), "image/png"
+        else:
+            title = parse_qs(url.query).get("t", [""])[0]
+            poster_base = f"http://{self.headers['Host']}/"
+            movie_data = {"Response": "False", "Error": "Movie not found!"} if title.startswith("Unknown") \
+                else fake_movie_data(title, poster_base)
+            body, content_type = json.dumps(movie_data).encode(), "application/json"
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        return
+
+
+@contextmanager
+def running_stub_server(latency=0.0, fail_every=0, fail_status=503):
+    """
+    Serve the stub API on a free local port while the with-block runs.
+    Yields: the base url of the server (str)
+    """
+    handler = type("LatencyHandler", (OmdbStubHandler,), {"latency": latency, "fail_every": fail_every,
+                                                          "fail_status": fail_status,
+                                                          "request_numbers": itertools.count(1)})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{server.server_address[1]}/"
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,168 @@
+"""
+Stress test of several processes reading and writing the same database file at once.
+Every process increments a shared counter (the comment of one movie) with
+optimistic versioning, adds and deletes its own movies, races the other
+processes for the same titles and reads pages and statistics in between.
+Afterward the database is checked: every successful increment is in the
+counter, every contested title was added exactly once, every process finds
+its own movies and the rating aggregates match the movies.
+Exits with 1, if an update was lost or a check failed.
+
+Run from the project root:
+    python -m benchmarks.stress_concurrency [--processes 8] [--operations 300] [--unversioned]
+"""
+import argparse
+import multiprocessing
+import random
+import sys
+import tempfile
+import time
+from collections import Counter
+from pathlib import Path
+
+from sqlalchemy import text
+
+from storage import database, metrics, movie_stats, schema
+from storage import movie_storage_sql as storage
+from storage.errors import DatabaseBusyError, DuplicateMovieError, VersionConflictError
+from storage.movie import Movie
+from storage.movie_repository import MovieRepository
+
+USER_ID = 1
+COUNTER_TITLE = "Counter"
+CONTESTED_TITLES = 20
+# Share of each operation, drawn at random per step
+OPERATION_WEIGHTS = {"increment": 40, "add": 20, "delete": 10, "contested_add": 10, "read": 20}
+
+
+def run_worker(number, db_url, operations, versioned, barrier, results):
+    """ One process of the stress test, puts its counts and its own saved titles into results """
+    database.set_engine(database.create_database_engine(db_url))
+    rng = random.Random(number)
+    movies = MovieRepository(USER_ID)
+    counts = Counter()
+    own_titles = set()
+    added = 0
+    barrier.wait()
+    start = time.perf_counter()
+    for kind in rng.choices(list(OPERATION_WEIGHTS), weights=list(OPERATION_WEIGHTS.values()), k=operations):
+        try:
+            if kind == "increment":
+                while True:
+                    counter = movies[COUNTER_TITLE]
+                    try:
+                        movies.update_comment(COUNTER_TITLE, str(int(counter.comment) + 1),
+                                              counter.version if versioned else None)
+                        break
+                    except VersionConflictError:
+                        # The cache was cleared, the next read gets the current counter
+                        counts["conflicts"] += 1
+            elif kind == "add":
+                title = f"Worker {number} Movie {added}"
+                added += 1
+                movies.add(Movie(title, 2000, rng.choice([None, 5.0, 7.5, 9.0]), "", ""))
+                own_titles.add(title)
+            elif kind == "delete" and own_titles:
+                title = rng.choice(sorted(own_titles))
+                movies.delete(title)
+                own_titles.discard(title)
+            elif kind == "contested_add":
+                try:
+                    movies.add(Movie(f"Contested {rng.randrange(CONTESTED_TITLES)}", 1999, 6.0, "", ""))
+                    counts["contested_won"] += 1
+                except DuplicateMovieError:
+                    counts["contested_lost"] += 1
+            elif kind == "read":
+                storage.list_movies_page(USER_ID, None, 100)
+                movies.stats()
+            counts[kind] += 1
+        except DatabaseBusyError:
+            counts["busy_errors"] += 1
+    seconds = time.perf_counter() - start
+    busy_retries = sum(counter["value"] for counter in metrics.snapshot()["counters"]
+                       if counter["name"] == metrics.PREFIX + "db_busy_retries_total")
+    results.put({"number": number, "seconds": seconds, "counts": dict(counts), "busy_retries": busy_retries,
+                 "own_titles": sorted(own_titles)})
+
+
+def prepare_database(db_url):
+    engine = database.create_database_engine(db_url)
+    schema.migrate(engine)
+    with engine.begin() as connection:
+        connection.execute(text("INSERT INTO users (user_id, user_name) VALUES (:user_id, 'Stress')"),
+                           {"user_id": USER_ID})
+        connection.execute(text("INSERT INTO movies (user_id, title, year, rating, poster_url, comment) "
+                                "VALUES (:user_id, :title, 2000, 5.0, '', '0')"),
+                           {"user_id": USER_ID, "title": COUNTER_TITLE})
+    engine.dispose()
+
+
+def check_database(db_url, worker_results):
+    """ Returns: [str] failed checks, the lost increments are reported separately """
+    database.set_engine(database.create_database_engine(db_url))
+    titles = storage.list_movies(USER_ID)
+    failures = []
+    expected_own = {title for result in worker_results for title in result["own_titles"]}
+    saved_own = {title for title in titles if title.startswith("Worker ")}
+    if saved_own != expected_own:
+        failures.append(f"{len(expected_own - saved_own)} own movies missing, "
+                        f"{len(saved_own - expected_own)} deleted movies still saved")
+    contested_saved = sum(1 for title in titles if title.startswith("Contested "))
+    contested_won = sum(result["counts"].get("contested_won", 0) for result in worker_results)
+    if contested_saved != contested_won:
+        failures.append(f"{contested_won} contested titles were added, {contested_saved} are saved")
+    wrong_users = movie_stats.check_user_stats()
+    if wrong_users:
+        failures.append(f"Rating aggregates of users {wrong_users} don't match their movies")
+    busy_errors = sum(result["counts"].get("busy_errors", 0) for result in worker_results)
+    if busy_errors:
+        failures.append(f"{busy_errors} operations failed with a locked database")
+    return int(titles[COUNTER_TITLE].comment), failures
+
+
+def run(processes, operations, versioned):
+    context = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory() as temp_dir:
+        db_url = f"sqlite:///{Path(temp_dir) / 'movies.db'}"
+        prepare_database(db_url)
+        barrier = context.Barrier(processes + 1)
+        results = context.Queue()
+        workers = [context.Process(target=run_worker, args=(number, db_url, operations, versioned, barrier, results))
+                   for number in range(processes)]
+        for worker in workers:
+            worker.start()
+        # Every process is imported and connected, they start together
+        barrier.wait()
+        start = time.perf_counter()
+        worker_results = [results.get() for _ in workers]
+        wall_seconds = time.perf_counter() - start
+        for worker in workers:
+            worker.join()
+        counter, failures = check_database(db_url, worker_results)
+
+    totals = Counter()
+    for result in worker_results:
+        totals.update(result["counts"])
+    finished = sum(totals[kind] for kind in OPERATION_WEIGHTS)
+    print(f"{processes} processes x {operations} operations in {wall_seconds:.2f}s: "
+          f"{finished / wall_seconds:.1f} operations/s")
+    for kind in OPERATION_WEIGHTS:
+        print(f"    {kind:<14} {totals[kind]:6d}")
+    print(f"    version conflicts retried {totals['conflicts']}, contested adds won {totals['contested_won']} "
+          f"lost {totals['contested_lost']}, busy retries {sum(r['busy_retries'] for r in worker_results)}")
+    lost = totals["increment"] - counter
+    print(f"Counter {counter} after {totals['increment']} increments: {lost} lost updates"
+          f"{'' if versioned else ' (without versions)'}")
+    for failure in failures:
+        print(f"FAILED: {failure}")
+    return 1 if failures or (versioned and lost) else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--processes", type=int, default=8)
+    parser.add_argument("--operations", type=int, default=300, help="operations per process")
+    parser.add_argument("--unversioned", action="store_true",
+                        help="increment without the version check, to show the lost updates it prevents")
+    arguments = parser.parse_args()
+    sys.exit(run(arguments.processes, arguments.operations, not arguments.unversioned))
@@ -0,0 +1,243 @@
+"""
+End-to-end benchmark suite: times the storage functions, the user functions,
+the stats, search, sort and list actions of the menu and the website generator
+on seeded datasets of several sizes. OMDb is replaced by the local stub server.
+Results are written as JSON, a second file can be compared with them
+to find regressions between commits.
+
+Run from the project root:
+    python -m benchmarks.suite [--scales 10x100,20x1000,50x5000] [--repeats 5]
+                               [--output results.json] [--compare baseline.json]
+"""
+import argparse
+import contextlib
+import io
+import json
+import platform
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import movies
+import website
+from benchmarks import dataset
+from benchmarks.omdb_stub import running_stub_server
+from storage import api_cache, database
+from storage import api_data_handling as api
+from storage import movie_storage_sql as storage
+from storage import user_data_handling as user
+from storage.movie import Movie
+from storage.movie_repository import MovieRepository
+
+RESULTS_PATH = Path(__file__).resolve().parent / "results"
+DEFAULT_SCALES = "10x100,20x1000,50x5000"
+# A median this much slower than the baseline counts as regression
+REGRESSION_FACTOR = 1.25
+# Faster operations are too noisy to compare
+MIN_COMPARED_SECONDS = 0.0005
+USER_ID = 1
+
+
+def git_commit():
+    """ Short hash of the checked out commit, None outside of a git repository """
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True, cwd=Path(__file__).resolve().parent).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_scales(scales):
+    """ "10x100,20x1000" -> [(10, 100), (20, 1000)] users x movies per user """
+    return [tuple(int(number) for number in scale.split("x")) for scale in scales.split(",")]
+
+
+class Timer:
+    """ Collects the seconds of repeated runs per operation """
+
+    def __init__(self, repeats):
+        self.repeats = repeats
+        self.results = {}
+
+    def time(self, name, function, setup=None, repeats=None):
+        """ Run setup() untimed and function() timed, repeats times """
+        seconds = []
+        for run in range(repeats or self.repeats):
+            if setup is not None:
+                setup()
+            start = time.perf_counter()
+            function()
+            seconds.append(time.perf_counter() - start)
+        self.results[name] = {"median": statistics.median(seconds), "min": min(seconds), "max": max(seconds),
+                              "runs": len(seconds)}
+
+
+@contextlib.contextmanager
+def menu_input(answers):
+    """ Answer the input() prompts of movies.py in order and swallow its output """
+    answer_iterator = iter(answers)
+    movies.input = lambda prompt="": next(answer_iterator)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            yield
+    finally:
+        del movies.input
+
+
+def run_menu(function, *answers):
+    with menu_input(answers):
+        function(MovieRepository(USER_ID), USER_ID)
+
+
+def time_storage(timer, movie_count):
+    new_movies = [Movie(f"Suite Movie {number}", 2000, 7.0, "", "") for number in range(100)]
+    counter = iter(range(10 ** 9))
+
+    def cold_cache():
+        storage.movie_caches.clear()
+
+    timer.time("storage.list_movies", lambda: storage.list_movies(USER_ID))
+    timer.time("storage.list_movies_page", lambda: storage.list_movies_page(USER_ID, None, 100))
+    timer.time("storage.iter_movies", lambda: sum(1 for _ in storage.iter_movies(USER_ID)))
+    timer.time("storage.list_all_movies", storage.list_all_movies)
+    timer.time("storage.get_movie_cache_cold", lambda: storage.get_movie_cache(USER_ID), setup=cold_cache)
+    timer.time("storage.add_movie", lambda: storage.add_movie(USER_ID, Movie(f"Single Movie {next(counter)}",
+                                                                             2000, 7.0, "", "")))
+    timer.time("storage.update_movie", lambda: storage.update_movie("Single Movie 0", "Updated", USER_ID))
+    deleted = iter(range(10 ** 9))
+    timer.time("storage.delete_movie", lambda: storage.delete_movie(f"Single Movie {next(deleted)}", USER_ID))
+    timer.time("storage.add_movies_100", lambda: storage.add_movies(USER_ID, new_movies),
+               setup=lambda: [storage.delete_movie(movie.title, USER_ID) for movie in new_movies])
+    for movie in new_movies:
+        storage.delete_movie(movie.title, USER_ID)
+
+    # A user with as many movies as the others, deleted once
+    scratch_user_id = user.insert_user("Scratch User")
+    storage.add_movies(scratch_user_id, [Movie(f"Scratch Movie {number}", 2000, 7.0, "", "")
+                                         for number in range(movie_count)])
+    timer.time("storage.delete_user_movies", lambda: storage.delete_user_movies(scratch_user_id), repeats=1)
+    user.remove_user(scratch_user_id)
+
+
+def time_users(timer):
+    user_ids = []
+    timer.time("user.get_user_data", user.get_user_data)
+    timer.time("user.get_user_name", lambda: user.get_user_name(USER_ID))
+    timer.time("user.insert_user", lambda: user_ids.append(user.insert_user("Suite User")))
+    timer.time("user.rename_user", lambda: user.rename_user(user_ids[0], "Renamed User"))
+    timer.time("user.remove_user", lambda: user.remove_user(user_ids.pop()))
+
+
+def time_menu(timer):
+    # A partial title, which is found by the fuzzy search only
+    query = dataset.catalog_title(7).split()[1].lower()
+    timer.time("menu.list_movies", lambda: run_menu(movies.list_movies))
+    timer.time("menu.show_stats", lambda: run_menu(movies.show_stats))
+    timer.time("menu.search_movie", lambda: run_menu(movies.search_movie, query))
+    timer.time("menu.sort_by_rating", lambda: run_menu(movies.sort_by_rating))
+    titles = iter(range(10 ** 9))
+
+    def add_and_delete():
+        title = f"Menu Movie {next(titles)}"
+        run_menu(movies.add_movie, title)
+        # The menu only prints its errors
+        assert title in MovieRepository(USER_ID), f"{title} was not added"
+        run_menu(movies.delete_movie, title)
+    # Fetched from the stub server, the OMDb response cache is bypassed by new titles
+    timer.time("menu.add_and_delete_movie", add_and_delete)
+
+
+def time_website(timer, output_path):
+    user_name = user.get_user_name(USER_ID)
+    movie_stream = storage.MovieStream(USER_ID)
+
+    def remove_pages():
+        for page in Path(output_path).glob("*.html"):
+            page.unlink()
+    timer.time("website.generate_website", lambda: website.generate_website(USER_ID, user_name, movie_stream, output_path),
+               setup=remove_pages)
+    timer.time("website.generate_website_unchanged",
+               lambda: website.generate_website(USER_ID, user_name, movie_stream, output_path))
+
+
+def run_scale(users, movies_per_user, repeats, seed, temp_dir):
+    """ Returns: {"rows", "fill_seconds", "operations": {name: {"median", "min", "max", "runs"}}} """
+    scale_path = Path(temp_dir) / f"{users}x{movies_per_user}"
+    scale_path.mkdir()
+    engine = database.create_database_engine(f"sqlite:///{scale_path / 'movies.db'}")
+    start = time.perf_counter()
+    rows = dataset.fill_database(engine, users, movies_per_user, seed)
+    fill_seconds = time.perf_counter() - start
+    database.set_engine(engine)
+    storage.movie_caches.clear()
+    api_cache.cache_database.set_engine(database.create_database_engine(f"sqlite:///{scale_path / 'omdb_cache.db'}"))
+
+    timer = Timer(repeats)
+    time_storage(timer, movies_per_user)
+    time_users(timer)
+    time_menu(timer)
+    time_website(timer, scale_path)
+    engine.dispose()
+    return {"rows": rows, "fill_seconds": fill_seconds, "operations": timer.results}
+
+
+def compare(results, baseline, factor=REGRESSION_FACTOR):
+    """
+    Print the median of every operation relative to the baseline.
+    Returns: [(scale, operation, ratio)] of the regressions
+    """
+    regressions = []
+    for scale, scale_results in results["scales"].items():
+        base_operations = baseline.get("scales", {}).get(scale, {}).get("operations", {})
+        for name, result in scale_results["operations"].items():
+            if name not in base_operations:
+                continue
+            base_median = base_operations[name]["median"]
+            ratio = result["median"] / base_median if base_median else float("inf")
+            slower = ratio > factor and max(result["median"], base_median) >= MIN_COMPARED_SECONDS
+            if slower:
+                regressions.append((scale, name, ratio))
+            print(f"{scale:>10} {name:<36} {base_median * 1000:10.3f} ms -> {result['median'] * 1000:10.3f} ms"
+                  f" {ratio:6.2f}x{'  SLOWER' if slower else ''}")
+    return regressions
+
+
+def run(scales, repeats, seed, output, baseline_file=None):
+    results = {"commit": git_commit(), "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+               "python": platform.python_version(), "sqlite": sqlite3.sqlite_version,
+               "platform": platform.platform(), "seed": seed, "repeats": repeats, "scales": {}}
+    with tempfile.TemporaryDirectory() as temp_dir, running_stub_server() as url:
+        api.REQUEST_GET_URL = f"{url}?apikey=benchmark&"
+        for users, movies_per_user in parse_scales(scales):
+            scale = f"{users}x{movies_per_user}"
+            scale_results = run_scale(users, movies_per_user, repeats, seed, temp_dir)
+            results["scales"][scale] = scale_results
+            print(f"{scale}: {scale_results['rows']} movies generated in {scale_results['fill_seconds']:.3f}s")
+            for name, result in scale_results["operations"].items():
+                print(f"    {name:<36} median {result['median'] * 1000:10.3f} ms | "
+                      f"min {result['min'] * 1000:10.3f} ms | max {result['max'] * 1000:10.3f} ms")
+
+    output = Path(output or RESULTS_PATH / f"{results['commit'] or 'results'}.json")
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(results, indent=2), encoding="utf8")
+    print(f"Results written to {output}")
+    if baseline_file:
+        regressions = compare(results, json.loads(Path(baseline_file).read_text(encoding="utf8")))
+        print(f"{len(regressions)} regressions slower than {REGRESSION_FACTOR}x")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--scales", default=DEFAULT_SCALES, help="users x movies per user, comma separated")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help=f"JSON file, {RESULTS_PATH.name}/<commit>.json by default")
+    parser.add_argument("--compare", help="JSON file of an earlier run, exits with 1 on regressions")
+    arguments = parser.parse_args()
+    sys.exit(run(arguments.scales, arguments.repeats, arguments.seed, arguments.output, arguments.compare))
@@ -0,0 +1,207 @@
+"""
+Charts of the movies of a user: the rating distribution, movies per
+period of years and the average rating per decade.
+The bins are computed with NumPy, the charts are drawn on their own Figure
+with the Agg backend, so nothing is kept in pyplot's global state and no GUI
+backend is loaded. A chart file is named by the hash of its data and only
+drawn again when the data changed.
+
+Render the charts of all users with:
+    python charts.py [--workers 4]
+"""
+import argparse
+import hashlib
+import time
+from collections import namedtuple
+from pathlib import Path
+
+from sqlalchemy import text
+
+from storage import metrics
+from storage.database import data_path, get_engine
+from storage.files import atomic_path
+
+CHART_PATH = data_path / "charts"
+# Inches and dots per inch of every chart, part of the hash
+FIGURE_SIZE = (8, 4.5)
+DPI = 100
+BAR_COLOR = "#3b6ea5"
+# Ratings are saved with one decimal, like the buckets of user_rating_histogram
+RATING_BIN_WIDTH = 0.1
+YEAR_BIN_WIDTH = 5
+DECADE = 10
+# Changes the hash of every chart, increase it when the drawing changes
+CHART_VERSION = 2
+
+# positions: left edges of the bars, heights: their heights, both NumPy arrays
+Chart = namedtuple("Chart", ["kind", "title", "x_label", "y_label", "positions", "heights", "width"])
+
+
+def load_chart_data(user_id=None):
+    """
+    Read year and rating of the movies of one user or of all users with one query.
+    Returns: {user_id: (years, ratings)} float arrays, NaN where the value is missing
+    """
+    import numpy as np
+    query = "SELECT user_id, year, rating FROM movies"
+    if user_id is not None:
+        query += " WHERE user_id = :user_id"
+    with get_engine().connect() as connection:
+        rows = connection.execute(text(query + " ORDER BY user_id"), {"user_id": user_id}).fetchall()
+    if not rows:
+        return {}
+    user_ids = np.array([row[0] for row in rows], dtype=np.int64)
+    years = np.array([row[1] for row in rows], dtype=np.float64)
+    ratings = np.array([row[2] for row in rows], dtype=np.float64)
+    starts = np.flatnonzero(np.r_[True, user_ids[1:] != user_ids[:-1]])
+    ends = np.r_[starts[1:], len(rows)]
+    return {int(user_ids[start]): (years[start:end], ratings[start:end]) for start, end in zip(starts, ends)}
+
+
+def ratings_chart(histogram):
+    """ The Chart "ratings" with one bar per rating of histogram: {rating: number of movies} """
+    import numpy as np
+    ratings = np.fromiter(histogram.keys(), dtype=np.float64, count=len(histogram))
+    heights = np.fromiter(histogram.values(), dtype=np.int64, count=len(histogram))
+    # The bars are centered on their rating
+    return Chart("ratings", "Ratings of current movies", "Rating (1-10)", "Movies",
+                 ratings - RATING_BIN_WIDTH / 2, heights, RATING_BIN_WIDTH)
+
+
+def build_charts(years, ratings):
+    """ Bin the years and ratings of a user into the Charts "ratings", "years" and "decades" """
+    import numpy as np
+    rated = ratings[~np.isnan(ratings)]
+    buckets, counts = np.unique(np.round(rated * 10).astype(np.int64), return_counts=True)
+    charts = [ratings_chart(dict(zip((buckets / 10).tolist(), counts.tolist())))]
+
+    known_years = years[~np.isnan(years)]
+    year_edges = np.empty(0)
+    year_heights = np.empty(0, dtype=np.int64)
+    if len(known_years):
+        first = np.floor(known_years.min() / YEAR_BIN_WIDTH) * YEAR_BIN_WIDTH
+        year_edges = np.arange(first, known_years.max() + YEAR_BIN_WIDTH + 1, YEAR_BIN_WIDTH)
+        year_heights, year_edges = np.histogram(known_years, bins=year_edges)
+        year_edges = year_edges[:-1]
+    charts.append(Chart("years", f"Movies per {YEAR_BIN_WIDTH} years", "Year", "Movies",
+                        year_edges, year_heights, YEAR_BIN_WIDTH))
+
+    both = ~np.isnan(years) & ~np.isnan(ratings)
+    decades = (years[both] // DECADE).astype(np.int64)
+    decade_positions = np.empty(0)
+    averages = np.empty(0)
+    if len(decades):
+        first_decade = decades.min()
+        counts = np.bincount(decades - first_decade)
+        sums = np.bincount(decades - first_decade, weights=ratings[both])
+        present = counts > 0
+        decade_positions = (np.flatnonzero(present) + first_decade) * DECADE
+        averages = sums[present] / counts[present]
+    charts.append(Chart("decades", "Average rating per decade", "Decade", "Average rating",
+                        decade_positions.astype(np.float64), averages, DECADE))
+    return {chart.kind: chart for chart in charts}
+
+
+def chart_hash(chart):
+    """ Hash of everything drawn into a chart """
+    import numpy as np
+    digest = hashlib.sha256(repr((CHART_VERSION, FIGURE_SIZE, DPI, chart.kind, chart.title,
+                                  chart.x_label, chart.y_label, chart.width)).encode())
+    digest.update(np.ascontiguousarray(chart.positions, dtype=np.float64).tobytes())
+    digest.update(np.ascontiguousarray(chart.heights, dtype=np.float64).tobytes())
+    return digest.hexdigest()
+
+
+def chart_file(user_id, chart, output_path=CHART_PATH):
+    """ Path of the chart file, named by user, kind and the hash of the chart """
+    return Path(output_path) / f"{user_id}_{chart.kind}_{chart_hash(chart)[:16]}.png"
+
+
+def save_chart(chart, file_path):
+    """
+    Draw a chart on a new Figure and write it atomically to file_path,
+    the format follows the suffix of the file.
+    """
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+    file_path = Path(file_path)
+    figure = Figure(figsize=FIGURE_SIZE, dpi=DPI)
+    FigureCanvasAgg(figure)
+    axes = figure.add_subplot()
+    axes.bar(chart.positions, chart.heights, width=chart.width * 0.9, align="edge", color=BAR_COLOR)
+    axes.set_title(chart.title)
+    axes.set_xlabel(chart.x_label)
+    axes.set_ylabel(chart.y_label)
+    file_path.parent.mkdir(parents=True, exist_ok=True)
+    with atomic_path(file_path) as temp_path:
+        figure.savefig(temp_path, format=file_path.suffix.lstrip(".") or "png")
+    return file_path
+
+
+def _remove_old_charts(user_id, kind, current_file):
+    for old_file in current_file.parent.glob(f"{user_id}_{kind}_*.png"):
+        if old_file != current_file:
+            old_file.unlink(missing_ok=True)
+
+
+def _render_missing(user_id, charts, output_path):
+    """
+    Draw the charts of a user, whose data has no file yet.
+    Returns: ({kind: Path}, number of drawn charts)
+    """
+    files = {}
+    rendered = 0
+    for kind, chart in charts.items():
+        file_path = chart_file(user_id, chart, output_path)
+        if not file_path.exists():
+            save_chart(chart, file_path)
+            _remove_old_charts(user_id, kind, file_path)
+            rendered += 1
+        files[kind] = file_path
+    return files, rendered
+
+
+@metrics.timed()
+def render_user_charts(user_id, output_path=CHART_PATH):
+    """
+    Make sure the charts of a user exist for the current movies.
+    Returns: {kind: Path} of the chart files
+    """
+    import numpy as np
+    years, ratings = load_chart_data(user_id).get(user_id, (np.empty(0), np.empty(0)))
+    return _render_missing(user_id, build_charts(years, ratings), output_path)[0]
+
+
+def render_all_charts(output_path=CHART_PATH, workers=None):
+    """
+    Bin the movies of all users from one query and draw the changed charts
+    in parallel processes.
+    Returns: ({user_id: {kind: Path}}, number of drawn charts)
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    chart_data = load_chart_data()
+    files = {}
+    rendered = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for user_id, (years, ratings) in chart_data.items():
+            charts = build_charts(years, ratings)
+            missing = {kind: chart for kind, chart in charts.items()
+                       if not chart_file(user_id, chart, output_path).exists()}
+            files[user_id] = {kind: chart_file(user_id, chart, output_path) for kind, chart in charts.items()}
+            if missing:
+                # Only the binned data is sent to the worker process
+                futures[user_id] = executor.submit(_render_missing, user_id, missing, output_path)
+        for user_id, future in futures.items():
+            rendered += future.result()[1]
+    return files, rendered
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Render the charts of all users.")
+    parser.add_argument("--workers", type=int, default=None, help="number of processes, all cores by default")
+    arguments = parser.parse_args()
+    metrics.setup_from_environment()
+    start = time.perf_counter()
+    chart_files, drawn = render_all_charts(workers=arguments.workers)
+    print(f"{drawn} of {sum(map(len, chart_files.values()))} charts drawn in {time.perf_counter() - start:.3f}s")
@@ -0,0 +1,307 @@
+"""
+Non-interactive command line for scripts and other tools.
+Every command prints its results as JSON or, with --format ndjson, one JSON object per line.
+
+Examples:
+    python cli.py users list
+    python cli.py add 1 "The Matrix" "Seven"
+    python cli.py --format ndjson list 1
+    python cli.py batch < operations.ndjson
+
+The batch command reads one operation per line from stdin and runs all of them
+in this process, e.g. {"command": "delete", "user_id": 1, "titles": ["Seven"]}.
+Its keys are the argument names of the single commands.
+A failing single command prints {"error": "..."} and exits with 1.
+"""
+import argparse
+import json
+import sys
+
+from storage import (movie_storage_sql as storage,
+                     api_data_handling as api,
+                     user_data_handling as user,
+                     columnar,
+                     movie_stats,
+                     recommendations,
+                     refresh_worker,
+                     metrics)
+from storage.movie import Movie
+from storage.movie_repository import MovieRepository
+
+
+def list_command(user_id):
+    """ Stream the movies page by page, with --format ndjson the first ones are printed right away """
+    return (dict(movie.as_dict(), version=movie.version) for movie in MovieRepository(user_id).stream())
+
+
+def saved_titles_of(user_id):
+    """
+    Returns: set of the titles the user saved
+    Raises UnknownUserError, if there is no user with this user_id.
+    """
+    user.get_user_name(user_id)
+    return set(MovieRepository(user_id).titles())
+
+
+def fetch_new_movies(titles, saved_titles):
+    """
+    Fetch the titles, which are not in saved_titles, from the OMDb-API at once.
+    Returns: ({title: result} of the saved and unknown titles, [Movie] of the found ones)
+    """
+    new_titles = list(dict.fromkeys(title for title in titles if title not in saved_titles))
+    movies_data = api.get_movies_by_titles(new_titles)
+    results = {title: {"title": title, "status": "exists"} for title in titles if title in saved_titles}
+    movies = []
+    for title in new_titles:
+        movie_data = movies_data.get(title, {})
+        if movie_data.get("Response") != "True":
+            results[title] = {"title": title, "status": "not_found", "error": movie_data.get("Error")}
+            continue
+        movies.append(Movie.from_omdb(title, movie_data))
+    return results, movies
+
+
+def save_new_movies(user_id, titles, results, movies):
+    """
+    Save the movies of fetch_new_movies in one transaction.
+    Returns: one result per title
+    """
+    # Another process may have saved some of the titles since, their data is updated then
+    with storage.UnitOfWork() as work:
+        saved_since = work.saved_titles(user_id, [movie.title for movie in movies])
+        work.save_movies(user_id, movies)
+    for movie in movies:
+        results[movie.title] = {"title": movie.title, "status": "updated" if movie.title in saved_since else "added"}
+    return [results[title] for title in dict.fromkeys(titles)]
+
+
+def add_command(user_id, titles):
+    """
+    Fetch all new titles from the OMDb-API at once and save them in one transaction
+    Raises UnknownUserError before any request, if there is no user with this user_id.
+    """
+    titles = [title.title() for title in titles]
+    results, movies = fetch_new_movies(titles, saved_titles_of(user_id))
+    return save_new_movies(user_id, titles, results, movies)
+
+
+def delete_command(user_id, titles):
+    """ Delete all titles in one transaction """
+    titles = list(dict.fromkeys(title.title() for title in titles))
+    with storage.UnitOfWork() as work:
+        saved_titles = work.saved_titles(user_id, titles)
+        for title in titles:
+            work.delete_movie(title, user_id)
+    return [{"title": title, "deleted": title in saved_titles} for title in titles]
+
+
+def update_command(user_id, title, comment, version=None):
+    """ With the version of the movie, refuse to overwrite a newer comment """
+    return [{"title": title.title(),
+             "updated": MovieRepository(user_id).update_comment(title.title(), comment, version)}]
+
+
+def stats_command(user_id):
+    stats = MovieRepository(user_id).stats()
+    return [{"count": stats.count, "average": stats.average, "median": stats.median,
+             "max_rating": stats.max_rating, "min_rating": stats.min_rating,
+             "best_movies": [title for title, _, _ in stats.best_movies],
+             "worst_movies": [title for title, _, _ in stats.worst_movies],
+             "histogram": [{"rating": rating, "count": count} for rating, count in stats.histogram.items()]}]
+
+
+def check_stats_command(rebuild=False):
+    """ Compare the rating aggregates with the movies, with rebuild=True compute them again first """
+    if rebuild:
+        movie_stats.rebuild_user_stats()
+    return [{"rebuilt": rebuild, "inconsistent_user_ids": movie_stats.check_user_stats()}]
+
+
+def search_command(user_id, query):
+    repository = MovieRepository(user_id)
+    if query.title() in repository:
+        return [dict(repository[query.title()].as_dict(), score=100.0)]
+    return [dict(movie.as_dict(), score=score) for movie, score in repository.search(query)]
+
+
+def recommend_command(user_id, limit=10):
+    return [{"title": title, "year": year, "rating": rating, "score": score}
+            for title, year, rating, score in recommendations.recommend(user_id, limit)]
+
+
+def refresh_command(rate=refresh_worker.RATE_LIMIT):
+    """ Fetch the stale movies of all users again, at most rate requests per second """
+    return [refresh_worker.refresh_all(rate)]
+
+
+def charts_command(user_id=None):
+    """ Render the charts of a user or of all users, unchanged charts are kept """
+    import charts
+    if user_id is None:
+        chart_files = charts.render_all_charts()[0]
+    else:
+        chart_files = {user_id: charts.render_user_charts(user_id)}
+    return [{"user_id": chart_user_id, "kind": kind, "file": str(file_path)}
+            for chart_user_id, files in chart_files.items() for kind, file_path in files.items()]
+
+
+def export_command(user_id=None):
+    import website
+    if user_id is None:
+        render_times = website.export_all_websites()
+        return [{"user_id": render_user_id, "seconds": seconds} for render_user_id, seconds in render_times.items()]
+    user_name = user.get_user_name(user_id)
+    movie_stream = storage.MovieStream(user_id)
+    written = website.generate_website(user_id, user_name, movie_stream, posters=website.cache_posters(movie_stream))
+    return [{"user_id": user_id, "user_name": user_name, "written": written}]
+
+
+def backup_command(path, file_format=None):
+    """ Export the users and movies tables as Parquet, Arrow or CSV files into the directory path """
+    return [{"table": table, "file": str(file_path), "rows": rows}
+            for table, (file_path, rows) in columnar.export_tables(path, file_format).items()]
+
+
+def restore_command(path, replace=False):
+    """ Import the tables of a backup, with replace=True the current users and movies are deleted """
+    return [{"table": table, "rows": rows} for table, rows in columnar.import_tables(path, replace).items()]
+
+
+def users_list_command():
+    return [{"user_id": user_id, "user_name": user_name} for user_id, user_name in user.get_user_data().items()]
+
+
+def users_add_command(user_name):
+    return [{"user_id": user.insert_user(user_name), "user_name": user_name}]
+
+
+def users_rename_command(user_id, user_name):
+    return [{"user_id": user_id, "user_name": user_name, "updated": user.rename_user(user_id, user_name)}]
+
+
+def users_delete_command(user_id):
+    return [{"user_id": user_id, "deleted": user.remove_user(user_id)}]
+
+
+COMMANDS = {
+    "list": list_command,
+    "add": add_command,
+    "delete": delete_command,
+    "update": update_command,
+    "stats": stats_command,
+    "check-stats": check_stats_command,
+    "search": search_command,
+    "recommend": recommend_command,
+    "refresh": refresh_command,
+    "charts": charts_command,
+    "export": export_command,
+    "backup": backup_command,
+    "restore": restore_command,
+    "users list": users_list_command,
+    "users add": users_add_command,
+    "users rename": users_rename_command,
+    "users delete": users_delete_command,
+}
+
+
+def batch_command(lines):
+    """
+    Run one JSON operation per line, a failing operation doesn't stop the batch.
+    Yields: one result per operation, {"line", "command", "results"} or {"line", "command", "error"}
+    """
+    for line_number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        command = None
+        try:
+            operation = json.loads(line)
+            command = operation.pop("command")
+            yield {"line": line_number, "command": command, "results": list(COMMANDS[command](**operation))}
+        except Exception as e:
+            yield {"line": line_number, "command": command, "error": f"{type(e).__name__}: {e}"}
+
+
+def emit(records, output_format):
+    """ Print the records as one JSON array or as one JSON object per line """
+    if output_format == "ndjson":
+        for record in records:
+            sys.stdout.write(json.dumps(record) + "\n")
+    else:
+        json.dump(list(records), sys.stdout, indent=2)
+        sys.stdout.write("\n")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Manage the movie database without menus.")
+    parser.add_argument("--format", choices=["json", "ndjson"], default="json")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    commands.add_parser("list", help="list the movies of a user").add_argument("user_id", type=int)
+    add_parser = commands.add_parser("add", help="add movies by title, fetched from the OMDb-API")
+    add_parser.add_argument("user_id", type=int)
+    add_parser.add_argument("titles", nargs="+")
+    delete_parser = commands.add_parser("delete", help="delete movies by title")
+    delete_parser.add_argument("user_id", type=int)
+    delete_parser.add_argument("titles", nargs="+")
+    update_parser = commands.add_parser("update", help="change the comment of a movie")
+    update_parser.add_argument("user_id", type=int)
+    update_parser.add_argument("title")
+    update_parser.add_argument("comment")
+    update_parser.add_argument("--expected-version", dest="version", type=int,
+                               help="fail, if the movie was updated since this version")
+    commands.add_parser("stats", help="rating statistics of a user").add_argument("user_id", type=int)
+    commands.add_parser("check-stats", help="compare the rating aggregates with the movies").add_argument(
+        "--rebuild", action="store_true", help="compute the aggregates again before checking")
+    search_parser = commands.add_parser("search", help="fuzzy search in the titles of a user")
+    search_parser.add_argument("user_id", type=int)
+    search_parser.add_argument("query")
+    recommend_parser = commands.add_parser("recommend", help="movies, which users with a similar collection saved")
+    recommend_parser.add_argument("user_id", type=int)
+    recommend_parser.add_argument("--limit", type=int, default=10)
+    refresh_parser = commands.add_parser("refresh", help="fetch stale and incomplete movies from the OMDb-API again")
+    refresh_parser.add_argument("--rate", type=float, default=refresh_worker.RATE_LIMIT, help="requests per second")
+    commands.add_parser("charts", help="render the rating and year charts of a user or of all users").add_argument(
+        "user_id", type=int, nargs="?")
+    commands.add_parser("export", help="generate the website of a user or of all users").add_argument(
+        "user_id", type=int, nargs="?")
+    backup_parser = commands.add_parser("backup", help="export the users and movies tables into a directory")
+    backup_parser.add_argument("path")
+    backup_parser.add_argument("--file-format", choices=list(columnar.FORMATS),
+                               help="parquet by default, csv without pyarrow")
+    restore_parser = commands.add_parser("restore", help="import the tables of a backup into an empty database")
+    restore_parser.add_argument("path")
+    restore_parser.add_argument("--replace", action="store_true", help="delete all users and movies first")
+    commands.add_parser("batch", help="run JSON operations from stdin, one per line")
+
+    users_parser = commands.add_parser("users", help="manage users")
+    users_commands = users_parser.add_subparsers(dest="users_command", required=True)
+    users_commands.add_parser("list")
+    users_commands.add_parser("add").add_argument("user_name")
+    rename_parser = users_commands.add_parser("rename")
+    rename_parser.add_argument("user_id", type=int)
+    rename_parser.add_argument("user_name")
+    users_commands.add_parser("delete").add_argument("user_id", type=int)
+    return parser
+
+
+def main(argv=None):
+    arguments = vars(build_parser().parse_args(argv))
+    output_format = arguments.pop("format")
+    command = arguments.pop("command")
+    metrics.setup_from_environment()
+    # Create or upgrade the database before the first command
+    storage.create_table(None)
+    if command == "batch":
+        emit(batch_command(sys.stdin), output_format)
+        return
+    if command == "users":
+        command = f"users {arguments.pop('users_command')}"
+    try:
+        emit(COMMANDS[command](**arguments), output_format)
+    except Exception as e:
+        sys.stdout.write(json.dumps({"error": f"{type(e).__name__}: {e}"}) + "\n")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
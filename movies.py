@@ -1,14 +1,18 @@
 # Added Libraries
-import random
-from bdb import bar
-
-import matplotlib.pyplot as plt
-from urllib3.exceptions import RequestError
-from rapidfuzz.fuzz import partial_ratio as _partial_ratio
+# matplotlib, rapidfuzz, requests and numpy are imported on first use, to start faster
+from pathlib import Path
 from termcolor import colored, cprint
+import charts
+import website
 from storage import (movie_storage_sql as storage,
                      api_data_handling as api,
-                     user_data_handling as user)
+                     user_data_handling as user,
+                     recommendations,
+                     refresh_worker,
+                     metrics)
+from storage.errors import DuplicateMovieError, StorageError, VersionConflictError
+from storage.movie import Movie
+from storage.movie_repository import MovieRepository
 
 FIRST_MOVIE_YEAR = 1895
 CURRENT_YEAR = 2025
@@ -22,13 +26,15 @@ def show_menu(choices_dict):
         choice_num += 1
 
 
-def list_movies(movies_dict, user_id=None):
-    if not movies_dict:
+@metrics.timed("menu_action_seconds")
+def list_movies(movies, user_id=None):
+    if not movies:
         cprint("No Movies in your database yet!", 'red')
         return
-    cprint(f"\n{len(movies_dict)} movies in total", 'cyan')
-    for movie, stats in movies_dict.items():
-        print(f"{movie} ({stats['year']}) Rating: {stats['rating']}")
+    cprint(f"\n{len(movies)} movies in total", 'cyan')
+    # Streamed page by page from the database, the first rows print right away
+    for movie in movies.stream():
+        print(f"{movie.title} ({movie.display_year}) Rating: {movie.display_rating}")
 
 
 def get_movie_name(menu_option="work with"):
@@ -44,230 +50,200 @@ def get_movie_name(menu_option="work with"):
         return name.title()
 
 
-def add_movie(movies_dict, user_id):
+@metrics.timed("menu_action_seconds")
+def add_movie(movies, user_id):
     """
     Get a movie name by the user,
     if the movie exists in the OMDb-API, fetch the data.
     add the new movie, rating, year, image-url and a self created comment to the SQL database.
     """
-    if not movies_dict:
-        movies_dict = {}
+    from requests import ConnectionError as RequestConnectionError, RequestException
     movie = get_movie_name("add").title()
-    if movie not in movies_dict:
-        try:
-            movie_data = api.get_movie_by_title(movie)
-            movie_rating = movie_data["imdbRating"]
-            movie_year = movie_data["Year"]
-            movie_img_url = movie_data["Poster"]
-            movie_comment = movie
-            storage.add_movie(user_id, movie, movie_year, movie_rating, movie_img_url, movie_comment)
-            cprint(f"Movie '{movie}' successfully added!", 'cyan')
-        except RequestError:
-            cprint(f"Could not request movie named: {movie}", 'red')
-        except ConnectionError:
-            cprint("No connection to the api", 'red')
-        except KeyError:
-            cprint("Could not fetch all the data!")
-    else:
+    try:
+        movies.add(api.get_movie(movie))
+        cprint(f"Movie '{movie}' successfully added!", 'cyan')
+    except DuplicateMovieError:
         cprint("This movie was already saved.", 'red')
-
-
-def delete_movie(movies_dict, user_id):
+    except StorageError as e:
+        cprint(f"Could not save movie: {e}", 'red')
+    except (ConnectionError, RequestConnectionError):
+        cprint("No connection to the api", 'red')
+    except RequestException:
+        cprint(f"Could not request movie named: {movie}", 'red')
+    except KeyError:
+        cprint("Could not fetch all the data!")
+
+
+@metrics.timed("menu_action_seconds")
+def delete_movie(movies, user_id):
     """Ask user for a movie, if it exists. delete it from the SQL database"""
-    if not movies_dict:
+    if not movies:
         cprint("No Movies in your database yet!", 'red')
         return
     movie_to_delete = get_movie_name("delete").title()
-    if movie_to_delete not in movies_dict:
+    if movie_to_delete not in movies:
         cprint(f"Movie '{movie_to_delete}' doesn't exist!", 'red')
     else:
-        storage.delete_movie(movie_to_delete, user_id)
-        cprint(f"Movie '{movie_to_delete}' successfully deleted", 'cyan')
+        try:
+            movies.delete(movie_to_delete)
+            cprint(f"Movie '{movie_to_delete}' successfully deleted", 'cyan')
+        except StorageError as e:
+            cprint(f"Error: {e}", 'red')
 
 
-def update_movie(movies_dict, user_id):
+@metrics.timed("menu_action_seconds")
+def update_movie(movies, user_id):
     """
     Update the rating of an existing Movie from the SQL database
     and check for wrong inputs
     """
-    if not movies_dict:
+    if not movies:
         cprint("No Movies in your database yet!", 'red')
         return
     movie_to_update = get_movie_name("update")
-    if movie_to_update in movies_dict:
+    if movie_to_update in movies:
         new_comment = input(colored("Write a comment to add to the movie: ", 'yellow'))
         try:
-            storage.update_movie(movie_to_update, new_comment, user_id)
+            movies.update_comment(movie_to_update, new_comment, movies[movie_to_update].version)
             cprint(f"Movie '{movie_to_update}' successfully updated!", 'cyan')
-        except Exception as e:
+        except VersionConflictError:
+            cprint(f"Movie '{movie_to_update}' was changed by someone else in the meantime, "
+                   f"please check it and try again.", 'red')
+        except StorageError as e:
             cprint(f"Error: {e}", 'red')
     else:
         cprint(f"Movie '{movie_to_update}' doesn't exist!", 'red')
 
 
-def show_stats(movies_dict, user_id=None):
+@metrics.timed("menu_action_seconds")
+def show_stats(movies, user_id=None):
     """
-    Get the values of a dictionary and show average/median value
+    Get the rating summary of the user and show average/median value
     and the best/worst value/s
-    show an error and return if a wrong value is given
+    show an error and return if no ratings are found
     """
-    if not movies_dict:
+    if not movies:
         cprint("No Movies in your database yet!", 'red')
         return
-    ratings_list = [stats['rating'] for stats in movies_dict.values()]
-    # Average value + DivisionError check
-    try:
-        average_rating = sum(ratings_list) / len(ratings_list)
-    except ZeroDivisionError:
+    stats = movies.stats()
+    if not stats.count:
         cprint("No ratings found!", 'red')
         return
-    print(f"Average rating: {round(average_rating, 1)}")
-    # Median value
-    middle_of_list = len(ratings_list) // 2
-    median_value = (ratings_list[middle_of_list] + ratings_list[~middle_of_list]) / 2
-    print(f"Median rating: {round(median_value, 1)}")
-    # Best/worst movie(s)
-    max_rating = max(ratings_list)
-    min_rating = min(ratings_list)
-    best_movies = []
-    worst_movies = []
-    for movie, stats in movies_dict.items():
-        if stats['rating'] == max_rating:
-            best_movies.append(movie)
-        elif stats['rating'] == min_rating:
-            worst_movies.append(movie)
+    print(f"Average rating: {round(stats.average, 1)}")
+    print(f"Median rating: {round(stats.median, 1)}")
     # Output all the movies with the worst/best ratings
-    if best_movies:
-        if len(best_movies) > 1:
+    if stats.best_movies:
+        if len(stats.best_movies) > 1:
             print("Best movies:")
-            for best_movie in best_movies:
-                print(f"{best_movie} ({movies_dict[best_movie]['year']}), {max_rating}")
+            for best_movie, year, rating in stats.best_movies:
+                print(f"{best_movie} ({year}), {rating}")
         else:
-            best_movie_year = movies_dict[best_movies[0]]['year']
-            print(f"Best movie: {best_movies[0]} ({best_movie_year}), {max_rating}")
+            best_movie, year, rating = stats.best_movies[0]
+            print(f"Best movie: {best_movie} ({year}), {rating}")
 
-    if worst_movies:
-        if len(worst_movies) > 1:
+    if stats.worst_movies:
+        if len(stats.worst_movies) > 1:
             print("Worst movies:")
-            for worst_movie in worst_movies:
-                print(f"{worst_movie} ({movies_dict[worst_movie]['year']}), {min_rating}")
+            for worst_movie, year, rating in stats.worst_movies:
+                print(f"{worst_movie} ({year}), {rating}")
         else:
-            worst_movie_year = movies_dict[worst_movies[0]]['year']
-            print(f"Worst movie: {worst_movies[0]} ({worst_movie_year}), {min_rating}")
+            worst_movie, year, rating = stats.worst_movies[0]
+            print(f"Worst movie: {worst_movie} ({year}), {rating}")
 
 
-def random_movie(movies_dict, user_id=None):
+@metrics.timed("menu_action_seconds")
+def random_movie(movies, user_id=None):
     """
-    Get a random number in the length of the dict and count down.
-    the printed value is the current loop through the keys, when the nuber hits 0.
+    Pick a movie for tonight from the movies, which users with a similar
+    collection saved, weighted by how well they fit.
+    Without recommendations, pick one of the own movies weighted by rating.
     """
-    if not movies_dict:
+    if not movies:
         cprint("No Movies in your database yet!", 'red')
         return
-    random_number = random.randint(1, len(movies_dict))
-    for movie, stats in movies_dict.items():
-        random_number -= 1
-        if random_number <= 0:
-            cprint("Your movie for tonight:", 'cyan')
-            print(f"{movie} ({stats['year']}), it's rated {stats['rating']}")
-            break
+    pick = recommendations.pick_for_tonight(user_id)
+    if pick is None:
+        # The recommendations are still built from the collections before your first movies
+        cprint("Nothing to pick from yet, try again in a moment!", 'red')
+        return
+    title, year, rating, recommended = pick
+    movie = Movie(title, year, rating)
+    cprint("Your movie for tonight:", 'cyan')
+    print(f"{movie.title} ({movie.display_year}), it's rated {movie.display_rating}")
+    if recommended:
+        cprint("Recommended from the collections of other users.", 'cyan')
 
 
-def search_movie(movies_dict, user_id=None):
+@metrics.timed("menu_action_seconds")
+def search_movie(movies, user_id=None):
     """
     Ask the user for a movie title/part of title.
-    if no exact match (case-insensitive) print titles,
-    which are close to-/have part of the user search.
+    if no exact match (case-insensitive) print titles from the search index,
+    which are close to-/have part of the user search, best matches first.
     """
-    if not movies_dict:
+    if not movies:
         cprint("No Movies in your database yet!", 'red')
         return
     user_search = input(colored("Enter the full title, or part of a movie name: ", 'yellow'))
-    correct_search = user_search.title() in movies_dict
-    if correct_search:
-        print(f"{user_search.title()} ({movies_dict[user_search.title()]['year']})", end=", ")
-        print(f"{movies_dict[user_search.title()]['rating']}")
+    found_movie = movies.get(user_search.title())
+    if found_movie:
+        print(f"{found_movie.title} ({found_movie.display_year}), {found_movie.display_rating}")
     else:
         cprint(f"No movie with the title '{user_search}' was found!", 'red')
         cprint("\nMaybe you are searching for:", 'cyan')
-        found_movies = 0
-        for movie, stats in movies_dict.items():
-            if _partial_ratio(user_search.lower(), movie.lower()) >= 80:
-                print(f"{movie} ({stats['year']}), {stats['rating']}")
-                found_movies += 1
-        if found_movies <= 0:
+        matches = movies.search(user_search)
+        for movie, _ in matches:
+            print(f"{movie.title} ({movie.display_year}), {movie.display_rating}")
+        if not matches:
             cprint("No movie found", 'red')
 
 
-def sort_by_rating(movies_dict, user_id=None):
-    """Filter out the key with the highest value for each loop on a safe copy"""
-    if not movies_dict:
+@metrics.timed("menu_action_seconds")
+def sort_by_rating(movies, user_id=None):
+    """Print the movies from the best to the worst rating, unrated movies last"""
+    if not movies:
         cprint("No Movies in your database yet!", 'red')
         return
-    copy_of_dict = movies_dict.copy()
     cprint("The top-bottom ratings are:", 'cyan')
-    for loop in range(len(movies_dict)):
-        max_key = max(copy_of_dict, key=lambda movie: copy_of_dict[movie]['rating'])
-        print(f"{max_key} ({copy_of_dict[max_key]['year']}), {copy_of_dict[max_key]['rating']}")
-        del copy_of_dict[max_key]
+    for movie in movies.ranked():
+        print(f"{movie.title} ({movie.display_year}), {movie.display_rating}")
 
 
-def create_histogram_from_dict(movies_dict, user_id):
-    """Create and safe a Histogram in a user-named File"""
-    if not movies_dict:
+@metrics.timed("menu_action_seconds")
+def create_histogram_from_dict(movies, user_id):
+    """Create and safe a Histogram of the ratings in a user-named File"""
+    if not movies:
         cprint("No Movies in your database yet!", 'red')
         return
-    ratings_dict = {}
-    for movie, stats in movies_dict.items():
-        rating = stats['rating']
-        if rating not in ratings_dict:
-            ratings_dict[rating] = 0
-        ratings_dict[rating] += 1
-    plt.bar(list(ratings_dict.keys()), list(ratings_dict.values()), align="center")
-    plt.title('Ratings of current movies')
-    plt.xlabel("Rating (1-10)")
-    plt.ylabel("Movies with the same rating")
     safe_file = input(colored("In which file do you want to safe the Histogram? (.png by default):\n", 'yellow'))
-    plt.savefig("data/" + safe_file)
-    print(f"File '{safe_file}' successfully safed!")
+    file_path = Path("data") / safe_file
+    if not file_path.suffix:
+        file_path = file_path.with_suffix(".png")
+    charts.save_chart(charts.ratings_chart(movies.stats().histogram), file_path)
+    print(f"File '{file_path.name}' successfully safed!")
 
 
-def generate_website(movies_dict, user_id):
+@metrics.timed("menu_action_seconds")
+def generate_website(movies, user_id):
     """
-    Replace a placeholder in an HTML template with a generated html-string
-    and generate the website as movie-website-html.
+    Fill the HTML template with the movies of the user
+    and generate the website as movie-website-html, if the movies changed.
     """
     user_name = user.get_user_name(user_id)
-    title_name = user_name + "'s"
-    if not movies_dict:
+    if not movies:
         cprint("No Movies in your database yet!", 'red')
         return
-    generated_html = ""
-    for movie, data in movies_dict.items():
-        generated_html += f"""
-        <li class='movie-grid li'>
-                <div class='movie'>
-                    <a href='{data['poster_url']}' data-toggle="tooltip" data-placement="top" title='{data['comment']}'><img class='movie-poster' src='{data['poster_url']}' alt='Poster Image'/></a>
-                    <p class='movie-title'> {movie} </p>
-                    <p class='movie-year'> {data['year']} </p>
-                    <p class='movie-rating'> Rated {data['rating']} </p>
-                </div>
-        </li>\n
-            """
-    with open("_static/index_template.html", "r", encoding="utf-8") as data:
-        template = data.read()
-        generated_site = template.replace("My", title_name)
-        generated_site = generated_site.replace("__TEMPLATE_MOVIE_GRID__", generated_html)
-    file_path = f"_static/{user_name}.html"
-    with open(file_path, "w", encoding="utf8") as handle:
-        handle.write(generated_site)
-    cprint("Website was successfully generated!", 'cyan')
+    movie_stream = storage.MovieStream(user_id)
+    if website.generate_website(user_id, user_name, movie_stream, posters=website.cache_posters(movie_stream)):
+        cprint("Website was successfully generated!", 'cyan')
+    else:
+        cprint("Website is already up to date!", 'cyan')
 
 
 # Main Function start
 def main():
     """
-    Get a movie_dict from the SQL database, execute the chosen menu option
+    Get the MovieRepository of the chosen user, execute the chosen menu option
     to change the SQL table or show stats from the table.
     """
     menu_list = [
@@ -295,6 +271,7 @@ def main():
          "function": generate_website}
     ]
 
+    metrics.setup_from_environment()
     user.init_user_table()
     cprint("\n********** Welcome to the Movies app **********\n", 'cyan')
     # User.DB menu; return user_id chosen
@@ -304,10 +281,13 @@ def main():
     user_id, user_name = user_data
     # Create table if not already there
     storage.create_table(user_id)
+    # With MOVIES_BACKGROUND_REFRESH=1 stale ratings are fetched in a daemon thread, the menu never waits for it
+    refresh_worker.start_background_refresh()
+    # Answered from the MovieCache, which the storage functions keep up to date
+    movies = MovieRepository(user_id)
     # Movies.DB- menu for chosen user
     cprint(f"\n********** {user_name}'s Movies Database **********\n", 'cyan')
     while True:
-        movies = storage.list_movies(user_id)
         show_menu(menu_list)
         print()
         try:
@@ -0,0 +1,93 @@
+"""
+On-disk cache for OMDb-API responses.
+Responses are stored by normalized title in their own SQLite file,
+entries older than CACHE_TTL seconds are ignored and the oldest entries
+are evicted, once more than CACHE_MAX_ENTRIES are stored.
+The cache file is only opened, when the cache is used the first time.
+"""
+import json
+import os
+import time
+
+from sqlalchemy import text, bindparam
+
+from storage.database import LOOKUP_CHUNK_SIZE, CacheDatabase, write_transaction
+
+CACHE_TTL = int(os.environ.get("OMDB_CACHE_TTL", 7 * 24 * 60 * 60))
+CACHE_MAX_ENTRIES = int(os.environ.get("OMDB_CACHE_MAX_ENTRIES", 50_000))
+
+cache_database = CacheDatabase("omdb_cache.db", [
+    """
+    CREATE TABLE IF NOT EXISTS omdb_cache (
+        title_key TEXT PRIMARY KEY,
+        response TEXT NOT NULL,
+        fetched_at REAL NOT NULL
+    );
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_omdb_cache_fetched_at ON omdb_cache (fetched_at);",
+])
+get_cache_engine = cache_database.get_engine
+
+
+def normalize_title(title):
+    """ Titles differing only in case or whitespace share a cache entry """
+    return " ".join(title.split()).casefold()
+
+
+def get_many(titles):
+    """
+    Look up many titles at once.
+    Returns: {title(str): movie_data(dict)} for every title with a fresh cache entry
+    """
+    keys = {}
+    for title in titles:
+        keys.setdefault(normalize_title(title), []).append(title)
+    query = text("SELECT title_key, response FROM omdb_cache "
+                 "WHERE title_key IN :keys AND fetched_at >= :oldest").bindparams(bindparam("keys", expanding=True))
+    found = {}
+    key_list = list(keys)
+    with get_cache_engine().connect() as connection:
+        for start in range(0, len(key_list), LOOKUP_CHUNK_SIZE):
+            rows = connection.execute(query, {"keys": key_list[start:start + LOOKUP_CHUNK_SIZE],
+                                              "oldest": time.time() - CACHE_TTL})
+            for title_key, response in rows:
+                movie_data = json.loads(response)
+                for title in keys[title_key]:
+                    found[title] = movie_data
+    return found
+
+
+def get(title):
+    """ Return the cached movie_data of a title or None """
+    return get_many([title]).get(title)
+
+
+def put_many(movies_data):
+    """
+    Store {title: movie_data} in one transaction
+    and evict the oldest entries, if the cache grew too big.
+    """
+    if not movies_data:
+        return
+    now = time.time()
+    rows = [{"title_key": normalize_title(title), "response": json.dumps(movie_data), "fetched_at": now}
+            for title, movie_data in movies_data.items()]
+    with write_transaction(get_cache_engine()) as connection:
+        connection.execute(text("INSERT OR REPLACE INTO omdb_cache (title_key, response, fetched_at) "
+                                "VALUES (:title_key, :response, :fetched_at)"), rows)
+        connection.execute(text("""
+            DELETE FROM omdb_cache WHERE title_key IN (
+                SELECT title_key FROM omdb_cache ORDER BY fetched_at DESC LIMIT -1 OFFSET :max_entries
+            );
+        """), {"max_entries": CACHE_MAX_ENTRIES})
+
+
+def put(title, movie_data):
+    """ Store the movie_data of a single title """
+    put_many({title: movie_data})
+
+
+def clear():
+    """ Remove all cached responses """
+    with write_transaction(get_cache_engine()) as connection:
+        connection.execute(text("DELETE FROM omdb_cache;"))
@@ -1,17 +1,115 @@
+"""
+Requests to the OMDb-API.
+requests and dotenv are only imported, when the first movie is requested.
+"""
 import os
-import requests
-from dotenv import load_dotenv
+from concurrent.futures import ThreadPoolExecutor
 
-# Load the environment variable from the .env file
-load_dotenv()
+from storage import api_cache
+from storage.movie import Movie
+
+# Built by get_request_url() on the first request
+REQUEST_GET_URL = None
+# Seconds to wait for the API, before a request fails
+REQUEST_TIMEOUT = 10
+# Maximum of concurrent requests for get_movies_by_titles()
+MAX_IN_FLIGHT = 8
+# The answer of the API for an unknown title, every other error may pass on a retry
+NOT_FOUND_ERROR = "Movie not found!"
+
+_session = None
+
+
+def get_api_key():
+    """ Return the API_KEY from the environment or the .env file, "" if it is not configured """
+    from dotenv import load_dotenv
+    # Load the environment variable from the .env file
+    load_dotenv()
+    return os.environ.get('API_KEY', "")
+
+
+def get_request_url():
+    """ Return the url of the API with the API_KEY from the .env file """
+    global REQUEST_GET_URL
+    if REQUEST_GET_URL is None:
+        omdb_url = os.environ.get('OMDB_URL', "http://www.omdbapi.com/")
+        REQUEST_GET_URL = f"{omdb_url}?apikey={get_api_key()}&"
+    return REQUEST_GET_URL
+
+
+def get_session():
+    """ Return a shared requests.Session, which keeps connections to the API open """
+    global _session
+    if _session is None:
+        import requests
+        from requests.adapters import HTTPAdapter
+        _session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=MAX_IN_FLIGHT)
+        _session.mount("http://", adapter)
+        _session.mount("https://", adapter)
+    return _session
+
+
+def request_movie(title):
+    """ Request a single movie from the OMDb-API, without using the cache """
+    response = get_session().get(get_request_url(), params={"t": title}, timeout=REQUEST_TIMEOUT)
+    return response.json()
 
-API_KEY = os.environ.get('API_KEY')
-REQUEST_GET_URL = f"http://www.omdbapi.com/?apikey={API_KEY}&"
 
 def get_movie_by_title(title):
     """
-    Fetch data from a movie by requesting the OMDb-API.
+    Fetch data from a movie by requesting the OMDb-API,
+    if it was not requested recently.
     return data as dictionary.
     """
-    movie_data = requests.get(REQUEST_GET_URL, params={"t":title})
-    return movie_data.json()
+    movie_data = api_cache.get(title)
+    if movie_data is None:
+        movie_data = request_movie(title)
+        if movie_data.get("Response") == "True":
+            api_cache.put(title, movie_data)
+    return movie_data
+
+
+def get_movie(title):
+    """
+    Fetch a movie like get_movie_by_title and parse it into a Movie.
+    Raises KeyError, if the API has no movie with this title.
+    """
+    return Movie.from_omdb(title, get_movie_by_title(title))
+
+
+def is_not_found(movie_data):
+    """ Return True, if the API answered, that it has no movie with this title """
+    return movie_data.get("Response") == "False" and movie_data.get("Error") == NOT_FOUND_ERROR
+
+
+def _request_movie_or_error(title):
+    """ Like request_movie, but return failed requests in the error format of the OMDb-API """
+    import requests
+    try:
+        return request_movie(title)
+    except (requests.RequestException, ValueError) as e:
+        return {"Response": "False", "Error": str(e)}
+
+
+def get_movies_by_titles(titles, max_in_flight=MAX_IN_FLIGHT):
+    """
+    Fetch the data of many movies at once.
+    Cached titles are answered locally, the others are requested concurrently
+    with at most max_in_flight open requests.
+    Failed requests are returned as {"Response": "False", "Error": message}.
+
+    Returns: {title(str): movie_data(dict)}
+    """
+    movies_data = api_cache.get_many(titles)
+    missing_titles = list(dict.fromkeys(title for title in titles if title not in movies_data))
+    if not missing_titles:
+        return movies_data
+    fetched_data = {}
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        for title, movie_data in zip(missing_titles, executor.map(_request_movie_or_error, missing_titles)):
+            movies_data[title] = movie_data
+            if movie_data.get("Response") == "True":
+                fetched_data[title] = movie_data
+    api_cache.put_many(fetched_data)
+    return movies_data
@@ -0,0 +1,169 @@
+"""
+Import a list of movie titles into the collection of a user, without prompts.
+Titles are streamed from a CSV file (column "title" or the first column)
+or a JSONL file (strings or objects with a "title"), enriched by the OMDb-API
+in batches and written in one transaction per batch.
+After every batch the line number is saved, an interrupted import continues there.
+Titles, whose request failed (connection errors, HTTP 429 or 5xx), are saved
+with the line number and requested again by the next run.
+
+Usage:
+    python -m storage.bulk_import USER_ID FILE [--batch-size 100] [--restart]
+"""
+import argparse
+import csv
+import hashlib
+import json
+import time
+from itertools import chain, islice
+from pathlib import Path
+
+from termcolor import cprint
+
+from storage import (movie_storage_sql as storage,
+                     api_data_handling as api)
+from storage.database import db_file
+from storage.movie import Movie
+
+BATCH_SIZE = 100
+
+
+def read_titles(file_path):
+    """
+    Yield (line_number, title) for every title in a .csv or .jsonl file.
+    Titles are formatted like the titles entered in the menu.
+    """
+    with open(file_path, "r", encoding="utf-8", newline="") as handle:
+        if Path(file_path).suffix.lower() == ".csv":
+            rows = csv.reader(handle)
+            header = next(rows, [])
+            lowered_header = [column.strip().lower() for column in header]
+            if "title" in lowered_header:
+                column, first_line = lowered_header.index("title"), 2
+            else:
+                column, first_line = 0, 1
+                rows = _chain_first_row(header, rows)
+            for line_number, row in enumerate(rows, start=first_line):
+                if len(row) > column and row[column].strip():
+                    yield line_number, row[column].strip().title()
+        else:
+            for line_number, line in enumerate(handle, start=1):
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                title = entry.get("title", "") if isinstance(entry, dict) else str(entry)
+                if title.strip():
+                    yield line_number, title.strip().title()
+
+
+def _chain_first_row(first_row, rows):
+    """ Put a csv row, that turned out not to be a header, back in front """
+    if first_row:
+        yield first_row
+    yield from rows
+
+
+def skip_done(titles, done_line):
+    """ Skip titles, which were already handled by an interrupted import """
+    for line_number, title in titles:
+        if line_number > done_line:
+            yield line_number, title
+
+
+def drop_duplicates(titles, saved_titles):
+    """ Skip titles the user already saved or which appeared earlier in the file """
+    seen = set(saved_titles)
+    for line_number, title in titles:
+        if title not in seen:
+            seen.add(title)
+            yield line_number, title
+
+
+def batched(titles, batch_size):
+    """ Yield lists of up to batch_size (line_number, title) pairs """
+    titles = iter(titles)
+    while batch := list(islice(titles, batch_size)):
+        yield batch
+
+
+def enrich(batches):
+    """
+    Fetch the OMDb-data for every batch at once.
+    Yields: (last_line_number, movies, failed_titles, retry_titles) per batch,
+    retry_titles are the (line_number, title) pairs of failed requests
+    """
+    for batch in batches:
+        movies_data = api.get_movies_by_titles([title for _, title in batch])
+        movies = []
+        failed_titles = []
+        retry_titles = []
+        for line_number, title in batch:
+            movie_data = movies_data.get(title, {})
+            if movie_data.get("Response") != "True" and not api.is_not_found(movie_data):
+                retry_titles.append((line_number, title))
+                continue
+            try:
+                movies.append(Movie.from_omdb(title, movie_data))
+            except KeyError:
+                failed_titles.append(title)
+        yield max(line_number for line_number, _ in batch), movies, failed_titles, retry_titles
+
+
+def checkpoint_path(user_id, file_path):
+    """
+    Return the file, which remembers how far the import of this file got,
+    next to the database (MOVIES_DB_PATH), which the import writes into.
+    """
+    file_id = hashlib.sha1(str(Path(file_path).resolve()).encode()).hexdigest()[:12]
+    return db_file.parent / f"import_{user_id}_{file_id}.json"
+
+
+def import_movies(user_id, file_path, batch_size=BATCH_SIZE, restart=False):
+    """
+    Run the import pipeline and print the progress after every batch.
+    Titles, whose request failed, stay in the checkpoint for the next run.
+    Returns: (added(int), failed_titles(list)) failed_titles includes the titles to retry
+    """
+    storage.create_table(user_id)
+    checkpoint = checkpoint_path(user_id, file_path)
+    done_line = 0
+    retry_titles = []
+    if checkpoint.exists() and not restart:
+        state = json.loads(checkpoint.read_text())
+        done_line = state["line"]
+        retry_titles = [tuple(entry) for entry in state.get("retry", [])]
+        cprint(f"Resuming import after line {done_line}, retrying {len(retry_titles)} titles", 'cyan')
+
+    titles = chain(retry_titles, skip_done(read_titles(file_path), done_line))
+    titles = drop_duplicates(titles, storage.get_movie_cache(user_id).movies)
+    added = 0
+    failed_titles = []
+    retry_titles = []
+    start = time.perf_counter()
+    for last_line, movies, failed, retry in enrich(batched(titles, batch_size)):
+        added += storage.add_movies(user_id, movies)
+        failed_titles.extend(failed)
+        retry_titles.extend(retry)
+        done_line = max(done_line, last_line)
+        checkpoint.write_text(json.dumps({"line": done_line, "retry": retry_titles}))
+        handled = added + len(failed_titles) + len(retry_titles)
+        print(f"Line {done_line}: {added} added, {len(failed_titles)} not found, "
+              f"{len(retry_titles)} to retry ({handled / (time.perf_counter() - start):.1f} titles/s)")
+    if retry_titles:
+        cprint(f"{len(retry_titles)} titles could not be fetched, run the import again to retry them", 'red')
+    else:
+        checkpoint.unlink(missing_ok=True)
+    cprint(f"Import finished: {added} movies added in {time.perf_counter() - start:.1f}s", 'cyan')
+    return added, failed_titles + [title for _, title in retry_titles]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import movie titles from a .csv or .jsonl file.")
+    parser.add_argument("user_id", type=int)
+    parser.add_argument("file", type=Path)
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--restart", action="store_true", help="ignore the progress of an earlier import")
+    arguments = parser.parse_args()
+    _, not_found = import_movies(arguments.user_id, arguments.file, arguments.batch_size, arguments.restart)
+    for title in not_found:
+        cprint(f"Could not fetch: {title}", 'red')
@@ -0,0 +1,241 @@
+"""
+Export and import of the users and movies tables as columnar files,
+for backups and for analysing all collections with NumPy or pandas.
+Parquet and Arrow IPC files need pyarrow, without it the tables are written
+as CSV. Exports stream record batches straight from the database cursor,
+imports memory-map Arrow and Parquet files, so neither holds a whole table.
+CSV has no NULL, it is written as \\N like in PostgreSQL's COPY.
+
+Back up or restore the database with:
+    python -m storage.columnar export data/backup [--format parquet|arrow|csv]
+    python -m storage.columnar import data/backup [--replace]
+"""
+import argparse
+import csv
+import time
+from pathlib import Path
+
+from sqlalchemy import text
+
+from storage import metrics, schema
+from storage import movie_storage_sql as storage
+from storage.database import get_engine, write_transaction
+from storage.files import atomic_path
+
+# Rows per record batch and per executemany
+BATCH_SIZE = 10_000
+FORMATS = {"parquet": ".parquet", "arrow": ".arrow", "csv": ".csv"}
+# Column name and type of every exported table, users first for the foreign key
+TABLES = {
+    "users": [("user_id", "int64"), ("user_name", "string")],
+    "movies": [("id", "int64"), ("user_id", "int64"), ("title", "string"), ("year", "int64"),
+               ("rating", "float64"), ("poster_url", "string"), ("comment", "string"),
+               ("fetched_at", "float64"), ("version", "int64")],
+}
+# Ordered by the primary key, so an export of the same data gives the same files
+ORDER_BY = {"users": "user_id", "movies": "id"}
+CSV_NULL = "\\N"
+_CSV_TYPES = {"int64": int, "float64": float, "string": str}
+
+
+def has_pyarrow():
+    """ Return True, if the optional pyarrow is installed """
+    try:
+        import pyarrow
+    except ImportError:
+        return False
+    return True
+
+
+def default_format():
+    """ Parquet, CSV if pyarrow is missing """
+    return "parquet" if has_pyarrow() else "csv"
+
+
+def _arrow_schema(columns):
+    import pyarrow as pa
+    return pa.schema([(name, getattr(pa, type_name)()) for name, type_name in columns])
+
+
+def _record_batch(rows, arrow_schema):
+    """ Turn a list of row tuples into a RecordBatch, column by column """
+    import pyarrow as pa
+    columns = list(zip(*rows))
+    return pa.RecordBatch.from_arrays([pa.array(values, type=field.type)
+                                       for values, field in zip(columns, arrow_schema)], schema=arrow_schema)
+
+
+def _write_file(file_path, file_format, columns, batches):
+    """
+    Write batches of row tuples atomically to file_path.
+    Returns: number of written rows (int)
+    """
+    written = 0
+    with atomic_path(file_path) as temp_path:
+        if file_format == "csv":
+            with open(temp_path, "w", newline="", encoding="utf8") as file:
+                writer = csv.writer(file)
+                writer.writerow([name for name, _ in columns])
+                for rows in batches:
+                    writer.writerows([CSV_NULL if value is None else value for value in row] for row in rows)
+                    written += len(rows)
+        else:
+            import pyarrow as pa
+            arrow_schema = _arrow_schema(columns)
+            if file_format == "parquet":
+                import pyarrow.parquet as pq
+                writer = pq.ParquetWriter(temp_path, arrow_schema)
+            else:
+                writer = pa.ipc.new_file(str(temp_path), arrow_schema)
+            with writer:
+                for rows in batches:
+                    writer.write_batch(_record_batch(rows, arrow_schema))
+                    written += len(rows)
+    return written
+
+
+@metrics.timed()
+def export_tables(output_path, file_format=None, batch_size=BATCH_SIZE):
+    """
+    Write every table of TABLES into output_path as <table>.<format>.
+    All tables are read in one transaction, so they fit together
+    even while other processes write.
+    Returns: {table: (Path, number of rows)}
+    """
+    file_format = file_format or default_format()
+    if file_format not in FORMATS:
+        raise ValueError(f"Format has to be one of {', '.join(FORMATS)}, not '{file_format}'")
+    if file_format != "csv" and not has_pyarrow():
+        raise ValueError(f"The {file_format} format needs pyarrow, install it or use csv")
+    output_path = Path(output_path)
+    output_path.mkdir(parents=True, exist_ok=True)
+    exported = {}
+    with get_engine().connect() as connection:
+        connection = connection.execution_options(yield_per=batch_size)
+        for table, columns in TABLES.items():
+            result = connection.execute(text(f"SELECT {', '.join(name for name, _ in columns)} FROM {table} "
+                                             f"ORDER BY {ORDER_BY[table]}"))
+            file_path = output_path / f"{table}{FORMATS[file_format]}"
+            batches = (list(partition) for partition in result.partitions(batch_size))
+            exported[table] = (file_path, _write_file(file_path, file_format, columns, batches))
+    return exported
+
+
+def find_table_file(input_path, table):
+    """ Return the file of a table in input_path, in any of the FORMATS """
+    for suffix in FORMATS.values():
+        file_path = Path(input_path) / f"{table}{suffix}"
+        if file_path.exists():
+            return file_path
+    raise FileNotFoundError(f"No {table} file in {input_path}")
+
+
+def _check_columns(file_path, names, expected):
+    if list(names) != expected:
+        raise ValueError(f"{file_path.name} has the columns {', '.join(names)}, expected {', '.join(expected)}")
+
+
+def read_batches(file_path, columns, batch_size=BATCH_SIZE):
+    """
+    Yield the rows of a table file as lists of tuples in the order of columns.
+    Arrow and Parquet files are memory-mapped, only one batch is converted at a time.
+    """
+    file_path = Path(file_path)
+    names = [name for name, _ in columns]
+    if file_path.suffix == ".csv":
+        converters = [_CSV_TYPES[type_name] for _, type_name in columns]
+        with open(file_path, newline="", encoding="utf8") as file:
+            reader = csv.reader(file)
+            _check_columns(file_path, next(reader, []), names)
+            rows = []
+            for record in reader:
+                rows.append(tuple(None if value == CSV_NULL else convert(value)
+                                  for value, convert in zip(record, converters)))
+                if len(rows) == batch_size:
+                    yield rows
+                    rows = []
+            if rows:
+                yield rows
+        return
+    if file_path.suffix == ".arrow":
+        import pyarrow as pa
+        with pa.memory_map(str(file_path)) as source:
+            reader = pa.ipc.open_file(source)
+            _check_columns(file_path, reader.schema.names, names)
+            for number in range(reader.num_record_batches):
+                batch = reader.get_batch(number)
+                yield list(zip(*(batch.column(name).to_pylist() for name in names)))
+        return
+    import pyarrow.parquet as pq
+    parquet_file = pq.ParquetFile(file_path, memory_map=True)
+    _check_columns(file_path, parquet_file.schema_arrow.names, names)
+    for batch in parquet_file.iter_batches(batch_size=batch_size, columns=names):
+        yield list(zip(*(batch.column(name).to_pylist() for name in names)))
+
+
+def load_table(file_path):
+    """
+    Open an exported Arrow or Parquet file for analysis without copying it into memory,
+    e.g. load_table("data/backup/movies.arrow").column("rating").to_numpy() or .to_pandas().
+    Returns: pyarrow.Table
+    """
+    import pyarrow as pa
+    file_path = Path(file_path)
+    if file_path.suffix == ".arrow":
+        # The columns point into the mapped file, it stays open as long as the table
+        return pa.ipc.open_file(pa.memory_map(str(file_path))).read_all()
+    import pyarrow.parquet as pq
+    return pq.read_table(file_path, memory_map=True)
+
+
+@metrics.timed()
+def import_tables(input_path, replace=False, engine=None, batch_size=BATCH_SIZE):
+    """
+    Restore the tables of an export into the database in one transaction.
+    The database has to be empty, with replace=True all users and movies are deleted first.
+    The rating aggregates are computed and the change is counted once after all rows are inserted.
+    Returns: {table: number of rows}
+    """
+    engine = engine or get_engine()
+    schema.migrate(engine)
+    files = {table: find_table_file(input_path, table) for table in TABLES}
+    imported = {}
+    with write_transaction(engine) as connection, schema.row_triggers_paused(connection):
+        if replace:
+            # Cascades to the movies and their aggregates
+            connection.execute(text("DELETE FROM users"))
+        elif connection.execute(text("SELECT EXISTS (SELECT 1 FROM users)")).scalar():
+            raise ValueError("The database already has users, import with replace=True to delete them")
+        for table, columns in TABLES.items():
+            statement = (f"INSERT INTO {table} ({', '.join(name for name, _ in columns)}) "
+                         f"VALUES ({', '.join('?' for _ in columns)})")
+            imported[table] = 0
+            for rows in read_batches(files[table], columns, batch_size):
+                connection.exec_driver_sql(statement, rows)
+                imported[table] += len(rows)
+    if engine is get_engine():
+        for user_id in list(storage.movie_caches):
+            storage.clear_movie_cache(user_id)
+    return imported
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export or import the users and movies tables.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    export_parser = commands.add_parser("export", help="write the tables into a directory")
+    export_parser.add_argument("path", type=Path)
+    export_parser.add_argument("--format", choices=list(FORMATS), default=None,
+                               help="parquet by default, csv without pyarrow")
+    import_parser = commands.add_parser("import", help="restore the tables from a directory")
+    import_parser.add_argument("path", type=Path)
+    import_parser.add_argument("--replace", action="store_true", help="delete all users and movies first")
+    arguments = parser.parse_args()
+    start = time.perf_counter()
+    if arguments.command == "export":
+        schema.migrate(get_engine())
+        for table_name, (table_file, row_count) in export_tables(arguments.path, arguments.format).items():
+            print(f"{table_name}: {row_count} rows written to {table_file}")
+    else:
+        for table_name, row_count in import_tables(arguments.path, arguments.replace).items():
+            print(f"{table_name}: {row_count} rows imported")
+    print(f"Done in {time.perf_counter() - start:.3f}s")
@@ -0,0 +1,196 @@
+"""
+The single database of the movie app.
+Users and their movies share one file, so the movies reference their user
+with a foreign key and deleting a user is one transaction.
+The former data/users.db is imported once by the schema migrations.
+
+The engine is only created, when get_engine() is called the first time.
+Every engine is created by create_database_engine(), which tunes SQLite
+on connect. The settings can be changed per deployment with these
+environment variables:
+    MOVIES_DB_PATH          database file (data/movies.db)
+    MOVIES_DB_JOURNAL_MODE  WAL
+    MOVIES_DB_SYNCHRONOUS   NORMAL
+    MOVIES_DB_CACHE_SIZE    -16000 (negative: KiB, positive: pages)
+    MOVIES_DB_MMAP_SIZE     268435456 (bytes, 0 turns memory mapping off)
+    MOVIES_DB_TEMP_STORE    MEMORY
+    MOVIES_DB_POOL_SIZE     5 (connections kept open)
+    MOVIES_DB_BUSY_TIMEOUT  5000 (milliseconds SQLite waits for a lock)
+    MOVIES_DB_WRITE_RETRIES 5 (attempts to get the write lock after the busy timeout)
+
+Several processes can use the same file. Write transactions take the write
+lock when they start (BEGIN IMMEDIATE, see write_transaction()), so a writer
+never fails in the middle of a transaction, because another one got in first.
+"""
+import os
+import random
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.exc import OperationalError
+
+from storage import metrics
+
+JOURNAL_MODES = {"DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL", "OFF"}
+SYNCHRONOUS_MODES = {"OFF", "NORMAL", "FULL", "EXTRA"}
+TEMP_STORES = {"DEFAULT", "FILE", "MEMORY"}
+WRITE_RETRIES = int(os.environ.get("MOVIES_DB_WRITE_RETRIES", 5))
+# Seconds waited before the first retry, doubled on every further retry
+RETRY_BACKOFF = 0.05
+MAX_RETRY_BACKOFF = 2.0
+# SQLite allows only a limited number of variables per statement
+LOOKUP_CHUNK_SIZE = 500
+
+data_path = Path(__file__).resolve().parent.parent / "data"
+db_file = Path(os.environ.get("MOVIES_DB_PATH", data_path / "movies.db"))
+db_url = f"sqlite:///{db_file}"
+
+
+def _choice(name, default, choices):
+    """ Read an environment variable, that has to be one of the choices """
+    value = os.environ.get(name, default).upper()
+    if value not in choices:
+        raise ValueError(f"{name} has to be one of {', '.join(sorted(choices))}, not '{value}'")
+    return value
+
+
+def get_pragmas():
+    """ Return the SQLite pragmas of this deployment as {name: value} """
+    return {
+        "journal_mode": _choice("MOVIES_DB_JOURNAL_MODE", "WAL", JOURNAL_MODES),
+        "synchronous": _choice("MOVIES_DB_SYNCHRONOUS", "NORMAL", SYNCHRONOUS_MODES),
+        "cache_size": int(os.environ.get("MOVIES_DB_CACHE_SIZE", -16000)),
+        "mmap_size": int(os.environ.get("MOVIES_DB_MMAP_SIZE", 256 * 2 ** 20)),
+        "temp_store": _choice("MOVIES_DB_TEMP_STORE", "MEMORY", TEMP_STORES),
+        "busy_timeout": int(os.environ.get("MOVIES_DB_BUSY_TIMEOUT", 5000)),
+    }
+
+
+def create_database_engine(url, tuned=True, instrumented=True):
+    """
+    Create an engine, which enforces foreign keys
+    and lets SQLAlchemy control the transactions, also around schema changes.
+    tuned: apply the pragmas of get_pragmas() on every new connection
+    and keep MOVIES_DB_POOL_SIZE connections open
+    instrumented: time every statement with storage.metrics
+    """
+    pragmas = get_pragmas() if tuned else {}
+    engine = create_engine(url, pool_size=int(os.environ.get("MOVIES_DB_POOL_SIZE", 5)), max_overflow=10)
+
+    @event.listens_for(engine, "connect")
+    def _on_connect(dbapi_connection, connection_record):
+        # pysqlite would only start transactions before INSERT/UPDATE/DELETE
+        dbapi_connection.isolation_level = None
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA foreign_keys = ON;")
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name} = {value};")
+        cursor.close()
+
+    @event.listens_for(engine, "begin")
+    def _on_begin(connection):
+        # "IMMEDIATE" for the connections of write_transaction()
+        begin_mode = connection.get_execution_options().get("sqlite_begin")
+        connection.exec_driver_sql(f"BEGIN {begin_mode}" if begin_mode else "BEGIN")
+
+    if instrumented:
+        metrics.instrument_engine(engine)
+    return engine
+
+
+_engine = None
+
+
+def get_engine():
+    """ Return the engine of the app database, created on the first call """
+    global _engine
+    if _engine is None:
+        # Ensure data folder exists
+        db_file.parent.mkdir(parents=True, exist_ok=True)
+        _engine = create_database_engine(db_url)
+    return _engine
+
+
+def set_engine(engine):
+    """ Let the storage functions use another database, e.g. for benchmarks """
+    global _engine
+    _engine = engine
+
+
+def is_busy_error(error):
+    """ Return True, if a database error means another connection holds the lock """
+    message = str(getattr(error, "orig", error))
+    return isinstance(error, OperationalError) and ("locked" in message or "busy" in message)
+
+
+def retry_backoff(attempt):
+    """ Seconds to wait before retry number attempt (1, 2, ...), with jitter against lockstep retries """
+    return min(MAX_RETRY_BACKOFF, RETRY_BACKOFF * 2 ** (attempt - 1)) * random.uniform(0.5, 1.0)
+
+
+def begin_write(engine=None):
+    """
+    Connect and start a transaction, that holds the write lock from the start.
+    SQLite waits busy_timeout for the lock, afterward it is tried again
+    WRITE_RETRIES times with growing pauses.
+    Returns: Connection with the open transaction, the caller commits and closes it
+    """
+    engine = engine or get_engine()
+    attempt = 0
+    while True:
+        connection = engine.connect().execution_options(sqlite_begin="IMMEDIATE")
+        try:
+            connection.begin()
+            return connection
+        except OperationalError as e:
+            connection.close()
+            attempt += 1
+            if not is_busy_error(e) or attempt > WRITE_RETRIES:
+                raise
+            metrics.count("db_busy_retries_total", "begin_write")
+            time.sleep(retry_backoff(attempt))
+
+
+@contextmanager
+def write_transaction(engine=None):
+    """
+    Like engine.begin(), but the transaction holds the write lock from the start,
+    use it for every transaction, that writes. A transaction, which read first,
+    could otherwise not get the lock, when another process wrote in between.
+    """
+    connection = begin_write(engine)
+    try:
+        yield connection
+        connection.commit()
+    finally:
+        # Rolls back, if the transaction was not committed
+        connection.close()
+
+
+class CacheDatabase:
+    """
+    A SQLite file of its own in the data folder for a cache, which can be deleted any time.
+    The engine is only created and the tables only created, when it is used the first time.
+    schema: CREATE ... IF NOT EXISTS statements of the tables and indexes
+    """
+
+    def __init__(self, file_name, schema):
+        self.db_file = data_path / file_name
+        self.schema = schema
+        self.engine = None
+
+    def get_engine(self):
+        """ Return the engine of the cache file, created on the first call """
+        if self.engine is None:
+            self.db_file.parent.mkdir(parents=True, exist_ok=True)
+            self.set_engine(create_database_engine(f"sqlite:///{self.db_file}"))
+        return self.engine
+
+    def set_engine(self, engine):
+        """ Use another database for the cache, e.g. for benchmarks, its tables are created """
+        with write_transaction(engine) as connection:
+            for statement in self.schema:
+                connection.execute(text(statement))
+        self.engine = engine
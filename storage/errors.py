@@ -0,0 +1,38 @@
+"""
+Errors raised by the write functions of the storage layer,
+instead of printing the database error and carrying on.
+"""
+
+
+class StorageError(Exception):
+    """ A write to the movies database failed, its transaction was rolled back """
+
+
+class DuplicateMovieError(StorageError):
+    """ The user already saved a movie with this title """
+
+    def __init__(self, user_id, titles):
+        self.user_id = user_id
+        self.titles = list(titles)
+        super().__init__(f"User {user_id} already saved: {', '.join(self.titles)}")
+
+
+class UnknownUserError(StorageError):
+    """ A movie was written for a user_id, which is not in the users table """
+
+    def __init__(self, user_ids):
+        self.user_ids = sorted(set(user_ids))
+        super().__init__(f"Unknown user_id: {', '.join(map(str, self.user_ids))}")
+
+
+class DatabaseBusyError(StorageError):
+    """ Another connection held the lock on the database for too long """
+
+
+class VersionConflictError(StorageError):
+    """ A movie was updated by someone else since the version the update was based on """
+
+    def __init__(self, user_id, titles):
+        self.user_id = user_id
+        self.titles = list(titles)
+        super().__init__(f"Changed by someone else in the meantime: {', '.join(self.titles)}")
@@ -0,0 +1,30 @@
+"""
+Atomic writes of the files the app generates: websites, posters, charts and backups.
+A file is written under a temporary name in its folder and replaces the old file,
+once it is complete, so other threads and processes only ever see whole files.
+"""
+import os
+import tempfile
+from contextlib import contextmanager
+from pathlib import Path
+
+
+@contextmanager
+def atomic_path(file_path):
+    """
+    Yield the Path of a new temporary file next to file_path. It replaces file_path,
+    when the block ends without an error, and is removed otherwise.
+    Every call gets its own temporary file, so threads writing the same file don't collide.
+    """
+    file_path = Path(file_path)
+    handle, temp_name = tempfile.mkstemp(dir=file_path.parent, prefix=f".{file_path.name}.", suffix=".tmp")
+    os.close(handle)
+    temp_path = Path(temp_name)
+    try:
+        yield temp_path
+        # Temporary files are only readable by the owner
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, file_path)
+    except BaseException:
+        temp_path.unlink(missing_ok=True)
+        raise
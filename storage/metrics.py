@@ -0,0 +1,248 @@
+"""
+Timing and counting of everything the app does: SQL statements, storage
+functions, menu actions and API requests end up in latency histograms,
+failures in error counters. Recording is a few dict lookups, so it is always on.
+
+Opt-in with environment variables:
+    MOVIES_METRICS_FILE  write the metrics on exit, as JSON for *.json,
+                         otherwise in the Prometheus text format
+    MOVIES_PROFILE       run the app under cProfile and write the stats to this file
+                         (python -m pstats FILE to read them)
+    MOVIES_TRACE         print every timed operation and SQL statement to stderr
+"""
+import atexit
+import bisect
+import inspect
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from pathlib import Path
+
+PREFIX = "movies_"
+# Upper bounds in seconds, the last bucket takes everything slower
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# {name: (label name, help text)}
+HISTOGRAMS = {
+    "query_seconds": ("statement", "SQL statements by their first keyword"),
+    "operation_seconds": ("operation", "Storage functions"),
+    "menu_action_seconds": ("action", "Actions of the interactive menu"),
+    "api_request_seconds": ("route", "Requests to the HTTP API"),
+}
+COUNTERS = {
+    "errors_total": ("operation", "Failed storage functions and SQL statements"),
+    "api_responses_total": ("status", "Responses of the HTTP API by status code"),
+    "refresh_jobs_total": ("outcome", "Movies fetched again by the refresh worker"),
+    "db_busy_retries_total": ("operation", "Write transactions started again, because the database was locked"),
+}
+
+TRACE = bool(os.environ.get("MOVIES_TRACE"))
+
+_lock = threading.Lock()
+# {(name, label): Histogram}
+_histograms = {}
+# {(name, label): count}
+_counters = {}
+_profiler = None
+
+
+class Histogram:
+    """ Number of observations per bucket, with their count and sum """
+
+    def __init__(self):
+        self.bucket_counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.bucket_counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def quantile(self, fraction):
+        """ Upper bound of the bucket containing the quantile, None if nothing was observed """
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for bound, bucket_count in zip(BUCKETS + (float("inf"),), self.bucket_counts):
+            seen += bucket_count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+def observe(name, label, seconds):
+    """ Add a duration to the histogram name{label} """
+    with _lock:
+        histogram = _histograms.get((name, label))
+        if histogram is None:
+            histogram = _histograms[(name, label)] = Histogram()
+        histogram.observe(seconds)
+    if TRACE:
+        print(f"[trace] {name} {label} {seconds * 1000:.3f} ms", file=sys.stderr)
+
+
+def count(name, label, amount=1):
+    """ Increase the counter name{label} """
+    with _lock:
+        _counters[(name, label)] = _counters.get((name, label), 0) + amount
+
+
+@contextmanager
+def timer(name, label):
+    """ Time the with-block into the histogram name{label}, errors are counted as well """
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        count("errors_total", label)
+        raise
+    finally:
+        observe(name, label, time.perf_counter() - start)
+
+
+def timed(name="operation_seconds", label=None):
+    """
+    Decorator timing every call of a function or coroutine function,
+    labeled with module.function by default.
+    """
+    def decorate(function):
+        module = function.__module__.rsplit(".", 1)[-1]
+        function_label = label or (function.__name__ if module == "__main__" else f"{module}.{function.__name__}")
+
+        if inspect.iscoroutinefunction(function):
+            @wraps(function)
+            async def async_wrapper(*args, **kwargs):
+                with timer(name, function_label):
+                    return await function(*args, **kwargs)
+            return async_wrapper
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with timer(name, function_label):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def instrument_engine(engine):
+    """ Time and count every statement of an engine by its first keyword """
+    from sqlalchemy import event
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before_execute(connection, cursor, statement, parameters, context, executemany):
+        connection.info.setdefault("query_starts", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after_execute(connection, cursor, statement, parameters, context, executemany):
+        start = connection.info["query_starts"].pop()
+        observe("query_seconds", statement.lstrip().split(None, 1)[0].upper(), time.perf_counter() - start)
+
+    @event.listens_for(engine, "handle_error")
+    def _on_error(exception_context):
+        connection = exception_context.connection
+        if connection is not None and connection.info.get("query_starts"):
+            connection.info["query_starts"].pop()
+        count("errors_total", "query")
+
+
+def snapshot():
+    """
+    Return all metrics as one JSON object:
+    {"histograms": [{"name", "labels", "count", "sum", "p50", "p99", "buckets"}],
+     "counters": [{"name", "labels", "value"}]}
+    """
+    with _lock:
+        histograms = [{"name": PREFIX + name, "labels": {HISTOGRAMS[name][0]: label},
+                       "count": histogram.count, "sum": histogram.sum,
+                       "p50": histogram.quantile(0.5), "p99": histogram.quantile(0.99),
+                       "buckets": dict(zip([str(bound) for bound in BUCKETS] + ["+Inf"], histogram.bucket_counts))}
+                      for (name, label), histogram in sorted(_histograms.items())]
+        counters = [{"name": PREFIX + name, "labels": {COUNTERS[name][0]: label}, "value": value}
+                    for (name, label), value in sorted(_counters.items())]
+    return {"histograms": histograms, "counters": counters}
+
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def to_prometheus():
+    """ Return all metrics in the Prometheus text exposition format """
+    lines = []
+    with _lock:
+        for name, (label_name, help_text) in HISTOGRAMS.items():
+            series = sorted((label, histogram) for (metric, label), histogram in _histograms.items()
+                            if metric == name)
+            if not series:
+                continue
+            lines += [f"# HELP {PREFIX}{name} {help_text}", f"# TYPE {PREFIX}{name} histogram"]
+            for label, histogram in series:
+                labels = f'{label_name}="{_escape_label(label)}"'
+                cumulative = 0
+                for bound, bucket_count in zip([str(bound) for bound in BUCKETS] + ["+Inf"], histogram.bucket_counts):
+                    cumulative += bucket_count
+                    lines.append(f'{PREFIX}{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+                lines.append(f"{PREFIX}{name}_sum{{{labels}}} {histogram.sum}")
+                lines.append(f"{PREFIX}{name}_count{{{labels}}} {histogram.count}")
+        for name, (label_name, help_text) in COUNTERS.items():
+            series = sorted((label, value) for (metric, label), value in _counters.items() if metric == name)
+            if not series:
+                continue
+            lines += [f"# HELP {PREFIX}{name} {help_text}", f"# TYPE {PREFIX}{name} counter"]
+            lines += [f'{PREFIX}{name}{{{label_name}="{_escape_label(label)}"}} {value}' for label, value in series]
+    return "\n".join(lines) + "\n"
+
+
+def write_metrics(file_path):
+    """ Write the metrics to a file, as JSON for *.json, otherwise as Prometheus text """
+    file_path = Path(file_path)
+    file_path.parent.mkdir(parents=True, exist_ok=True)
+    if file_path.suffix == ".json":
+        file_path.write_text(json.dumps(snapshot(), indent=2), encoding="utf8")
+    else:
+        file_path.write_text(to_prometheus(), encoding="utf8")
+
+
+def reset():
+    """ Forget everything recorded so far """
+    with _lock:
+        _histograms.clear()
+        _counters.clear()
+
+
+def start_profiling():
+    """ Profile everything from now on with cProfile """
+    global _profiler
+    import cProfile
+    _profiler = cProfile.Profile()
+    _profiler.enable()
+
+
+def stop_profiling(file_path):
+    """ Stop the profiler and write its stats to file_path """
+    global _profiler
+    if _profiler is None:
+        return
+    _profiler.disable()
+    _profiler.dump_stats(file_path)
+    _profiler = None
+
+
+def setup_from_environment():
+    """
+    Start profiling with MOVIES_PROFILE and write the metrics to MOVIES_METRICS_FILE
+    and the profile, when the process exits. Called by the entry points.
+    """
+    profile_file = os.environ.get("MOVIES_PROFILE")
+    if profile_file:
+        start_profiling()
+        atexit.register(stop_profiling, profile_file)
+    metrics_file = os.environ.get("MOVIES_METRICS_FILE")
+    if metrics_file:
+        atexit.register(write_metrics, metrics_file)
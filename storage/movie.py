@@ -0,0 +1,81 @@
+"""
+The Movie record used everywhere in the app.
+Values from the OMDb-API are parsed once, when a movie is saved,
+so the database and every reader only see int years and float ratings.
+"""
+import re
+
+# Shown instead of a missing year or rating
+NOT_AVAILABLE = "N/A"
+
+_YEAR = re.compile(r"\d{4}")
+
+
+def parse_year(value):
+    """
+    Return the (first) year of an OMDb year like "1999" or "2010–2014" as int,
+    None if it has no year.
+    """
+    if isinstance(value, int):
+        return value
+    match = _YEAR.search(str(value or ""))
+    return int(match.group()) if match else None
+
+
+def parse_rating(value):
+    """ Return an OMDb rating like "8.7" as float, None for "N/A" or anything else """
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class Movie:
+    """
+    One saved movie. __slots__ keeps it at a fraction of the size of a dict,
+    which matters with a whole collection in the MovieCache.
+    year: int or None
+    rating: float or None
+    version: increased in the database by every comment update, see update_movie()
+    """
+    __slots__ = ("title", "year", "rating", "poster_url", "comment", "version")
+
+    def __init__(self, title, year=None, rating=None, poster_url="", comment="", version=1):
+        self.title = title
+        self.year = year
+        self.rating = rating
+        self.poster_url = poster_url
+        self.comment = comment
+        self.version = version
+
+    @classmethod
+    def from_omdb(cls, title, movie_data, comment=None):
+        """ Build a Movie from an answer of the OMDb-API, the comment defaults to the title """
+        return cls(title, parse_year(movie_data["Year"]), parse_rating(movie_data["imdbRating"]),
+                   movie_data["Poster"], title if comment is None else comment)
+
+    def __iter__(self):
+        """ Unpack like a database row: title, year, rating, poster_url, comment """
+        return iter((self.title, self.year, self.rating, self.poster_url, self.comment))
+
+    def __eq__(self, other):
+        if not isinstance(other, Movie):
+            return NotImplemented
+        return tuple(self) == tuple(other)
+
+    def __repr__(self):
+        return (f"Movie(title={self.title!r}, year={self.year!r}, rating={self.rating!r}, "
+                f"poster_url={self.poster_url!r}, comment={self.comment!r})")
+
+    @property
+    def display_year(self):
+        return NOT_AVAILABLE if self.year is None else self.year
+
+    @property
+    def display_rating(self):
+        return NOT_AVAILABLE if self.rating is None else self.rating
+
+    def as_dict(self):
+        """ Return the movie as one JSON object """
+        return {"title": self.title, "year": self.year, "rating": self.rating,
+                "poster_url": self.poster_url, "comment": self.comment}
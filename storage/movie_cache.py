@@ -0,0 +1,60 @@
+from itertools import count
+
+from storage.search_index import TitleIndex
+
+# Shared by all caches, so a reloaded cache never repeats an older generation
+_generations = count(1)
+
+
+class MovieCache:
+    """
+    In-memory copy of one user's movies as {title: Movie}.
+    Loaded once from the database, afterward the write functions
+    of movie_storage_sql keep it up to date, so reading it is O(1).
+    Every change increases the generation, a view that remembered an older
+    generation can find out with is_stale() that it has to be rebuilt.
+    """
+
+    def __init__(self, user_id, movies):
+        self.user_id = user_id
+        self.movies = movies
+        self.generation = next(_generations)
+        self._search_index = None
+
+    @property
+    def search_index(self):
+        """ TitleIndex of the cached titles, built on the first search """
+        if self._search_index is None:
+            self._search_index = TitleIndex(self.movies)
+        return self._search_index
+
+    def add(self, movie):
+        """ Add a Movie, that was just saved in the database """
+        self.movies[movie.title] = movie
+        if self._search_index is not None:
+            self._search_index.add(movie.title)
+        self.generation = next(_generations)
+
+    def delete(self, title):
+        """ Remove a movie, that was just deleted from the database """
+        if self.movies.pop(title, None) is not None:
+            if self._search_index is not None:
+                self._search_index.remove(title)
+            self.generation = next(_generations)
+
+    def update_comment(self, title, comment):
+        """ Change the comment of a movie, that was just updated in the database """
+        if title in self.movies:
+            self.movies[title].comment = comment
+            self.movies[title].version += 1
+            self.generation = next(_generations)
+
+    def replace(self, movie):
+        """ Put a Movie, whose data was fetched again, in place of the cached one """
+        if movie.title in self.movies:
+            self.movies[movie.title] = movie
+            self.generation = next(_generations)
+
+    def is_stale(self, generation):
+        """ Return True, if the cache changed since the given generation """
+        return generation != self.generation
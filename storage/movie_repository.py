@@ -0,0 +1,81 @@
+"""
+Typed access to the movies of one user.
+Reads are answered from the user's MovieCache, writes go through
+movie_storage_sql, which keeps that cache up to date.
+"""
+from storage import movie_storage_sql as storage
+from storage import movie_stats
+
+
+class MovieRepository:
+    """
+    The movies of one user as Movie records, looked up by title.
+    Iterating it yields the cached movies, stream() reads them
+    from the database ordered by title instead.
+    """
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+
+    @property
+    def _movies(self):
+        # Fetched on every access, add_many() replaces the cache of the user
+        return storage.get_movie_cache(self.user_id).movies
+
+    def __len__(self):
+        return len(self._movies)
+
+    def __contains__(self, title):
+        return title in self._movies
+
+    def __getitem__(self, title):
+        return self._movies[title]
+
+    def __iter__(self):
+        return iter(self._movies.values())
+
+    def get(self, title, default=None):
+        return self._movies.get(title, default)
+
+    def titles(self):
+        return list(self._movies)
+
+    def stream(self):
+        """ Yield the movies from the database ordered by title, a page at a time """
+        return storage.iter_movies(self.user_id)
+
+    def add(self, movie):
+        """ Save a new Movie, raises DuplicateMovieError if the title is already saved """
+        storage.add_movie(self.user_id, movie)
+
+    def add_many(self, movies):
+        """ Save many Movies in one transaction, returns the number of added movies """
+        return storage.add_movies(self.user_id, movies)
+
+    def delete(self, title):
+        """ Returns: True if the movie was deleted """
+        return storage.delete_movie(title, self.user_id)
+
+    def update_comment(self, title, comment, version=None):
+        """
+        With the version of the Movie the comment is based on, raises
+        VersionConflictError if the movie was updated since.
+        Returns: True if the movie was updated
+        """
+        return storage.update_movie(title, comment, self.user_id, version)
+
+    def search(self, query):
+        """
+        Fuzzy search in the titles.
+        Returns: [(Movie, score(float))] the best matches first
+        """
+        movie_cache = storage.get_movie_cache(self.user_id)
+        return [(movie_cache.movies[title], score) for title, score in movie_cache.search_index.search(query)]
+
+    def stats(self):
+        """ The MovieStats of the rated movies """
+        return movie_stats.get_movie_stats(self.user_id)
+
+    def ranked(self):
+        """ Returns: [Movie] from the best to the worst rating, unrated movies last """
+        return movie_stats.ranked_movies(self.user_id)
@@ -0,0 +1,130 @@
+"""
+Rating statistics of a user, read from the user_stats and user_rating_histogram
+tables, which triggers on the movies table keep up to date (see storage.schema).
+A summary costs a few index lookups, however many movies the user saved.
+
+Check the aggregates against the movies table, or compute them again, with:
+    python -m storage.movie_stats [--rebuild]
+"""
+import sys
+
+from sqlalchemy import text
+
+from storage import schema
+from storage.database import get_engine, write_transaction
+from storage.movie import Movie
+
+# Tolerated difference of the stored rating sum, which adds and subtracts floats
+RATING_SUM_TOLERANCE = 1e-6
+
+
+class MovieStats:
+    """
+    Summary of the ratings of one user, shared by the stats and histogram menu actions.
+    histogram: {rating: number of movies}, from the lowest to the highest rating
+    best_movies, worst_movies: [(title, year, rating)]
+    """
+
+    def __init__(self, count, rating_sum, min_rating, max_rating, histogram, best_movies, worst_movies):
+        self.count = count
+        self.histogram = histogram
+        self.max_rating = max_rating
+        self.min_rating = min_rating
+        self.best_movies = best_movies
+        # With only one rating every movie counts as best
+        self.worst_movies = worst_movies if min_rating != max_rating else []
+        if not count:
+            self.average = self.median = None
+            return
+        self.average = rating_sum / count
+        self.median = (_nth_rating(histogram, (count - 1) // 2) + _nth_rating(histogram, count // 2)) / 2
+
+
+def _nth_rating(histogram, position):
+    """ Return the rating at position of all ratings sorted from the lowest """
+    seen = 0
+    for rating, count in histogram.items():
+        seen += count
+        if seen > position:
+            return rating
+    raise IndexError(position)
+
+
+def _movies_with_rating(connection, user_id, rating):
+    """ Return [(title, year, rating)] of the user's movies with exactly this rating, ordered by title """
+    # Sorted here, with ORDER BY title SQLite would walk the title index instead of the rating index
+    return sorted(tuple(row) for row in connection.execute(
+        text("SELECT title, year, rating FROM movies WHERE user_id = :user_id AND rating = :rating"),
+        {"user_id": user_id, "rating": rating}))
+
+
+def get_movie_stats(user_id):
+    """ Read the MovieStats of a user from the aggregate tables """
+    with get_engine().connect() as connection:
+        row = connection.execute(text("SELECT rated_count, rating_sum, min_rating, max_rating "
+                                      "FROM user_stats WHERE user_id = :user_id"), {"user_id": user_id}).first()
+        if row is None or not row[0]:
+            return MovieStats(0, 0.0, None, None, {}, [], [])
+        count, rating_sum, min_rating, max_rating = row
+        histogram = {bucket / 10: movie_count for bucket, movie_count in connection.execute(
+            text("SELECT bucket, movie_count FROM user_rating_histogram WHERE user_id = :user_id ORDER BY bucket"),
+            {"user_id": user_id})}
+        best_movies = _movies_with_rating(connection, user_id, max_rating)
+        worst_movies = _movies_with_rating(connection, user_id, min_rating) if min_rating != max_rating else []
+    return MovieStats(count, rating_sum, min_rating, max_rating, histogram, best_movies, worst_movies)
+
+
+def ranked_movies(user_id):
+    """
+    Read the movies of a user in the order of the (user_id, rating) index.
+    Returns: [Movie] from the best to the worst rating, unrated movies last
+    """
+    with get_engine().connect() as connection:
+        result = connection.execute(text("SELECT title, year, rating, poster_url, comment, version FROM movies "
+                                         "WHERE user_id = :user_id ORDER BY rating DESC"), {"user_id": user_id})
+        return [Movie(*row) for row in result]
+
+
+def check_user_stats():
+    """
+    Compare the aggregate tables with the movies table.
+    Returns: sorted [user_id] of the users with wrong aggregates
+    """
+    with get_engine().connect() as connection:
+        expected = {row[0]: row[1:] for row in connection.execute(text(
+            "SELECT user_id, COUNT(*), COUNT(rating), COALESCE(SUM(rating), 0), MIN(rating), MAX(rating) "
+            "FROM movies GROUP BY user_id"))}
+        stored = {row[0]: row[1:] for row in connection.execute(text(
+            "SELECT user_id, movie_count, rated_count, rating_sum, min_rating, max_rating FROM user_stats "
+            "WHERE movie_count != 0"))}
+        expected_histograms = set(connection.execute(text(
+            "SELECT user_id, CAST(ROUND(rating * 10) AS INTEGER), COUNT(*) FROM movies "
+            "WHERE rating IS NOT NULL GROUP BY 1, 2")))
+        stored_histograms = set(connection.execute(text(
+            "SELECT user_id, bucket, movie_count FROM user_rating_histogram")))
+    wrong_users = {user_id for user_id, _, _ in expected_histograms ^ stored_histograms}
+    for user_id in expected.keys() | stored.keys():
+        if user_id not in expected or user_id not in stored:
+            wrong_users.add(user_id)
+            continue
+        movie_count, rated_count, rating_sum, min_rating, max_rating = expected[user_id]
+        stored_count, stored_rated, stored_sum, stored_min, stored_max = stored[user_id]
+        if ((movie_count, rated_count, min_rating, max_rating) != (stored_count, stored_rated, stored_min, stored_max)
+                or abs(rating_sum - stored_sum) > RATING_SUM_TOLERANCE * max(1.0, abs(rating_sum))):
+            wrong_users.add(user_id)
+    return sorted(wrong_users)
+
+
+def rebuild_user_stats():
+    """ Compute the aggregate tables again from the movies table """
+    with write_transaction() as connection:
+        schema.rebuild_user_stats(connection)
+
+
+if __name__ == "__main__":
+    schema.migrate(get_engine())
+    if "--rebuild" in sys.argv[1:]:
+        rebuild_user_stats()
+    wrong_user_ids = check_user_stats()
+    print(f"Wrong aggregates of users: {wrong_user_ids}" if wrong_user_ids else "Aggregates are consistent")
+    sys.exit(1 if wrong_user_ids else 0)
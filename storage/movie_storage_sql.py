@@ -1,91 +1,524 @@
-from numpy import integer
-from pygments.styles.dracula import comment
-from sqlalchemy import create_engine, text
+import threading
+import time
+from contextlib import contextmanager
+from itertools import groupby
+from operator import itemgetter
+
+from sqlalchemy import bindparam, text
+from sqlalchemy.exc import DBAPIError, IntegrityError
 from termcolor import cprint
-from pathlib import Path
+from storage import metrics, schema
+from storage.database import LOOKUP_CHUNK_SIZE, begin_write, get_engine, is_busy_error
+from storage.errors import (DatabaseBusyError, DuplicateMovieError, StorageError, UnknownUserError,
+                            VersionConflictError)
+from storage.movie import Movie
+from storage.movie_cache import MovieCache
 
-# Ensure data folder exists
-data_path = Path(__file__).resolve().parent.parent / "data"
-data_path.mkdir(exist_ok=True)
-# Create and return engine
-db_file = data_path / "movies.db"
-db_url = f"sqlite:///{db_file}"
-movie_engine = create_engine(db_url)
+# One MovieCache per user_id, filled by get_movie_cache()
+movie_caches = {}
+# Rows read per query by iter_movies()
+STREAM_BATCH_SIZE = 500
+# Increased whenever movies are added or removed, also by another process, for views over all users
+write_generation = 0
+# Value of the data_changes counter, the movie_caches are up to date with
+seen_changes = None
+# (engine, DBAPI connection) kept open to read the counter, see data_changes()
+_changes_connection = None
+_changes_lock = threading.Lock()
 
 
 def create_table(user_id):
-    sql_query = f"""
-        CREATE TABLE IF NOT EXISTS movies (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL ,
-            title TEXT NOT NULL,
-            year INTEGER NOT NULL,
-            rating REAL NOT NULL DEFAULT 0.0,
-            poster_url TEXT,
-            comment DEFAULT ''
-        );
-    """
-    with movie_engine.begin() as conn:
-        conn.execute(text(sql_query))
-        conn.commit()
+    """ Create the movies table or upgrade it to the newest schema version """
+    schema.migrate(get_engine())
     return
 
 
+@metrics.timed()
 def list_movies(user_id):
-    """ Retrieve all movies from the database."""
-    with movie_engine.connect() as movie_connection:
+    """
+    Retrieve all movies of a user from the database.
+    Returns: {title: Movie}
+    """
+    with get_engine().connect() as movie_connection:
         try:
-            result = movie_connection.execute(text(f"SELECT title, year, rating, poster_url, comment FROM movies WHERE user_id = :user_id"),
+            result = movie_connection.execute(text("SELECT title, year, rating, poster_url, comment, version FROM movies WHERE user_id = :user_id"),
                                              {"user_id": user_id})
-            movies_data = result.fetchall()
-            return {row[0]: {"year": row[1], "rating": row[2], "poster_url": row[3], "comment": row[4]} for row in movies_data}
+            return {row[0]: Movie(*row) for row in result}
         except Exception as e:
+            metrics.count("errors_total", "movie_storage_sql.list_movies")
             cprint(f"Error: {e}", 'red')
 
 
-def add_movie(user_id, title, year, rating, poster_url, comment="" ):
-    """ Add a new movie to the database, based on the current user_id """
-    with movie_engine.connect() as movie_connection:
+@metrics.timed()
+def list_movies_page(user_id, after_title=None, limit=STREAM_BATCH_SIZE):
+    """
+    Retrieve the next movies of a user ordered by title, starting after after_title.
+    The (user_id, title) index finds the start of the page directly,
+    so every page is as fast as the first one.
+    Returns: [Movie] with at most limit rows
+    """
+    query = "SELECT title, year, rating, poster_url, comment, version FROM movies WHERE user_id = :user_id "
+    if after_title is not None:
+        query += "AND title > :after_title "
+    query += "ORDER BY title LIMIT :limit"
+    with get_engine().connect() as movie_connection:
+        result = movie_connection.execute(text(query), {"user_id": user_id, "after_title": after_title,
+                                                        "limit": limit})
+        return [Movie(*row) for row in result]
+
+
+def iter_movies(user_id, batch_size=STREAM_BATCH_SIZE):
+    """
+    Yield the movies of a user as Movie ordered by title.
+    Only one page of batch_size rows is in memory at a time.
+    """
+    after_title = None
+    while True:
+        page = list_movies_page(user_id, after_title, batch_size)
+        yield from page
+        if len(page) < batch_size:
+            return
+        after_title = page[-1].title
+
+
+class MovieStream:
+    """ The movies of a user, streamed again from the database on every iteration """
+
+    def __init__(self, user_id, batch_size=STREAM_BATCH_SIZE):
+        self.user_id = user_id
+        self.batch_size = batch_size
+
+    def __iter__(self):
+        return iter_movies(self.user_id, self.batch_size)
+
+
+@metrics.timed()
+def list_all_movies():
+    """
+    Retrieve the movies of every user with one query.
+    Returns: {user_id: [Movie]} ordered by title
+    """
+    movies_by_user = {}
+    with get_engine().connect() as movie_connection:
+        result = movie_connection.execute(text("SELECT user_id, title, year, rating, poster_url, comment, version "
+                                               "FROM movies ORDER BY user_id, title"))
+        for row in result:
+            movies_by_user.setdefault(row[0], []).append(Movie(*row[1:]))
+    return movies_by_user
+
+
+def _movies_changed():
+    global write_generation
+    write_generation += 1
+
+
+_READ_CHANGES = "SELECT counter FROM data_changes"
+
+
+def _read_changes(connection):
+    return connection.exec_driver_sql(_READ_CHANGES).scalar()
+
+
+def data_changes():
+    """
+    Return the counter of changed movies and users rows, increased by triggers
+    in the transaction of every change, whichever process committed it.
+    It is read on a connection kept open for it, which takes a few microseconds.
+    """
+    global _changes_connection
+    engine = get_engine()
+    with _changes_lock:
+        if _changes_connection is None or _changes_connection[0] is not engine:
+            if _changes_connection is not None:
+                _changes_connection[1].close()
+            _changes_connection = (engine, engine.raw_connection())
+        cursor = _changes_connection[1].cursor()
         try:
-            movie_connection.execute(text(f"INSERT INTO movies (title, year, rating, poster_url, user_id, comment) VALUES (:title, :year, :rating, :poster_url, :user_id, :comment)"),
-                               {"title": title, "year": year, "rating": rating, "poster_url": poster_url, "user_id": user_id, "comment": comment})
-            movie_connection.commit()
-        except Exception as e:
-            cprint(f"Error: {e}", "red")
-    return
+            # fetchall() ends the read transaction right away
+            return cursor.execute(_READ_CHANGES).fetchall()[0][0]
+        finally:
+            cursor.close()
 
 
-def delete_movie(title, user_id):
-    """ Delete a movie from the database, based on the current user_id """
-    with movie_engine.connect() as movie_connection:
+def check_data_changes():
+    """
+    Drop all MovieCaches and increase write_generation,
+    if movies or users were changed since the caches were loaded,
+    by another process or by a write, that didn't update the caches.
+    Returns: the current data_changes() counter
+    """
+    global seen_changes
+    changes = data_changes()
+    if changes != seen_changes:
+        # Read before the caches are filled again, a change in between only reloads them once more
+        seen_changes = changes
+        movie_caches.clear()
+        _movies_changed()
+    return changes
+
+
+def get_movie_cache(user_id):
+    """
+    Return the MovieCache of a user, the movies are only loaded
+    from the database the first time it is requested
+    and again after any process changed the movies (check_data_changes()).
+    If loading failed, an empty MovieCache is returned without keeping it,
+    so the next request reads the database again.
+    """
+    check_data_changes()
+    # Looked up once, another thread may clear movie_caches in between
+    movie_cache = movie_caches.get(user_id)
+    if movie_cache is None:
+        movies = list_movies(user_id)
+        if movies is None:
+            return MovieCache(user_id, {})
+        movie_cache = movie_caches[user_id] = MovieCache(user_id, movies)
+    return movie_cache
+
+
+class UnitOfWork:
+    """
+    Groups many writes into one transaction:
+        with UnitOfWork() as work:
+            work.add_movie(user_id, movie)
+            work.delete_movie(title, user_id)
+    Writes are queued and sent with one executemany per run of writes of the same kind,
+    when flush() is called or the block ends. The transaction only starts with
+    the first flush and holds the write lock of the database from then on
+    (storage.database.begin_write), so other processes wait for it, instead of
+    failing halfway. It is committed at the end of the block and rolled back,
+    if the block raised. Writes in a "with work.savepoint():" block are rolled
+    back alone, when it raises.
+    Failed writes raise a storage.errors.StorageError, the writes queued behind
+    them are discarded. The MovieCaches are only changed after the commit,
+    they are dropped instead, if another process changed the movies since they were loaded.
+    rowcount: number of rows changed by the flushed writes
+    """
+
+    def __init__(self):
+        self.connection = None
+        self.rowcount = 0
+        # data_changes counter at the start and the end of the transaction
+        self._changes_before = self._changes_after = None
+        # [(kind, parameters, Movie or None)]
+        self._pending = []
+        self._flushed = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
         try:
-            movie_connection.execute(text(f"DELETE FROM movies WHERE title = :title AND user_id = :user_id"),
-                               {"title": title, "user_id": user_id})
-            movie_connection.commit()
-        except Exception as e:
-            cprint(f"Error: {e}", "red")
-    return
+            if exc_type is None:
+                self.flush()
+                if self.connection is not None:
+                    try:
+                        self._changes_after = _read_changes(self.connection)
+                        self.connection.commit()
+                    except DBAPIError as e:
+                        raise _storage_error(e) from e
+        finally:
+            # Rolls back the transaction, if it was not committed
+            if self.connection is not None:
+                self.connection.close()
+        if exc_type is None:
+            self._update_caches()
+        return False
+
+    def _connect(self):
+        if self.connection is None:
+            try:
+                self.connection = begin_write()
+                self._changes_before = _read_changes(self.connection)
+            except DBAPIError as e:
+                raise _storage_error(e) from e
+        return self.connection
+
+    def add_movie(self, user_id, movie):
+        """ Queue a new Movie, flushing it raises DuplicateMovieError if the title is already saved """
+        self._pending.append(("add", dict(movie.as_dict(), user_id=user_id, fetched_at=time.time()), movie))
+
+    def add_movies(self, user_id, movies, skip_existing=False):
+        """ Queue many new Movies, with skip_existing titles the user already saved are left out silently """
+        fetched_at = time.time()
+        kind = "add_new" if skip_existing else "add"
+        self._pending.extend((kind, dict(movie.as_dict(), user_id=user_id, fetched_at=fetched_at), movie)
+                             for movie in movies)
+
+    def save_movies(self, user_id, movies):
+        """
+        Queue an upsert of many Movies: new titles are inserted, saved ones
+        get the new year, rating and poster, but keep their comment.
+        """
+        fetched_at = time.time()
+        self._pending.extend(("save", dict(movie.as_dict(), user_id=user_id, fetched_at=fetched_at), movie)
+                             for movie in movies)
 
+    def update_movie(self, title, comment, user_id, version=None):
+        """
+        Queue a comment update. With the version the movie was read with,
+        flushing it raises VersionConflictError, if it was updated since.
+        """
+        self._pending.append(("update", {"title": title, "comment": comment, "user_id": user_id,
+                                         "version": version}, None))
 
-def update_movie(title, comment, user_id):
-    """Update a movie's rating in the database, based on the current user_id """
-    with movie_engine.connect() as movie_connection:
+    def delete_movie(self, title, user_id):
+        self._pending.append(("delete", {"title": title, "user_id": user_id}, None))
+
+    def delete_user_movies(self, user_id):
+        self._pending.append(("delete_user", {"user_id": user_id}, None))
+
+    def saved_titles(self, user_id, titles):
+        """
+        Read which of the titles the user saved, after the queued writes.
+        The transaction holds the write lock from then on, so no other process
+        can change them before the commit.
+        Returns: set of titles
+        """
+        self.flush()
+        connection = self._connect()
+        query = text("SELECT title FROM movies WHERE user_id = :user_id AND title IN :titles").bindparams(
+            bindparam("titles", expanding=True))
+        titles = list(titles)
+        found = set()
+        for start in range(0, len(titles), LOOKUP_CHUNK_SIZE):
+            found.update(connection.execute(query, {"user_id": user_id,
+                                                    "titles": titles[start:start + LOOKUP_CHUNK_SIZE]}).scalars())
+        return found
+
+    def flush(self):
+        """
+        Send the queued writes, every run of writes of the same kind
+        with one executemany inside its own savepoint.
+        Returns: number of changed rows (int)
+        """
+        if not self._pending:
+            return 0
+        connection = self._connect()
+        pending, self._pending = self._pending, []
+        changed = 0
+        for kind, group in groupby(pending, key=itemgetter(0)):
+            group = list(group)
+            try:
+                if kind == "update":
+                    _check_versions(connection, group)
+                with connection.begin_nested():
+                    result = connection.execute(_WRITE_STATEMENTS[kind], [row for _, row, _ in group])
+            except VersionConflictError as e:
+                # The cached version is outdated, the next read loads the current one
+                clear_movie_cache(e.user_id)
+                raise
+            except DBAPIError as e:
+                raise _storage_error(e, connection, group) from e
+            changed += result.rowcount
+            self._flushed.extend(group)
+        self.rowcount += changed
+        return changed
+
+    @contextmanager
+    def savepoint(self):
+        """ Roll back only the writes of this block, if it raises, the error is raised again """
+        self.flush()
+        flushed = len(self._flushed)
+        rowcount = self.rowcount
+        savepoint = self._connect().begin_nested()
         try:
-            movie_connection.execute(text(f"UPDATE movies SET comment = :comment WHERE title = :title AND user_id = :user_id"),
-                               {"comment": comment, "title": title, "user_id": user_id})
-            movie_connection.commit()
-        except Exception as e:
-            cprint(f"Error: {e}", "red")
-    return
+            yield self
+            self.flush()
+        except BaseException:
+            savepoint.rollback()
+            del self._flushed[flushed:]
+            self._pending.clear()
+            self.rowcount = rowcount
+            raise
+        savepoint.commit()
+
+    def _update_caches(self):
+        global seen_changes
+        if self._changes_after == self._changes_before:
+            return
+        if self._changes_before != seen_changes:
+            # Someone else changed the movies before this transaction, the caches are outdated
+            movie_caches.clear()
+            _movies_changed()
+            return
+        # Only this transaction changed the movies since the caches were loaded
+        seen_changes = self._changes_after
+        movies_changed = False
+        for kind, row, movie in self._flushed:
+            user_id = row["user_id"]
+            movies_changed = movies_changed or kind != "update"
+            if kind in ("add_new", "save", "delete_user"):
+                # Reloaded on the next request, instead of finding out which rows were skipped
+                movie_caches.pop(user_id, None)
+                continue
+            movie_cache = movie_caches.get(user_id)
+            if movie_cache is None:
+                continue
+            if kind == "add":
+                movie_cache.add(movie)
+            elif kind == "update":
+                movie_cache.update_comment(row["title"], row["comment"])
+            elif kind == "delete":
+                movie_cache.delete(row["title"])
+        if movies_changed:
+            _movies_changed()
+
+
+_INSERT_MOVIE = ("INSERT INTO movies (title, year, rating, poster_url, user_id, comment, fetched_at) "
+                 "VALUES (:title, :year, :rating, :poster_url, :user_id, :comment, :fetched_at)")
+_WRITE_STATEMENTS = {
+    "add": text(_INSERT_MOVIE),
+    # Only the unique title of a user is skipped, unlike INSERT OR IGNORE, which skips any failing row
+    "add_new": text(_INSERT_MOVIE + " ON CONFLICT (user_id, title) DO NOTHING"),
+    "save": text(_INSERT_MOVIE + " ON CONFLICT (user_id, title) DO UPDATE SET year = excluded.year, "
+                 "rating = excluded.rating, poster_url = excluded.poster_url, fetched_at = excluded.fetched_at"),
+    "update": text("UPDATE movies SET comment = :comment, version = version + 1 "
+                   "WHERE title = :title AND user_id = :user_id AND (:version IS NULL OR version = :version)"),
+    "delete": text("DELETE FROM movies WHERE title = :title AND user_id = :user_id"),
+    "delete_user": text("DELETE FROM movies WHERE user_id = :user_id"),
+}
+
+
+def _check_versions(connection, group):
+    """
+    Raise VersionConflictError, if a versioned update in group was based on an older version.
+    The transaction holds the write lock, so the versions can't change before the update.
+    """
+    versions = {}
+    conflicts = {}
+    for _, row, _ in group:
+        key = (row["user_id"], row["title"])
+        if row["version"] is None and key not in versions:
+            continue
+        if key not in versions:
+            versions[key] = connection.execute(
+                text("SELECT version FROM movies WHERE user_id = :user_id AND title = :title"), row).scalar()
+        current = versions[key]
+        if current is None:
+            # Not saved, the update changes nothing
+            continue
+        if row["version"] is not None and row["version"] != current:
+            conflicts.setdefault(row["user_id"], []).append(row["title"])
+        versions[key] = current + 1
+    if conflicts:
+        user_id, titles = next(iter(conflicts.items()))
+        raise VersionConflictError(user_id, titles)
 
 
+def _storage_error(error, connection=None, group=()):
+    """ Translate a DBAPIError of the writes in group into a StorageError """
+    message = str(error.orig)
+    if isinstance(error, IntegrityError) and group:
+        # The savepoint of the group was rolled back, so the database shows the state before it
+        if "UNIQUE" in message:
+            seen = set()
+            duplicates = {}
+            for _, row, _ in group:
+                key = (row["user_id"], row["title"])
+                exists = key in seen or connection.execute(
+                    text("SELECT 1 FROM movies WHERE user_id = :user_id AND title = :title"), row).first()
+                if exists:
+                    duplicates.setdefault(row["user_id"], []).append(row["title"])
+                seen.add(key)
+            if duplicates:
+                user_id, titles = next(iter(duplicates.items()))
+                return DuplicateMovieError(user_id, titles)
+        if "FOREIGN KEY" in message:
+            user_ids = {row["user_id"] for _, row, _ in group}
+            known = {user_id for user_id in user_ids if connection.execute(
+                text("SELECT 1 FROM users WHERE user_id = :user_id"), {"user_id": user_id}).first()}
+            return UnknownUserError(user_ids - known)
+    if is_busy_error(error):
+        return DatabaseBusyError(message)
+    return StorageError(message)
+
+
+@metrics.timed()
+def add_movie(user_id, movie):
+    """
+    Add a new Movie to the database, based on the current user_id
+    Raises DuplicateMovieError, if the user already saved a movie with this title.
+    """
+    with UnitOfWork() as work:
+        work.add_movie(user_id, movie)
+
+
+@metrics.timed()
+def add_movies(user_id, movies):
+    """
+    Add many movies in one transaction, titles the user already saved are skipped.
+    movies: list of Movie
+    Returns: number of added movies (int)
+    """
+    with UnitOfWork() as work:
+        work.add_movies(user_id, movies, skip_existing=True)
+    return work.rowcount
+
+
+@metrics.timed()
+def delete_movie(title, user_id):
+    """
+    Delete a movie from the database, based on the current user_id
+    Returns: True if the movie was deleted
+    """
+    with UnitOfWork() as work:
+        work.delete_movie(title, user_id)
+    return work.rowcount > 0
+
+
+@metrics.timed()
+def save_movies(user_id, movies):
+    """
+    Insert new movies and update year, rating and poster of saved ones in one transaction,
+    the database decides which titles exist, saved comments are kept.
+    Returns: number of inserted or updated movies (int)
+    """
+    with UnitOfWork() as work:
+        work.save_movies(user_id, movies)
+    return work.rowcount
+
+
+@metrics.timed()
+def update_movie(title, comment, user_id, version=None):
+    """
+    Update a movie's comment in the database, based on the current user_id
+    version: the Movie.version the new comment is based on, None overwrites any version
+    Raises VersionConflictError, if the movie was updated since that version.
+    Returns: True if the movie was updated
+    """
+    with UnitOfWork() as work:
+        work.update_movie(title, comment, user_id, version)
+    return work.rowcount > 0
+
+
+def refresh_cached_movies(movies_by_user):
+    """
+    Replace movies, which storage.refresh_worker fetched again, in the loaded caches.
+    movies_by_user: {user_id: [Movie]}
+    """
+    for user_id, movies in movies_by_user.items():
+        movie_cache = movie_caches.get(user_id)
+        if movie_cache is not None:
+            for movie in movies:
+                movie_cache.replace(movie)
+    _movies_changed()
+
+
+def clear_movie_cache(user_id):
+    """
+    Forget the cached movies of a user, they are loaded again when requested.
+    Called after bulk writes, which don't update the cache.
+    """
+    movie_caches.pop(user_id, None)
+    _movies_changed()
+
+
+@metrics.timed()
 def delete_user_movies(user_id):
-    """ Delete movies from the database with the deleted user_id """
-    with movie_engine.connect() as movie_connection:
-        try:
-            movie_connection.execute(text("DELETE FROM movies WHERE user_id = :user_id"),
-                                    {"user_id": user_id})
-            movie_connection.commit()
-        except Exception as e:
-            cprint(f"Error: {e}", 'red')
-        return
+    """
+    Delete movies from the database with the deleted user_id
+    Deleting the user itself removes its movies as well.
+    """
+    with UnitOfWork() as work:
+        work.delete_user_movies(user_id)
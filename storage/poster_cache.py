@@ -0,0 +1,223 @@
+"""
+Local copies of the poster images for the generated websites.
+Every poster is downloaded once, stored under _static/posters by the
+SHA-256 of its content and shrunk to a thumbnail for the movie grid.
+Which url points to which file is kept in their own SQLite file.
+Once the files exceed CACHE_MAX_BYTES, the posters used least recently are evicted,
+except the ones a saved movie of any user still links.
+Thumbnails need Pillow, without it the pages show the downloaded original.
+"""
+import hashlib
+import io
+import os
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from sqlalchemy import text, bindparam
+
+from storage import api_data_handling as api
+from storage.database import LOOKUP_CHUNK_SIZE, CacheDatabase, get_engine, write_transaction
+from storage.files import atomic_path
+
+POSTER_PATH = Path(__file__).resolve().parent.parent / "_static" / "posters"
+CACHE_MAX_BYTES = int(os.environ.get("POSTER_CACHE_MAX_MB", 200)) * 1024 * 1024
+# Twice the size of the poster in the grid, sharp on high resolution screens
+THUMBNAIL_SIZE = (256, 386)
+THUMBNAIL_QUALITY = 85
+MAX_IN_FLIGHT = 8
+
+cache_database = CacheDatabase("poster_cache.db", [
+    """
+    CREATE TABLE IF NOT EXISTS poster_cache (
+        url TEXT PRIMARY KEY,
+        digest TEXT NOT NULL,
+        image_name TEXT NOT NULL,
+        thumbnail_name TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        used_at REAL NOT NULL
+    );
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_poster_cache_used_at ON poster_cache (used_at);",
+    "CREATE INDEX IF NOT EXISTS idx_poster_cache_digest ON poster_cache (digest);",
+])
+get_cache_engine = cache_database.get_engine
+
+# image and thumbnail are paths below POSTER_PATH
+CachedPoster = namedtuple("CachedPoster", ["image", "thumbnail"])
+
+
+def _file_path(poster_path, name):
+    """ Spread the files over folders named by the first two hex digits """
+    return Path(poster_path) / name[:2] / name
+
+
+def _write_file(file_path, content):
+    """
+    Write content atomically, a content addressed file never changes afterward.
+    Threads storing the same poster write their own temporary file,
+    if replacing the file fails, because another one got there first, it is stored anyway.
+    """
+    if file_path.exists():
+        return
+    file_path.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        with atomic_path(file_path) as temp_path:
+            temp_path.write_bytes(content)
+    except OSError:
+        if not file_path.exists():
+            raise
+
+
+def make_thumbnail(content):
+    """
+    Shrink an image to fit into THUMBNAIL_SIZE.
+    Returns: the JPEG bytes or None, if Pillow is missing or can't read the image
+    """
+    try:
+        from PIL import Image
+    except ImportError:
+        return None
+    try:
+        with Image.open(io.BytesIO(content)) as image:
+            image.thumbnail(THUMBNAIL_SIZE)
+            output = io.BytesIO()
+            image.convert("RGB").save(output, "JPEG", quality=THUMBNAIL_QUALITY, optimize=True)
+    except (OSError, ValueError):
+        return None
+    return output.getvalue()
+
+
+def store_poster(content, extension, poster_path=POSTER_PATH):
+    """
+    Save a downloaded image and its thumbnail under the hash of the image.
+    Returns: {"digest", "image_name", "thumbnail_name", "size"}
+    """
+    digest = hashlib.sha256(content).hexdigest()
+    image_name = digest + extension
+    _write_file(_file_path(poster_path, image_name), content)
+    size = len(content)
+    thumbnail_name = f"{digest}_{THUMBNAIL_SIZE[0]}.jpg"
+    thumbnail_file = _file_path(poster_path, thumbnail_name)
+    if not thumbnail_file.exists():
+        thumbnail = make_thumbnail(content)
+        if thumbnail is None:
+            thumbnail_name = image_name
+        else:
+            _write_file(thumbnail_file, thumbnail)
+    if thumbnail_name != image_name:
+        size += thumbnail_file.stat().st_size
+    return {"digest": digest, "image_name": image_name, "thumbnail_name": thumbnail_name, "size": size}
+
+
+def download_poster(url, poster_path=POSTER_PATH):
+    """ Download and store one poster, returns the row for the cache table or None if it failed """
+    import requests
+    try:
+        response = api.get_session().get(url, timeout=api.REQUEST_TIMEOUT)
+        response.raise_for_status()
+    except requests.RequestException:
+        return None
+    extension = os.path.splitext(url.split("?", 1)[0])[1].lower()
+    if extension not in (".jpg", ".jpeg", ".png", ".gif", ".webp"):
+        extension = ".jpg"
+    return dict(store_poster(response.content, extension, poster_path), url=url)
+
+
+def lookup(urls, poster_path=POSTER_PATH):
+    """
+    Find already downloaded posters and mark them as used.
+    Returns: {url: CachedPoster} for every url with its files still on disk
+    """
+    query = text("SELECT url, image_name, thumbnail_name FROM poster_cache "
+                 "WHERE url IN :urls").bindparams(bindparam("urls", expanding=True))
+    found = {}
+    url_list = list(urls)
+    with write_transaction(get_cache_engine()) as connection:
+        for start in range(0, len(url_list), LOOKUP_CHUNK_SIZE):
+            for url, image_name, thumbnail_name in connection.execute(
+                    query, {"urls": url_list[start:start + LOOKUP_CHUNK_SIZE]}):
+                poster = CachedPoster(_file_path(poster_path, image_name), _file_path(poster_path, thumbnail_name))
+                if poster.image.exists() and poster.thumbnail.exists():
+                    found[url] = poster
+        if found:
+            connection.execute(text("UPDATE poster_cache SET used_at = :now WHERE url = :url"),
+                               [{"now": time.time(), "url": url} for url in found])
+    return found
+
+
+def cache_posters(urls, poster_path=POSTER_PATH, max_bytes=CACHE_MAX_BYTES, max_in_flight=MAX_IN_FLIGHT):
+    """
+    Make sure the posters of all urls are stored locally, missing ones are
+    downloaded with at most max_in_flight concurrent requests.
+    Urls without a downloadable image are left out, the page links them directly.
+    Returns: {url: CachedPoster}
+    """
+    urls = list(dict.fromkeys(url for url in urls if url and url.startswith(("http://", "https://"))))
+    posters = lookup(urls, poster_path)
+    missing_urls = [url for url in urls if url not in posters]
+    if missing_urls:
+        with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+            rows = [row for row in executor.map(lambda url: download_poster(url, poster_path), missing_urls) if row]
+        if rows:
+            now = time.time()
+            with write_transaction(get_cache_engine()) as connection:
+                connection.execute(text("INSERT OR REPLACE INTO poster_cache "
+                                        "(url, digest, image_name, thumbnail_name, size, used_at) "
+                                        "VALUES (:url, :digest, :image_name, :thumbnail_name, :size, :now)"),
+                                   [dict(row, now=now) for row in rows])
+        for row in rows:
+            posters[row["url"]] = CachedPoster(_file_path(poster_path, row["image_name"]),
+                                               _file_path(poster_path, row["thumbnail_name"]))
+    evict(max_bytes, keep=posters, poster_path=poster_path)
+    return posters
+
+
+def cache_size():
+    """ Return the bytes of all stored files, posters shared by several urls count once """
+    with get_cache_engine().connect() as connection:
+        return connection.execute(text("SELECT COALESCE(SUM(size), 0) FROM "
+                                       "(SELECT MAX(size) AS size FROM poster_cache GROUP BY digest)")).scalar()
+
+
+def referenced_urls():
+    """ Return the set of poster urls of the saved movies of all users """
+    with get_engine().connect() as connection:
+        return set(connection.execute(text("SELECT DISTINCT poster_url FROM movies")).scalars())
+
+
+def evict(max_bytes=CACHE_MAX_BYTES, keep=(), poster_path=POSTER_PATH, keep_referenced=True):
+    """
+    Delete the posters used least recently, until the files fit into max_bytes.
+    Posters of the urls in keep and, with keep_referenced, of every saved movie stay,
+    even if the cache is bigger then.
+    Returns: number of deleted posters (int)
+    """
+    total_size = cache_size()
+    if total_size <= max_bytes:
+        return 0
+    keep = set(keep)
+    if keep_referenced:
+        keep.update(referenced_urls())
+    evicted = 0
+    with write_transaction(get_cache_engine()) as connection:
+        rows = connection.execute(text("SELECT digest, MAX(used_at) AS last_used, MAX(size), "
+                                       "MIN(image_name), MIN(thumbnail_name), GROUP_CONCAT(url, char(10)) "
+                                       "FROM poster_cache GROUP BY digest ORDER BY last_used")).fetchall()
+        for digest, _, size, image_name, thumbnail_name, urls in rows:
+            if total_size <= max_bytes:
+                break
+            if keep.intersection(urls.split("\n")):
+                continue
+            connection.execute(text("DELETE FROM poster_cache WHERE digest = :digest"), {"digest": digest})
+            for name in {image_name, thumbnail_name}:
+                _file_path(poster_path, name).unlink(missing_ok=True)
+            total_size -= size
+            evicted += 1
+    return evicted
+
+
+def clear(poster_path=POSTER_PATH):
+    """ Remove all stored posters """
+    return evict(-1, poster_path=poster_path, keep_referenced=False)
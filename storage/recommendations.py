@@ -0,0 +1,316 @@
+"""
+Recommendations from the collections of all users.
+The movies table is read once into a sparse user x title matrix
+(CSR arrays in NumPy), from which the cosine similarity between users
+is computed. Only the NEIGHBORS most similar users are kept per user.
+A request then only scores the movies of those neighbors, O(k * movies per user).
+The first request builds the model. After movies were added or removed it is
+rebuilt in a background thread, the previous model answers until it is done.
+
+Build and try the model on the current database with:
+    python -m storage.recommendations USER_ID
+"""
+import random
+import sys
+import threading
+
+from sqlalchemy import text
+
+from storage import metrics
+from storage import movie_storage_sql as storage
+from storage.database import get_engine
+
+RATING_SCALE = 10.0
+# Weight of a saved movie without rating, compared to 1.0 for a 10/10
+UNRATED_WEIGHT = 0.5
+# Similar users kept per user
+NEIGHBORS = 20
+# Titles in more collections than this say little about taste and would create
+# a quadratic number of user pairs, they are left out of the similarity
+MAX_TITLE_USERS = 200
+# Recommendations, which "pick something for tonight" draws from
+PICK_CANDIDATES = 50
+
+_model = None
+# Thread building the next model, see get_model()
+_rebuild = None
+_rebuild_lock = threading.Lock()
+
+
+class AliasSampler:
+    """
+    Draws an index with probability proportional to its weight in O(1),
+    after an O(n) setup (Vose's alias method).
+    """
+
+    def __init__(self, weights):
+        count = len(weights)
+        total = float(sum(weights))
+        scaled = [weight * count / total for weight in weights]
+        self.probabilities = [0.0] * count
+        self.aliases = [0] * count
+        small = [index for index, weight in enumerate(scaled) if weight < 1.0]
+        large = [index for index, weight in enumerate(scaled) if weight >= 1.0]
+        while small and large:
+            less, more = small.pop(), large.pop()
+            self.probabilities[less] = scaled[less]
+            self.aliases[less] = more
+            scaled[more] -= 1.0 - scaled[less]
+            (small if scaled[more] < 1.0 else large).append(more)
+        # The rest is 1.0 apart from rounding errors
+        for index in small + large:
+            self.probabilities[index] = 1.0
+
+    def __len__(self):
+        return len(self.probabilities)
+
+    def sample(self, rng=random):
+        index = rng.randrange(len(self.probabilities))
+        return index if rng.random() < self.probabilities[index] else self.aliases[index]
+
+
+def _rating_weights(ratings):
+    """ Rating between 0 and 1 as weight of a saved movie, UNRATED_WEIGHT without rating """
+    import numpy as np
+    weights = np.array([UNRATED_WEIGHT * RATING_SCALE if rating is None else rating for rating in ratings],
+                       dtype=np.float64)
+    return np.clip(weights / RATING_SCALE, 0.01, 1.0)
+
+
+def _group_starts(sorted_values):
+    """ Return the positions, where a new value starts in a sorted array """
+    import numpy as np
+    return np.flatnonzero(np.r_[True, sorted_values[1:] != sorted_values[:-1]])
+
+
+def _user_neighbors(user_index, title_index, weights, user_count, neighbors, max_title_users):
+    """
+    Cosine similarity between the rating vectors of all users sharing a title.
+    Returns: (indptr, neighbor_index, similarity) CSR arrays with the best neighbors first
+    """
+    import numpy as np
+    order = np.lexsort((user_index, title_index))
+    users = user_index[order]
+    pair_weights = weights[order]
+    starts = _group_starts(title_index[order])
+    sizes = np.diff(np.r_[starts, len(order)])
+    # Every row pairs with the later rows of its title, if the title is shared by few enough users
+    row_group = np.repeat(np.arange(len(starts)), sizes)
+    position = np.arange(len(order)) - starts[row_group]
+    used = (sizes[row_group] > 1) & (sizes[row_group] <= max_title_users)
+    pair_counts = np.where(used, sizes[row_group] - 1 - position, 0)
+    left = np.repeat(np.arange(len(order)), pair_counts)
+    run_starts = np.cumsum(pair_counts) - pair_counts
+    right = left + 1 + np.arange(len(left)) - np.repeat(run_starts, pair_counts)
+
+    if not len(left):
+        return np.zeros(user_count + 1, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0)
+
+    # Sum the products of both users' weights over all shared titles
+    pair_keys = users[left].astype(np.int64) * user_count + users[right]
+    order = np.argsort(pair_keys)
+    pair_keys = pair_keys[order]
+    starts = _group_starts(pair_keys)
+    dots = np.add.reduceat((pair_weights[left] * pair_weights[right])[order], starts)
+    first_users, second_users = np.divmod(pair_keys[starts], user_count)
+    norms = np.sqrt(np.bincount(user_index, weights=weights * weights, minlength=user_count))
+    similarities = dots / (norms[first_users] * norms[second_users])
+
+    # Both directions, the best neighbors of every user first
+    sources = np.r_[first_users, second_users]
+    targets = np.r_[second_users, first_users]
+    similarities = np.r_[similarities, similarities]
+    # One float key sorts by user and then by similarity, which is within (0, 1]
+    order = np.argsort(sources + (1.0 - similarities) / 2)
+    sources, targets, similarities = sources[order], targets[order], similarities[order]
+    starts = _group_starts(sources)
+    rank = np.arange(len(sources)) - np.repeat(starts, np.diff(np.r_[starts, len(sources)]))
+    best = rank < neighbors
+    indptr = np.r_[0, np.cumsum(np.bincount(sources[best], minlength=user_count))]
+    return indptr, targets[best], similarities[best]
+
+
+class RecommendationModel:
+    """
+    User x title matrix in CSR form and the most similar users of every user.
+    Recommendations and samplers per user are cached until the model is replaced.
+    """
+
+    def __init__(self, user_ids, titles, years, ratings, neighbors=NEIGHBORS, max_title_users=MAX_TITLE_USERS):
+        import numpy as np
+        self.generation = None
+        self.user_ids, user_index = np.unique(np.asarray(user_ids, dtype=np.int64), return_inverse=True)
+        user_index = user_index.ravel()
+        # Sorting a million strings in NumPy is slower than a dict
+        title_positions = {}
+        title_index = np.fromiter((title_positions.setdefault(title, len(title_positions)) for title in titles),
+                                  dtype=np.int64, count=len(titles))
+        self.titles = list(title_positions)
+        weights = _rating_weights(ratings)
+        self.user_positions = {int(user_id): position for position, user_id in enumerate(self.user_ids)}
+
+        # Row of every user: the titles of its collection
+        order = np.argsort(user_index, kind="stable")
+        self.user_indptr = np.r_[0, np.cumsum(np.bincount(user_index, minlength=len(self.user_ids)))]
+        self.user_titles = title_index[order]
+        self.user_weights = weights[order]
+
+        # Year and average rating of every title over all collections, 0 for an unknown year
+        self.years = np.zeros(len(self.titles), dtype=np.int64)
+        self.years[title_index] = [0 if year is None else year for year in years]
+        rated = np.array([rating is not None for rating in ratings], dtype=bool)
+        rating_values = np.array([0.0 if rating is None else rating for rating in ratings], dtype=np.float64)
+        rating_sums = np.bincount(title_index, weights=rating_values * rated, minlength=len(self.titles))
+        rating_counts = np.bincount(title_index, weights=rated, minlength=len(self.titles))
+        with np.errstate(invalid="ignore", divide="ignore"):
+            self.average_ratings = rating_sums / rating_counts
+        self.popularity = np.bincount(title_index, weights=weights, minlength=len(self.titles))
+
+        self.neighbor_indptr, self.neighbors, self.similarities = _user_neighbors(
+            user_index, title_index, weights, len(self.user_ids), neighbors, max_title_users)
+        # {user_id: (limit, [(title_position, score)])} and {user_id: (title_positions, AliasSampler, recommended)}
+        self._recommendations = {}
+        self._samplers = {}
+
+    def title_info(self, title_position):
+        """ Return (title, year, average rating) of a title, year and rating None if unknown """
+        year = int(self.years[title_position]) or None
+        average_rating = float(self.average_ratings[title_position])
+        return (str(self.titles[title_position]), year,
+                None if average_rating != average_rating else round(average_rating, 1))
+
+    def _own_titles(self, position):
+        return self.user_titles[self.user_indptr[position]:self.user_indptr[position + 1]]
+
+    def recommend(self, user_id, limit=10):
+        """
+        Titles the most similar users saved, which the user hasn't saved yet,
+        scored by similarity * rating. Users without neighbors get the most popular titles.
+        Returns: [(title_position, score)] the best first
+        """
+        cached_limit, cached = self._recommendations.get(user_id, (0, None))
+        if cached is not None and cached_limit >= limit:
+            return cached[:limit]
+        import numpy as np
+        position = self.user_positions.get(user_id)
+        own_titles = self._own_titles(position) if position is not None else np.empty(0, dtype=np.int64)
+        start, end = (self.neighbor_indptr[position], self.neighbor_indptr[position + 1]) if position is not None \
+            else (0, 0)
+        if end > start:
+            slices = [slice(self.user_indptr[neighbor], self.user_indptr[neighbor + 1])
+                      for neighbor in self.neighbors[start:end]]
+            candidates = np.concatenate([self.user_titles[part] for part in slices])
+            candidate_scores = np.concatenate([self.user_weights[part] * similarity
+                                               for part, similarity in zip(slices, self.similarities[start:end])])
+            titles, title_index = np.unique(candidates, return_inverse=True)
+            scores = np.bincount(title_index.ravel(), weights=candidate_scores)
+        else:
+            titles, scores = np.arange(len(self.titles)), self.popularity
+        new = ~np.isin(titles, own_titles)
+        titles, scores = titles[new], scores[new]
+        if len(titles) > limit:
+            best = np.argpartition(-scores, limit)[:limit]
+            titles, scores = titles[best], scores[best]
+        order = np.argsort(-scores, kind="stable")
+        recommendations = [(int(title), float(score)) for title, score in zip(titles[order], scores[order])]
+        self._recommendations[user_id] = (limit, recommendations)
+        return recommendations
+
+    def sampler(self, user_id):
+        """
+        An AliasSampler weighted by the recommendation scores,
+        or by the user's own ratings, if there is nothing to recommend.
+        Returns: (title_positions, AliasSampler, recommended(bool)) or None without any movies
+        """
+        if user_id not in self._samplers:
+            candidates = self.recommend(user_id, PICK_CANDIDATES)
+            recommended = bool(candidates)
+            if not candidates and user_id in self.user_positions:
+                position = self.user_positions[user_id]
+                start, end = self.user_indptr[position], self.user_indptr[position + 1]
+                candidates = list(zip(self.user_titles[start:end].tolist(), self.user_weights[start:end].tolist()))
+            self._samplers[user_id] = None
+            if candidates:
+                titles = [title for title, _ in candidates]
+                self._samplers[user_id] = (titles, AliasSampler([score for _, score in candidates]), recommended)
+        return self._samplers[user_id]
+
+
+def load_model():
+    """ Read the movies of all users and build a RecommendationModel """
+    with get_engine().connect() as connection:
+        rows = connection.execute(text("SELECT user_id, title, year, rating FROM movies")).fetchall()
+    user_ids = [row[0] for row in rows]
+    titles = [row[1] for row in rows]
+    years = [row[2] for row in rows]
+    ratings = [row[3] for row in rows]
+    return RecommendationModel(user_ids, titles, years, ratings)
+
+
+def _rebuild_model(generation):
+    """ Replace the cached model with one of the current movies, runs in the background """
+    global _model
+    try:
+        model = load_model()
+    except Exception:
+        # Never print into the menu from the background, the old model stays
+        metrics.count("errors_total", "recommendations.rebuild_model")
+        return
+    model.generation = generation
+    _model = model
+
+
+def get_model():
+    """
+    Return the cached RecommendationModel, only the first call waits for it to be built.
+    After movies were added or removed by any process, a new model is built in a background
+    thread and the old one is returned until it is done, building it takes seconds.
+    """
+    global _model, _rebuild
+    storage.check_data_changes()
+    # Read before the movies, a change in between builds the model once more
+    generation = storage.write_generation
+    if _model is None:
+        model = load_model()
+        model.generation = generation
+        _model = model
+    elif _model.generation != generation:
+        with _rebuild_lock:
+            if _rebuild is None or not _rebuild.is_alive():
+                _rebuild = threading.Thread(target=_rebuild_model, args=(generation,),
+                                            name="recommendation-model", daemon=True)
+                _rebuild.start()
+    return _model
+
+
+def recommend(user_id, limit=10):
+    """
+    Recommend movies, which users with a similar collection saved.
+    Returns: [(title, year, average rating, score)] the best first
+    """
+    model = get_model()
+    return [model.title_info(title) + (score,) for title, score in model.recommend(user_id, limit)]
+
+
+def pick_for_tonight(user_id, rng=random):
+    """
+    Draw one movie, weighted by its recommendation score, or by rating
+    from the own collection, if there is nothing to recommend.
+    Returns: (title, year, average rating, recommended(bool)) or None without any movies
+    """
+    model = get_model()
+    sampler = model.sampler(user_id)
+    if sampler is None:
+        return None
+    titles, alias_sampler, recommended = sampler
+    return model.title_info(titles[alias_sampler.sample(rng)]) + (recommended,)
+
+
+if __name__ == "__main__":
+    import time
+    start = time.perf_counter()
+    model = get_model()
+    print(f"Model of {len(model.user_ids)} users and {len(model.titles)} titles built in "
+          f"{time.perf_counter() - start:.3f}s")
+    for title, year, rating, score in recommend(int(sys.argv[1])):
+        print(f"{score:6.3f}  {title} ({year}), {rating}")
@@ -0,0 +1,304 @@
+"""
+Background refresh of the saved movies.
+Ratings change and rows saved while OMDb answered "N/A" miss their year or rating,
+so movies fetched longer than REFRESH_MAX_AGE ago (MISSING_MAX_AGE for incomplete rows)
+are queued in the refresh_jobs table and fetched again by a daemon thread.
+Requests are spread to at most RATE_LIMIT per second, failed ones are retried
+with exponential backoff, the results of a batch are written in one transaction.
+The interactive menu never waits for it.
+The thread only runs with MOVIES_BACKGROUND_REFRESH=1 and an API_KEY.
+All workers and foreground refreshes together send at most DAILY_REQUESTS per day,
+counted in the refresh_budget table, so they never use up the key of a free OMDb
+account (1000 requests per day), which adding movies needs as well.
+
+Refresh the stale movies once in the foreground with:
+    python -m storage.refresh_worker
+"""
+import os
+import random
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import text, bindparam
+
+from storage import api_data_handling as api, api_cache, metrics
+from storage import movie_storage_sql as storage
+from storage.database import write_transaction
+from storage.movie import Movie, parse_rating, parse_year
+
+DAY = 24 * 60 * 60
+REFRESH_MAX_AGE = float(os.environ.get("MOVIES_REFRESH_MAX_AGE_DAYS", 30)) * DAY
+MISSING_MAX_AGE = float(os.environ.get("MOVIES_REFRESH_MISSING_MAX_AGE_DAYS", 1)) * DAY
+# Requests per second to OMDb, shared by all fetching threads
+RATE_LIMIT = float(os.environ.get("OMDB_RATE_LIMIT", 5))
+# Requests per day of the background thread, the rest of the key is left for adding movies
+DAILY_REQUESTS = int(os.environ.get("OMDB_REFRESH_DAILY_REQUESTS", 300))
+BATCH_SIZE = 50
+MAX_IN_FLIGHT = 4
+# Retries wait BACKOFF_BASE, 2 * BACKOFF_BASE, ... up to BACKOFF_MAX seconds
+BACKOFF_BASE = 60.0
+BACKOFF_MAX = 6 * 60 * 60
+MAX_ATTEMPTS = 6
+# A claimed job is given to another worker, if it was not finished after this many seconds
+LEASE_SECONDS = 5 * 60
+# Seconds between looking for stale movies and sleeping without jobs
+ENQUEUE_INTERVAL = 10 * 60
+IDLE_SECONDS = 30.0
+# The answer of OMDb for an unknown title, retrying won't help
+NOT_FOUND_ERROR = "Movie not found!"
+
+RefreshJob = namedtuple("RefreshJob", ["movie_id", "user_id", "title", "attempts"])
+
+_worker = None
+
+
+class RateLimiter:
+    """ Spaces the calls of wait() at least 1 / rate seconds apart, across threads """
+
+    def __init__(self, rate=RATE_LIMIT):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self._next_time = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next_time)
+            self._next_time = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+    def pause(self, seconds):
+        """ Let no call through for the next seconds, e.g. after a 429 answer """
+        with self._lock:
+            self._next_time = max(self._next_time, time.monotonic() + seconds)
+
+
+def retry_delay(attempts):
+    """ Seconds to wait before the next attempt, doubled per attempt with some jitter """
+    return min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (attempts - 1)) * random.uniform(0.5, 1.0)
+
+
+def enqueue_stale(max_age=REFRESH_MAX_AGE, missing_max_age=MISSING_MAX_AGE, now=None):
+    """
+    Queue every movie, which was never fetched, fetched before max_age seconds
+    or misses year or rating and was fetched before missing_max_age seconds.
+    Returns: number of new jobs (int)
+    """
+    now = time.time() if now is None else now
+    with write_transaction() as connection:
+        result = connection.execute(text("""
+            INSERT OR IGNORE INTO refresh_jobs (movie_id, attempts, not_before)
+            SELECT id, 0, :now FROM movies
+            WHERE fetched_at IS NULL OR fetched_at < :stale_before
+               OR (fetched_at < :missing_before AND (year IS NULL OR rating IS NULL))
+        """), {"now": now, "stale_before": now - max_age, "missing_before": now - missing_max_age})
+    return result.rowcount
+
+
+def claim_jobs(limit=BATCH_SIZE, now=None, daily_requests=DAILY_REQUESTS):
+    """
+    Take the due jobs, the oldest first, and hold them for LEASE_SECONDS,
+    so a second worker doesn't fetch the same movies.
+    Every job is counted as a request of today in the same transaction,
+    no more jobs are given out after daily_requests per day, 0 means no limit.
+    Returns: [RefreshJob]
+    """
+    now = time.time() if now is None else now
+    day = time.strftime("%Y-%m-%d", time.localtime(now))
+    with write_transaction() as connection:
+        if daily_requests:
+            used = connection.execute(text("SELECT requests FROM refresh_budget WHERE day = :day"),
+                                      {"day": day}).scalar() or 0
+            limit = min(limit, daily_requests - used)
+            if limit <= 0:
+                return []
+        jobs = [RefreshJob(*row) for row in connection.execute(text("""
+            SELECT j.movie_id, m.user_id, m.title, j.attempts
+            FROM refresh_jobs j JOIN movies m ON m.id = j.movie_id
+            WHERE j.not_before <= :now ORDER BY j.not_before LIMIT :limit
+        """), {"now": now, "limit": limit})]
+        if jobs:
+            connection.execute(text("UPDATE refresh_jobs SET not_before = :lease_end WHERE movie_id IN :movie_ids")
+                               .bindparams(bindparam("movie_ids", expanding=True)),
+                               {"lease_end": now + LEASE_SECONDS, "movie_ids": [job.movie_id for job in jobs]})
+            connection.execute(text("DELETE FROM refresh_budget WHERE day < :day"), {"day": day})
+            connection.execute(text("""
+                INSERT INTO refresh_budget (day, requests) VALUES (:day, :requests)
+                ON CONFLICT (day) DO UPDATE SET requests = requests + excluded.requests
+            """), {"day": day, "requests": len(jobs)})
+    return jobs
+
+
+def fetch_movie(title, limiter):
+    """
+    Request a title from OMDb, bypassing the response cache.
+    Returns: (movie_data, None) or (None, error message) if the request should be retried
+    """
+    import requests
+    limiter.wait()
+    try:
+        response = api.get_session().get(api.get_request_url(), params={"t": title}, timeout=api.REQUEST_TIMEOUT)
+        if response.status_code == 429 or response.status_code >= 500:
+            try:
+                limiter.pause(float(response.headers.get("Retry-After", BACKOFF_BASE)))
+            except ValueError:
+                limiter.pause(BACKOFF_BASE)
+            return None, f"HTTP {response.status_code}"
+        response.raise_for_status()
+        movie_data = response.json()
+    except (requests.RequestException, ValueError) as e:
+        return None, str(e)
+    if movie_data.get("Response") != "True" and movie_data.get("Error") != NOT_FOUND_ERROR:
+        # e.g. "Request limit reached!" or an invalid API key
+        return None, movie_data.get("Error", "Unknown error")
+    return movie_data, None
+
+
+def apply_results(results, now=None):
+    """
+    Write the results of one batch in one transaction.
+    Found movies get the new year, rating and poster (a missing value keeps the old one),
+    unknown titles are only marked as fetched, failed jobs wait for their next attempt
+    and are dropped after MAX_ATTEMPTS, until the movie is stale again.
+    results: [(RefreshJob, movie_data or None, error or None)]
+    Returns: {"refreshed", "not_found", "retried", "given_up"} numbers of jobs
+    """
+    now = time.time() if now is None else now
+    updates, finished, retries = [], [], []
+    summary = {"refreshed": 0, "not_found": 0, "retried": 0, "given_up": 0}
+    for job, movie_data, error in results:
+        if error is None and movie_data.get("Response") == "True":
+            updates.append({"movie_id": job.movie_id, "year": parse_year(movie_data.get("Year")),
+                            "rating": parse_rating(movie_data.get("imdbRating")),
+                            "poster_url": movie_data.get("Poster"), "now": now})
+            summary["refreshed"] += 1
+        elif error is None or job.attempts + 1 >= MAX_ATTEMPTS:
+            finished.append({"movie_id": job.movie_id, "now": now})
+            summary["not_found" if error is None else "given_up"] += 1
+        else:
+            retries.append({"movie_id": job.movie_id, "not_before": now + retry_delay(job.attempts + 1),
+                            "error": error})
+            summary["retried"] += 1
+
+    refreshed = {}
+    with write_transaction() as connection:
+        if updates:
+            connection.execute(text("""
+                UPDATE movies SET year = COALESCE(:year, year), rating = COALESCE(:rating, rating),
+                    poster_url = COALESCE(NULLIF(:poster_url, 'N/A'), poster_url), fetched_at = :now
+                WHERE id = :movie_id
+            """), updates)
+            rows = connection.execute(text("SELECT user_id, title, year, rating, poster_url, comment, version FROM movies "
+                                           "WHERE id IN :movie_ids").bindparams(bindparam("movie_ids", expanding=True)),
+                                      {"movie_ids": [update["movie_id"] for update in updates]})
+            for row in rows:
+                refreshed.setdefault(row[0], []).append(Movie(*row[1:]))
+        if finished:
+            connection.execute(text("UPDATE movies SET fetched_at = :now WHERE id = :movie_id"), finished)
+        if updates or finished:
+            connection.execute(text("DELETE FROM refresh_jobs WHERE movie_id = :movie_id"), updates + finished)
+        if retries:
+            connection.execute(text("UPDATE refresh_jobs SET attempts = attempts + 1, not_before = :not_before, "
+                                    "last_error = :error WHERE movie_id = :movie_id"), retries)
+    if refreshed:
+        storage.refresh_cached_movies(refreshed)
+    return summary
+
+
+@metrics.timed()
+def run_batch(limiter, executor, batch_size=BATCH_SIZE, daily_requests=DAILY_REQUESTS):
+    """
+    Fetch and write one batch of due jobs, the requests run in the executor.
+    Returns: the summary of apply_results, None if no job was due or the daily requests are used up
+    """
+    jobs = claim_jobs(batch_size, daily_requests=daily_requests)
+    if not jobs:
+        return None
+    fetched = list(executor.map(lambda job: fetch_movie(job.title, limiter), jobs))
+    found = {job.title: movie_data for job, (movie_data, _) in zip(jobs, fetched)
+             if movie_data and movie_data.get("Response") == "True"}
+    # The next add of the same title by another user can use the fresh answer
+    api_cache.put_many(found)
+    summary = apply_results([(job, movie_data, error) for job, (movie_data, error) in zip(jobs, fetched)])
+    for outcome, number in summary.items():
+        if number:
+            metrics.count("refresh_jobs_total", outcome, number)
+    return summary
+
+
+def refresh_all(rate=RATE_LIMIT, max_in_flight=MAX_IN_FLIGHT, batch_size=BATCH_SIZE,
+                daily_requests=DAILY_REQUESTS):
+    """
+    Queue the stale movies and work off every due job in the foreground,
+    until the daily requests are used up, the other jobs wait for the next run.
+    Returns: {"queued", "refreshed", "not_found", "retried", "given_up"} numbers of jobs
+    """
+    totals = {"queued": enqueue_stale(), "refreshed": 0, "not_found": 0, "retried": 0, "given_up": 0}
+    limiter = RateLimiter(rate)
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        while True:
+            summary = run_batch(limiter, executor, batch_size, daily_requests)
+            if summary is None:
+                return totals
+            for outcome, number in summary.items():
+                totals[outcome] += number
+
+
+class RefreshWorker(threading.Thread):
+    """
+    Daemon thread, which queues stale movies every ENQUEUE_INTERVAL and works off the jobs.
+    After daily_requests requests of all processes it waits for the next day, 0 means no limit.
+    """
+
+    def __init__(self, rate=RATE_LIMIT, max_in_flight=MAX_IN_FLIGHT, batch_size=BATCH_SIZE,
+                 idle_seconds=IDLE_SECONDS, daily_requests=DAILY_REQUESTS):
+        super().__init__(name="refresh-worker", daemon=True)
+        self.limiter = RateLimiter(rate)
+        self.max_in_flight = max_in_flight
+        self.batch_size = batch_size
+        self.idle_seconds = idle_seconds
+        self.daily_requests = daily_requests
+        self._stop_event = threading.Event()
+
+    def run(self):
+        next_enqueue = 0.0
+        with ThreadPoolExecutor(max_workers=self.max_in_flight) as executor:
+            while not self._stop_event.is_set():
+                summary = None
+                try:
+                    if time.monotonic() >= next_enqueue:
+                        enqueue_stale()
+                        next_enqueue = time.monotonic() + ENQUEUE_INTERVAL
+                    summary = run_batch(self.limiter, executor, self.batch_size, self.daily_requests)
+                except Exception:
+                    # Never print into the menu, the error counter shows it
+                    metrics.count("errors_total", "refresh_worker.run")
+                if summary is None:
+                    self._stop_event.wait(self.idle_seconds)
+
+    def stop(self, timeout=None):
+        """ Finish the current batch and end the thread """
+        self._stop_event.set()
+        self.join(timeout)
+
+
+def start_background_refresh():
+    """
+    Start the RefreshWorker of this process, if MOVIES_BACKGROUND_REFRESH is 1
+    and an API_KEY is configured, without one every request would fail.
+    Returns: the running RefreshWorker or None
+    """
+    global _worker
+    if os.environ.get("MOVIES_BACKGROUND_REFRESH", "0") != "1" or not api.get_api_key():
+        return None
+    if _worker is None or not _worker.is_alive():
+        _worker = RefreshWorker()
+        _worker.start()
+    return _worker
+
+
+if __name__ == "__main__":
+    print(refresh_all())
@@ -0,0 +1,406 @@
+"""
+Versioned schema migrations for the movies database.
+The applied version is kept in SQLite's PRAGMA user_version,
+so every migration in MIGRATIONS only runs once per database file.
+
+Upgrade an existing database in place with:
+    python -m storage.schema [path/to/movies.db]
+"""
+import sys
+from contextlib import contextmanager
+from pathlib import Path
+
+from sqlalchemy import create_engine, text
+
+from storage.database import write_transaction
+
+# Name of the former users database, expected next to the movies database
+LEGACY_USERS_DB_NAME = "users.db"
+
+
+def _create_movies_table(connection):
+    """ Version 1: the original movies table """
+    connection.execute(text("""
+        CREATE TABLE IF NOT EXISTS movies (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL ,
+            title TEXT NOT NULL,
+            year INTEGER NOT NULL,
+            rating REAL NOT NULL DEFAULT 0.0,
+            poster_url TEXT,
+            comment DEFAULT ''
+        );
+    """))
+
+
+def _add_user_title_index(connection):
+    """
+    Version 2: one movie title per user, backed by a unique index.
+    Older databases could contain duplicates, only the first saved row is kept.
+    """
+    connection.execute(text("""
+        DELETE FROM movies
+        WHERE id NOT IN (SELECT MIN(id) FROM movies GROUP BY user_id, title);
+    """))
+    connection.execute(text("""
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_movies_user_title
+        ON movies (user_id, title);
+    """))
+
+
+def _add_user_rating_index(connection):
+    """ Version 3: lets the statistics read a user's movies already ordered by rating """
+    connection.execute(text("""
+        CREATE INDEX IF NOT EXISTS idx_movies_user_rating
+        ON movies (user_id, rating);
+    """))
+
+
+def _create_users_table(connection):
+    """ Version 4: the users table moves into the movies database """
+    connection.execute(text("""
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_name TEXT NOT NULL
+        );
+    """))
+
+
+def _import_legacy_users(connection):
+    """ Version 5: copy the users of a former users.db next to this database """
+    legacy_file = Path(connection.engine.url.database).parent / LEGACY_USERS_DB_NAME
+    if not legacy_file.exists():
+        return
+    legacy_engine = create_engine(f"sqlite:///{legacy_file}")
+    try:
+        with legacy_engine.connect() as legacy_connection:
+            users = legacy_connection.execute(text("SELECT user_id, user_name FROM users;")).fetchall()
+    except Exception:
+        # No users table, nothing to import
+        users = []
+    finally:
+        legacy_engine.dispose()
+    if users:
+        connection.execute(text("INSERT OR IGNORE INTO users (user_id, user_name) VALUES (:user_id, :user_name)"),
+                           [{"user_id": user_id, "user_name": user_name} for user_id, user_name in users])
+
+
+def _add_users_foreign_key(connection):
+    """
+    Version 6: movies reference their user and are deleted with it.
+    SQLite can't add a foreign key to a table, so the table is copied.
+    Movies of unknown users get a placeholder user instead of being lost.
+    """
+    connection.execute(text("""
+        INSERT INTO users (user_id, user_name)
+        SELECT DISTINCT user_id, 'User ' || user_id FROM movies
+        WHERE user_id NOT IN (SELECT user_id FROM users);
+    """))
+    connection.execute(text("""
+        CREATE TABLE movies_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL REFERENCES users (user_id) ON DELETE CASCADE,
+            title TEXT NOT NULL,
+            year INTEGER NOT NULL,
+            rating REAL NOT NULL DEFAULT 0.0,
+            poster_url TEXT,
+            comment DEFAULT ''
+        );
+    """))
+    connection.execute(text("""
+        INSERT INTO movies_new (id, user_id, title, year, rating, poster_url, comment)
+        SELECT id, user_id, title, year, rating, poster_url, comment FROM movies;
+    """))
+    connection.execute(text("DROP TABLE movies;"))
+    connection.execute(text("ALTER TABLE movies_new RENAME TO movies;"))
+    _add_user_title_index(connection)
+    _add_user_rating_index(connection)
+
+
+def _allow_missing_year_and_rating(connection):
+    """
+    Version 7: year and rating are NULL, when OMDb has none.
+    Older rows kept OMDb strings like "2010–2014" or "N/A",
+    they become the first year and NULL, so only numbers are left.
+    """
+    connection.execute(text("""
+        CREATE TABLE movies_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL REFERENCES users (user_id) ON DELETE CASCADE,
+            title TEXT NOT NULL,
+            year INTEGER,
+            rating REAL,
+            poster_url TEXT,
+            comment DEFAULT ''
+        );
+    """))
+    connection.execute(text("""
+        INSERT INTO movies_new (id, user_id, title, year, rating, poster_url, comment)
+        SELECT id, user_id, title,
+            CASE WHEN typeof(year) = 'integer' THEN year
+                 WHEN substr(year, 1, 4) GLOB '[0-9][0-9][0-9][0-9]' THEN CAST(substr(year, 1, 4) AS INTEGER)
+            END,
+            CASE WHEN typeof(rating) IN ('integer', 'real') THEN rating END,
+            poster_url, comment
+        FROM movies;
+    """))
+    connection.execute(text("DROP TABLE movies;"))
+    connection.execute(text("ALTER TABLE movies_new RENAME TO movies;"))
+    _add_user_title_index(connection)
+    _add_user_rating_index(connection)
+
+
+def _add_refresh_jobs(connection):
+    """
+    Version 8: when a movie was last fetched from OMDb and the queue of movies,
+    which storage.refresh_worker fetches again. Existing rows count as never fetched.
+    """
+    connection.execute(text("ALTER TABLE movies ADD COLUMN fetched_at REAL;"))
+    connection.execute(text("CREATE INDEX IF NOT EXISTS idx_movies_fetched_at ON movies (fetched_at);"))
+    connection.execute(text("""
+        CREATE TABLE IF NOT EXISTS refresh_jobs (
+            movie_id INTEGER PRIMARY KEY REFERENCES movies (id) ON DELETE CASCADE,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            not_before REAL NOT NULL DEFAULT 0,
+            last_error TEXT
+        );
+    """))
+    connection.execute(text("CREATE INDEX IF NOT EXISTS idx_refresh_jobs_not_before ON refresh_jobs (not_before);"))
+
+
+USER_STATS_TRIGGERS = ("movies_stats_insert", "movies_stats_delete", "movies_stats_update")
+# Histogram bucket of a rating: tenths of a point, like IMDb ratings
+_BUCKET = "CAST(ROUND({row}.rating * 10) AS INTEGER)"
+
+
+def _add_to_user_stats(row):
+    """
+    Statements of a trigger, which count the movie {row} (NEW) into the aggregates.
+    Missing rows are inserted with NOT EXISTS, an upsert on movies would
+    turn an INSERT OR IGNORE in the trigger into an error.
+    """
+    bucket = _BUCKET.format(row=row)
+    return f"""
+        INSERT INTO user_stats (user_id) SELECT {row}.user_id
+        WHERE NOT EXISTS (SELECT 1 FROM user_stats WHERE user_id = {row}.user_id);
+        UPDATE user_stats SET movie_count = movie_count + 1,
+            rated_count = rated_count + ({row}.rating IS NOT NULL),
+            rating_sum = rating_sum + COALESCE({row}.rating, 0),
+            min_rating = COALESCE(MIN(min_rating, {row}.rating), min_rating, {row}.rating),
+            max_rating = COALESCE(MAX(max_rating, {row}.rating), max_rating, {row}.rating)
+        WHERE user_id = {row}.user_id;
+        INSERT INTO user_rating_histogram (user_id, bucket, movie_count)
+        SELECT {row}.user_id, {bucket}, 0 WHERE {row}.rating IS NOT NULL AND NOT EXISTS (
+            SELECT 1 FROM user_rating_histogram WHERE user_id = {row}.user_id AND bucket = {bucket});
+        UPDATE user_rating_histogram SET movie_count = movie_count + 1
+        WHERE {row}.rating IS NOT NULL AND user_id = {row}.user_id AND bucket = {bucket};
+    """
+
+
+def _remove_from_user_stats(row):
+    """
+    Statements of a trigger, which take the movie {row} (OLD) out of the aggregates.
+    A removed minimum or maximum is looked up again in the (user_id, rating) index.
+    """
+    bucket = _BUCKET.format(row=row)
+    return f"""
+        UPDATE user_stats SET movie_count = movie_count - 1,
+            rated_count = rated_count - ({row}.rating IS NOT NULL),
+            rating_sum = CASE WHEN rated_count - ({row}.rating IS NOT NULL) = 0 THEN 0
+                              ELSE rating_sum - COALESCE({row}.rating, 0) END,
+            min_rating = CASE WHEN {row}.rating <= min_rating
+                              THEN (SELECT MIN(rating) FROM movies WHERE user_id = {row}.user_id)
+                              ELSE min_rating END,
+            max_rating = CASE WHEN {row}.rating >= max_rating
+                              THEN (SELECT MAX(rating) FROM movies WHERE user_id = {row}.user_id)
+                              ELSE max_rating END
+        WHERE user_id = {row}.user_id;
+        UPDATE user_rating_histogram SET movie_count = movie_count - 1
+        WHERE {row}.rating IS NOT NULL AND user_id = {row}.user_id AND bucket = {bucket};
+        DELETE FROM user_rating_histogram
+        WHERE {row}.rating IS NOT NULL AND user_id = {row}.user_id AND bucket = {bucket} AND movie_count <= 0;
+    """
+
+
+def rebuild_user_stats(connection):
+    """ Compute user_stats and user_rating_histogram again from the movies table """
+    connection.execute(text("DELETE FROM user_rating_histogram;"))
+    connection.execute(text("DELETE FROM user_stats;"))
+    connection.execute(text("""
+        INSERT INTO user_stats (user_id, movie_count, rated_count, rating_sum, min_rating, max_rating)
+        SELECT user_id, COUNT(*), COUNT(rating), COALESCE(SUM(rating), 0), MIN(rating), MAX(rating)
+        FROM movies GROUP BY user_id;
+    """))
+    connection.execute(text(f"""
+        INSERT INTO user_rating_histogram (user_id, bucket, movie_count)
+        SELECT user_id, {_BUCKET.format(row="movies")}, COUNT(*)
+        FROM movies WHERE rating IS NOT NULL GROUP BY 1, 2;
+    """))
+
+
+def _create_user_stats(connection):
+    """
+    Version 9: count, sum, minimum, maximum and histogram of the ratings per user,
+    kept up to date by triggers on the movies table, so the statistics
+    don't have to read every movie of the user.
+    """
+    connection.execute(text("""
+        CREATE TABLE IF NOT EXISTS user_stats (
+            user_id INTEGER PRIMARY KEY REFERENCES users (user_id) ON DELETE CASCADE,
+            movie_count INTEGER NOT NULL DEFAULT 0,
+            rated_count INTEGER NOT NULL DEFAULT 0,
+            rating_sum REAL NOT NULL DEFAULT 0,
+            min_rating REAL,
+            max_rating REAL
+        );
+    """))
+    connection.execute(text("""
+        CREATE TABLE IF NOT EXISTS user_rating_histogram (
+            user_id INTEGER NOT NULL REFERENCES users (user_id) ON DELETE CASCADE,
+            bucket INTEGER NOT NULL,
+            movie_count INTEGER NOT NULL,
+            PRIMARY KEY (user_id, bucket)
+        ) WITHOUT ROWID;
+    """))
+    _create_user_stats_triggers(connection)
+    rebuild_user_stats(connection)
+
+
+def _drop_user_stats_triggers(connection):
+    for trigger in USER_STATS_TRIGGERS:
+        connection.execute(text(f"DROP TRIGGER IF EXISTS {trigger};"))
+
+
+@contextmanager
+def row_triggers_paused(connection):
+    """
+    Drop the stats and change triggers for a bulk write in the transaction of connection,
+    compute the aggregates and count the change once at the end, instead of once per row.
+    Other connections never see the missing triggers, the DDL is part of the transaction.
+    """
+    _drop_user_stats_triggers(connection)
+    _drop_data_changes_triggers(connection)
+    yield
+    rebuild_user_stats(connection)
+    connection.execute(text("UPDATE data_changes SET counter = counter + 1;"))
+    _create_user_stats_triggers(connection)
+    _create_data_changes_triggers(connection)
+
+
+def _create_user_stats_triggers(connection):
+    connection.execute(text(f"""
+        CREATE TRIGGER IF NOT EXISTS movies_stats_insert AFTER INSERT ON movies
+        BEGIN {_add_to_user_stats("NEW")} END;
+    """))
+    connection.execute(text(f"""
+        CREATE TRIGGER IF NOT EXISTS movies_stats_delete AFTER DELETE ON movies
+        BEGIN {_remove_from_user_stats("OLD")} END;
+    """))
+    connection.execute(text(f"""
+        CREATE TRIGGER IF NOT EXISTS movies_stats_update AFTER UPDATE OF user_id, rating ON movies
+        BEGIN {_remove_from_user_stats("OLD")} {_add_to_user_stats("NEW")} END;
+    """))
+
+
+def _add_movie_versions(connection):
+    """
+    Version 10: a version number per movie, increased by every comment update,
+    so an update based on an older read of the movie is refused instead of lost.
+    The stats triggers are created again without INSERT OR IGNORE, so upserts
+    on movies work.
+    """
+    connection.execute(text("ALTER TABLE movies ADD COLUMN version INTEGER NOT NULL DEFAULT 1;"))
+    _drop_user_stats_triggers(connection)
+    _create_user_stats_triggers(connection)
+
+
+def _add_data_changes(connection):
+    """
+    Version 11: a counter of the changed rows of movies and users, increased by triggers,
+    so every process finds out, that its cached movies are outdated,
+    whichever connection, process or tool committed the change.
+    """
+    connection.execute(text("""
+        CREATE TABLE IF NOT EXISTS data_changes (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            counter INTEGER NOT NULL
+        );
+    """))
+    connection.execute(text("INSERT OR IGNORE INTO data_changes (id, counter) VALUES (1, 0);"))
+    _create_data_changes_triggers(connection)
+
+
+def _data_changes_triggers():
+    """ Returns: [(trigger name, table, event)] """
+    return [(f"{table}_changes_{event.lower()}", table, event)
+            for table in ("movies", "users") for event in ("INSERT", "UPDATE", "DELETE")]
+
+
+def _create_data_changes_triggers(connection):
+    for trigger, table, event in _data_changes_triggers():
+        connection.execute(text(f"""
+            CREATE TRIGGER IF NOT EXISTS {trigger} AFTER {event} ON {table}
+            BEGIN UPDATE data_changes SET counter = counter + 1; END;
+        """))
+
+
+def _drop_data_changes_triggers(connection):
+    for trigger, _, _ in _data_changes_triggers():
+        connection.execute(text(f"DROP TRIGGER IF EXISTS {trigger};"))
+
+
+def _add_refresh_budget(connection):
+    """
+    Version 12: the OMDb requests storage.refresh_worker sent per day,
+    so the daily limit holds across restarts and processes.
+    """
+    connection.execute(text("""
+        CREATE TABLE IF NOT EXISTS refresh_budget (
+            day TEXT PRIMARY KEY,
+            requests INTEGER NOT NULL
+        );
+    """))
+
+
+# Never reorder or change applied migrations, only append new ones
+MIGRATIONS = [
+    _create_movies_table,
+    _add_user_title_index,
+    _add_user_rating_index,
+    _create_users_table,
+    _import_legacy_users,
+    _add_users_foreign_key,
+    _allow_missing_year_and_rating,
+    _add_refresh_jobs,
+    _create_user_stats,
+    _add_movie_versions,
+    _add_data_changes,
+    _add_refresh_budget,
+]
+
+
+def get_schema_version(connection):
+    """ Return the schema version of the connected database """
+    return connection.execute(text("PRAGMA user_version;")).scalar()
+
+
+def migrate(engine):
+    """
+    Apply all pending migrations in one transaction.
+    Returns: the schema version of the database after migrating (int)
+    """
+    with write_transaction(engine) as connection:
+        version = get_schema_version(connection)
+        for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            migration(connection)
+            connection.execute(text(f"PRAGMA user_version = {number};"))
+        return get_schema_version(connection)
+
+
+if __name__ == "__main__":
+    from storage import database
+    engine = database.get_engine()
+    if len(sys.argv) > 1:
+        engine = database.create_database_engine(f"sqlite:///{sys.argv[1]}")
+    new_version = migrate(engine)
+    print(f"Database is at schema version {new_version}")
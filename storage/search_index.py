@@ -0,0 +1,93 @@
+"""
+Fuzzy title search with a prebuilt character n-gram index.
+Only titles sharing enough n-grams with the query to reach the score cutoff
+are scored, so it finds the same titles as scoring all of them.
+The scoring itself runs vectorized in rapidfuzz.process.extract.
+"""
+from collections import Counter
+
+# Every edit changes up to NGRAM_SIZE n-grams, with trigrams a match may share none
+NGRAM_SIZE = 2
+# Shorter queries or titles may match without sharing an n-gram, they are always scored
+MIN_INDEXED_QUERY_LENGTH = 6
+SCORE_CUTOFF = 80
+
+
+def _ngrams(lowered_title):
+    """ Return the set of character n-grams of a lowercase title """
+    return {lowered_title[start:start + NGRAM_SIZE] for start in range(len(lowered_title) - NGRAM_SIZE + 1)}
+
+
+class TitleIndex:
+    """
+    Posting lists from every n-gram to the titles containing it.
+    add() and remove() keep it in sync with the collection.
+    """
+
+    def __init__(self, titles=()):
+        self.lowered_titles = {}
+        self.postings = {}
+        self.short_titles = set()
+        for title in titles:
+            self.add(title)
+
+    def __len__(self):
+        return len(self.lowered_titles)
+
+    def add(self, title):
+        """ Index a new title """
+        if title in self.lowered_titles:
+            return
+        lowered_title = title.lower()
+        self.lowered_titles[title] = lowered_title
+        if len(lowered_title) < MIN_INDEXED_QUERY_LENGTH:
+            self.short_titles.add(title)
+        for ngram in _ngrams(lowered_title):
+            self.postings.setdefault(ngram, set()).add(title)
+
+    def remove(self, title):
+        """ Remove a title from the index, if it was indexed """
+        lowered_title = self.lowered_titles.pop(title, None)
+        if lowered_title is None:
+            return
+        self.short_titles.discard(title)
+        for ngram in _ngrams(lowered_title):
+            titles = self.postings[ngram]
+            titles.discard(title)
+            if not titles:
+                del self.postings[ngram]
+
+    def candidates(self, query, score_cutoff=SCORE_CUTOFF):
+        """
+        Return the titles, which could match the query with score_cutoff.
+        partial_ratio is 100 * (1 - edits / (2 * len(query))) for the best part of a title,
+        counting inserted and deleted characters, and every edit changes
+        at most NGRAM_SIZE of the query's n-grams, the others are in the title.
+        A title shorter than the query is the part aligned, one shared n-gram is enough.
+        """
+        lowered_query = query.lower()
+        if len(lowered_query) < MIN_INDEXED_QUERY_LENGTH:
+            return list(self.lowered_titles)
+        query_ngrams = _ngrams(lowered_query)
+        max_edits = int(2 * len(lowered_query) * (100 - score_cutoff) // 100)
+        needed = max(1, len(query_ngrams) - NGRAM_SIZE * max_edits)
+        shared = Counter()
+        for ngram in query_ngrams:
+            shared.update(self.postings.get(ngram, ()))
+        found = set(self.short_titles)
+        for title, count in shared.items():
+            if count >= needed or len(self.lowered_titles[title]) < len(lowered_query):
+                found.add(title)
+        return list(found)
+
+    def search(self, query, score_cutoff=SCORE_CUTOFF):
+        """
+        Score the candidates of a query with rapidfuzz' partial_ratio.
+        Returns: [(title(str), score(float))] the best matches first
+        """
+        from rapidfuzz import fuzz, process
+        titles = self.candidates(query, score_cutoff)
+        choices = [self.lowered_titles[title] for title in titles]
+        matches = process.extract(query.lower(), choices, scorer=fuzz.partial_ratio,
+                                  score_cutoff=score_cutoff, limit=None)
+        return [(titles[position], score) for _, score, position in matches]
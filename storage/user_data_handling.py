@@ -1,56 +1,51 @@
-from storage import (movie_storage_sql as movie_storage)
+from storage import (movie_storage_sql as movie_storage, metrics, schema)
+from storage.database import get_engine, write_transaction
+from storage.errors import UnknownUserError
 
-from sqlalchemy import create_engine, text
+from sqlalchemy import text
 from termcolor import cprint, colored
-from pathlib import Path
-
-# Ensure data folder exists
-data_path = Path(__file__).resolve().parent.parent / "data"
-data_path.mkdir(exist_ok=True)
-# Create path and user_engine
-db_file = data_path / "users.db"
-
-db_url = f"sqlite:///{db_file}"
-user_engine = create_engine(db_url)
 
 
+@metrics.timed()
 def init_user_table():
-    """ Create the users table, if it does not exist """
-    with user_engine.begin() as connection:
-        try:
-            connection.execute(text("""
-                CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_name TEXT NOT NULL
-                );
-            """))
-            connection.commit()
-        except Exception as e:
-            cprint(f"Error: {e}", 'red')
-        return
+    """ Create the users table or upgrade the database to the newest schema version """
+    try:
+        schema.migrate(get_engine())
+    except Exception as e:
+        metrics.count("errors_total", "user_data_handling.init_user_table")
+        cprint(f"Error: {e}", 'red')
+    return
 
 
+@metrics.timed()
 def get_user_data():
     """
     Ask the user for a user_id from the database and return it, if valid.
     Returns: {user_id(int): user_name(str)}
     """
-    with user_engine.connect() as user_connection:
+    with get_engine().connect() as user_connection:
         try:
             result = user_connection.execute(text("SELECT user_id, user_name FROM users;"))
             user_data = result.fetchall()
         except Exception as e:
+            metrics.count("errors_total", "user_data_handling.get_user_data")
             print(f"Error: {e}")
     return {row[0]: row[1] for row in user_data}
 
 
+@metrics.timed()
 def get_user_name(user_id):
-    """ Get the user_name from a single user_id """
-    with user_engine.connect() as user_conn:
+    """
+    Get the user_name from a single user_id
+    Raises UnknownUserError, if there is no user with this user_id.
+    """
+    with get_engine().connect() as user_conn:
         result = user_conn.execute(text("SELECT user_name FROM users WHERE user_id = :user_id;"),
                           {"user_id": user_id})
         rows = result.fetchall()
-        return rows[0][0]
+    if not rows:
+        raise UnknownUserError([user_id])
+    return rows[0][0]
 
 
 def user_menu():
@@ -62,7 +57,7 @@ def user_menu():
     return: (user_id: user_name), chosen via number.
         OR: "change_users" if the highest menu number was chosen.
     """
-    with user_engine.connect() as user_connection:
+    with get_engine().connect() as user_connection:
         result = user_connection.execute(text("SELECT user_id, user_name FROM users;"))
         user_data = result.fetchall()
         user_list = [row[1] for row in user_data]
@@ -129,18 +124,45 @@ def get_user_id_menu(menu_choice="change"):
             return
 
 
+@metrics.timed()
+def insert_user(user_name):
+    """ Add a user to the database and return the new user_id """
+    with write_transaction() as user_connection:
+        result = user_connection.execute(text("INSERT INTO users (user_name) VALUES (:user_name);"),
+                                         {"user_name": user_name})
+    return result.lastrowid
+
+
+@metrics.timed()
+def rename_user(user_id, user_name):
+    """ Change the name of a user, return False if the user_id doesn't exist """
+    with write_transaction() as user_connection:
+        result = user_connection.execute(text("UPDATE users SET user_name = :new_name WHERE user_id = :user_id"),
+                                         {"new_name": user_name, "user_id": user_id})
+    return result.rowcount > 0
+
+
+@metrics.timed()
+def remove_user(user_id):
+    """
+    Delete a user and, by the foreign key, all its movies in one transaction.
+    Return False if the user_id doesn't exist
+    """
+    with write_transaction() as user_connection:
+        result = user_connection.execute(text("DELETE FROM users WHERE user_id = :id"),
+                                         {"id": user_id})
+    movie_storage.clear_movie_cache(user_id)
+    return result.rowcount > 0
+
+
 def delete_user():
-    """Delete a user from the database."""
+    """Ask for a user_id and delete the user with all its movies."""
     user_id = get_user_id_menu("delete")
-    with user_engine.connect() as user_connection:
-        try:
-            user_connection.execute(text("DELETE FROM users WHERE user_id = :id"),
-                               {"id": user_id})
-            user_connection.commit()
-            cprint("User deleted successfully", 'green')
-        except Exception as e:
-            cprint(f"Error: {e}", "red")
-    movie_storage.delete_user_movies(user_id)
+    try:
+        remove_user(user_id)
+        cprint("User deleted successfully", 'green')
+    except Exception as e:
+        cprint(f"Error: {e}", "red")
     return
 
 
@@ -154,14 +176,11 @@ def update_user():
     else:
         cprint("Id doesn't exist!\n", 'red')
     # Update the user_name with the chosen id
-    with user_engine.connect() as user_connection:
-        try:
-            user_connection.execute(text("UPDATE users SET user_name = :new_name WHERE user_id = :user_id"),
-                               {"new_name": new_name, "user_id": user_id})
-            user_connection.commit()
-            cprint("User updated successfully", 'green')
-        except Exception as e:
-            cprint(f"Error: {e}", "red")
+    try:
+        rename_user(user_id, new_name)
+        cprint("User updated successfully", 'green')
+    except Exception as e:
+        cprint(f"Error: {e}", "red")
     return
 
 
@@ -170,10 +189,7 @@ def add_user():
     new_user = ""
     while not new_user:
         new_user = input(colored("\nPlease enter a new user name: ", 'yellow'))
-    with user_engine.connect() as user_connection:
-        user_connection.execute(text("INSERT INTO users (user_name) VALUES (:user_name);"),
-                            {"user_name": new_user})
-        user_connection.commit()
+    insert_user(new_user)
     cprint("User added successfully", 'green')
     return
 
@@ -0,0 +1,269 @@
+"""
+Render the movie website of a user from _static/index_template.html.
+The template is read and split once, the escaped movie items are streamed
+straight into the output file, which replaces the old page when it is complete.
+A hash of the rendered content is stored at the end of the first page,
+so unchanged collections are not written again.
+Big collections are split into pages of PAGE_SIZE movies.
+Posters stored by storage.poster_cache are linked as local files,
+the grid shows their thumbnails.
+
+Export the websites of all users and an index page with:
+    python website.py [--workers 4]
+"""
+import argparse
+import hashlib
+import os
+import re
+import time
+from functools import lru_cache
+from html import escape
+from itertools import islice
+from pathlib import Path
+from urllib.parse import quote
+
+from storage import (movie_storage_sql as storage,
+                     user_data_handling as user,
+                     metrics)
+from storage.files import atomic_path
+
+STATIC_PATH = Path(__file__).resolve().parent / "_static"
+TEMPLATE_FILE = STATIC_PATH / "index_template.html"
+GRID_PLACEHOLDER = "__TEMPLATE_MOVIE_GRID__"
+PAGINATION_PLACEHOLDER = "__TEMPLATE_PAGINATION__"
+HASH_MARKER = "<!-- content-hash: "
+INDEX_FILE_NAME = "index.html"
+PAGE_SIZE = 1000
+
+MOVIE_ITEM = """
+        <li class='movie-grid li'>
+                <div class='movie'>
+                    <a href='{poster_link}' data-toggle="tooltip" data-placement="top" title='{comment}'><img class='movie-poster' src='{poster_src}' alt='Poster Image'/></a>
+                    <p class='movie-title'> {title} </p>
+                    <p class='movie-year'> {year} </p>
+                    <p class='movie-rating'> Rated {rating} </p>
+                </div>
+        </li>\n
+            """
+
+
+@lru_cache(maxsize=4)
+def _compile_template(template_file, modified_time):
+    """
+    Split the template at its placeholders, cached until the file changes.
+    Returns: (head, middle, tail) around the movie grid and the pagination
+    """
+    with open(template_file, "r", encoding="utf-8") as data:
+        template = data.read()
+    head, rest = template.split(GRID_PLACEHOLDER)
+    if PAGINATION_PLACEHOLDER in rest:
+        middle, tail = rest.split(PAGINATION_PLACEHOLDER)
+    else:
+        middle, tail = rest, ""
+    return head, middle, tail
+
+
+def load_template(template_file=TEMPLATE_FILE):
+    """ Return the compiled template parts of the current template file """
+    return _compile_template(str(template_file), os.stat(template_file).st_mtime_ns)
+
+
+def poster_sources(movie, posters, output_path):
+    """
+    Return the (link, image) urls of a movie's poster, the original and the thumbnail
+    relative to the page, if the poster is stored locally, otherwise the poster_url twice.
+    posters: {poster_url: CachedPoster} or None
+    """
+    poster = posters.get(movie.poster_url) if posters else None
+    if poster is None:
+        return movie.poster_url or "", movie.poster_url or ""
+    return (quote(Path(os.path.relpath(poster.image, output_path)).as_posix()),
+            quote(Path(os.path.relpath(poster.thumbnail, output_path)).as_posix()))
+
+
+def render_movie(movie, poster_link=None, poster_src=None):
+    """ Return the escaped grid item of a single Movie """
+    if poster_link is None:
+        poster_link = poster_src = movie.poster_url or ""
+    return MOVIE_ITEM.format(title=escape(str(movie.title), quote=False),
+                             year=escape(str(movie.display_year), quote=False),
+                             rating=escape(str(movie.display_rating), quote=False),
+                             poster_link=escape(str(poster_link)), poster_src=escape(str(poster_src)),
+                             comment=escape(str(movie.comment or "")))
+
+
+def site_name(user_id, user_name):
+    """
+    The base of the file names of a user's pages: the user name reduced to letters,
+    digits and dashes, so it can't leave the output folder, and the unique user_id.
+    """
+    slug = re.sub(r"[^a-z0-9]+", "-", user_name.lower()).strip("-") or "user"
+    return f"{slug}_{user_id}"
+
+
+def page_name(site, page_number):
+    """ The first page is named after the site, following pages get a number """
+    if page_number == 1:
+        return f"{site}.html"
+    return f"{site}_{page_number}.html"
+
+
+def render_pagination(site, page_number, page_count):
+    """ Return the navigation links between the pages of a user """
+    if page_count <= 1:
+        return ""
+    links = []
+    for number in range(1, page_count + 1):
+        if number == page_number:
+            links.append(f"<span class='current-page'>{number}</span>")
+        else:
+            links.append(f"<a href='{escape(page_name(site, number))}'>{number}</a>")
+    return f"<nav class='pagination'>{' '.join(links)}</nav>"
+
+
+def content_hash(user_name, movies, page_size, posters=None, output_path=STATIC_PATH):
+    """
+    Hash everything, that ends up in the pages of a user.
+    Returns: (hash(str), movie_count(int))
+    """
+    digest = hashlib.sha256()
+    head, middle, tail = load_template()
+    for part in (head, middle, tail, user_name, str(page_size)):
+        digest.update(part.encode())
+    movie_count = 0
+    for movie in movies:
+        digest.update(repr((tuple(movie), poster_sources(movie, posters, output_path))).encode())
+        movie_count += 1
+    return digest.hexdigest(), movie_count
+
+
+def read_content_hash(file_path):
+    """ Return the hash stored at the end of a generated page or None """
+    try:
+        with open(file_path, "rb") as handle:
+            handle.seek(max(0, os.path.getsize(file_path) - 200))
+            ending = handle.read().decode("utf-8", errors="ignore")
+    except OSError:
+        return None
+    if HASH_MARKER not in ending:
+        return None
+    return ending.rsplit(HASH_MARKER, 1)[1].split(" ", 1)[0]
+
+
+def generate_website(user_id, user_name, movies, output_path=STATIC_PATH, page_size=PAGE_SIZE, posters=None):
+    """
+    Write the pages of a user's website, unless they are up to date.
+    The files are named by site_name(user_id, user_name).
+    movies: Movies ordered by title, iterated twice (e.g. a list or a MovieStream),
+    so a streamed collection is never held in memory at once
+    posters: {poster_url: CachedPoster} of the locally stored posters, others are hotlinked
+    Returns: True if the pages were written, False if nothing changed
+    """
+    output_path = Path(output_path)
+    site = site_name(user_id, user_name)
+    new_hash, movie_count = content_hash(user_name, movies, page_size, posters, output_path)
+    first_page = output_path / page_name(site, 1)
+    if read_content_hash(first_page) == new_hash:
+        return False
+
+    head, middle, tail = load_template()
+    title_name = user_name + "'s"
+    head = head.replace("My", escape(title_name, quote=False))
+    page_count = max(1, -(-movie_count // page_size))
+    movie_items = iter(movies)
+    for page_number in range(1, page_count + 1):
+        with atomic_path(output_path / page_name(site, page_number)) as temp_path, \
+                open(temp_path, "w", encoding="utf8") as handle:
+            handle.write(head)
+            for movie in islice(movie_items, page_size):
+                handle.write(render_movie(movie, *poster_sources(movie, posters, output_path)))
+            handle.write(middle)
+            handle.write(render_pagination(site, page_number, page_count))
+            handle.write(tail)
+
+    # Remove pages left over from a bigger collection
+    page_number = page_count + 1
+    while (output_path / page_name(site, page_number)).exists():
+        (output_path / page_name(site, page_number)).unlink()
+        page_number += 1
+    # Only marked as up to date, once every page was written
+    with open(first_page, "a", encoding="utf8") as handle:
+        handle.write(f"\n{HASH_MARKER}{new_hash} -->\n")
+    return True
+
+
+def cache_posters(movies):
+    """
+    Download the posters of the movies, which are not stored locally yet.
+    Returns: {poster_url: CachedPoster} for generate_website()
+    """
+    from storage import poster_cache
+    return poster_cache.cache_posters(movie.poster_url for movie in movies)
+
+
+def _timed_generate_website(user_id, user_name, movies, output_path, page_size, posters):
+    """ Worker of export_all_websites, returns (user_id, written, seconds) """
+    start = time.perf_counter()
+    written = generate_website(user_id, user_name, movies, output_path, page_size, posters)
+    return user_id, written, time.perf_counter() - start
+
+
+def render_index(users_movie_count):
+    """
+    Return an index page linking the websites of all users.
+    users_movie_count: {user_id: (user_name, movie_count)}
+    """
+    head, middle, tail = load_template()
+    links = [f"<li><a href='{escape(quote(page_name(site_name(user_id, user_name), 1)))}'>"
+             f"{escape(user_name, quote=False)}</a> ({movie_count} movies)</li>"
+             for user_id, (user_name, movie_count) in sorted(users_movie_count.items(),
+                                                             key=lambda item: (item[1][0], item[0]))]
+    return head.replace("My", "All Users'") + "\n".join(links) + middle + tail
+
+
+def export_all_websites(output_path=STATIC_PATH, page_size=PAGE_SIZE, workers=None, local_posters=True):
+    """
+    Render the websites of all users in parallel processes
+    and write an index page linking them.
+    The posters of all users are downloaded first, unless local_posters is False.
+    Returns: {user_id: seconds} render time per user
+    """
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    start = time.perf_counter()
+    user_names = user.get_user_data()
+    movies_by_user = storage.list_all_movies()
+    posters = {}
+    if local_posters:
+        posters = cache_posters(movie for movies in movies_by_user.values() for movie in movies)
+        print(f"{len(posters)} posters stored locally in {time.perf_counter() - start:.3f}s")
+    render_times = {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        for user_id, user_name in user_names.items():
+            movies = movies_by_user.get(user_id, [])
+            # Only the posters of this user are sent to the worker process
+            user_posters = {movie.poster_url: posters[movie.poster_url]
+                            for movie in movies if movie.poster_url in posters}
+            futures.append(executor.submit(_timed_generate_website, user_id, user_name, movies,
+                                           output_path, page_size, user_posters))
+        for future in as_completed(futures):
+            user_id, written, seconds = future.result()
+            render_times[user_id] = seconds
+            print(f"{user_names[user_id]}: {'generated' if written else 'up to date'} in {seconds:.3f}s")
+    index_html = render_index({user_id: (user_name, len(movies_by_user.get(user_id, [])))
+                               for user_id, user_name in user_names.items()})
+    with atomic_path(Path(output_path) / INDEX_FILE_NAME) as temp_path:
+        temp_path.write_text(index_html, encoding="utf8")
+    print(f"Exported {len(user_names)} websites in {time.perf_counter() - start:.3f}s")
+    return render_times
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export the websites of all users.")
+    parser.add_argument("--workers", type=int, default=None, help="number of processes, all cores by default")
+    parser.add_argument("--page-size", type=int, default=PAGE_SIZE)
+    parser.add_argument("--hotlink-posters", action="store_true", help="link the posters instead of storing them")
+    arguments = parser.parse_args()
+    metrics.setup_from_environment()
+    export_all_websites(page_size=arguments.page_size, workers=arguments.workers,
+                        local_posters=not arguments.hotlink_posters)